@@ -0,0 +1,70 @@
+import sys
+import threading
+from itertools import islice
+from porter2stemmer import Porter2Stemmer
+
+_stemmer = Porter2Stemmer()
+_stemmer_lock = threading.Lock()
+
+
+def stem(word):
+    """Porter2 stem of word. Porter2Stemmer keeps the R1/R2 regions of the previous word when
+    a word has none, they are reset so the stem depends on word alone."""
+    with _stemmer_lock:
+        _stemmer.r1 = _stemmer.r2 = sys.maxsize
+        return _stemmer.stem(word)
+
+
+class TermCache:
+    """Bounded memo of surface form -> normalized form for a pure normalize function. Word
+    frequencies are Zipfian, so a small cache absorbs most occurrences. When max_entries is
+    reached the oldest quarter of the entries is dropped. Lookups take no lock, the counters
+    are approximate when several threads use the cache. Instances pickle with their entries,
+    so worker processes can start warm."""
+    def __init__(self, normalize, max_entries: int = 100000):
+        self.normalize = normalize
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __call__(self, surface):
+        result = self.entries.get(surface)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = self.normalize(surface)
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                dropped = list(islice(self.entries, max(1, self.max_entries // 4)))
+                for key in dropped:
+                    del self.entries[key]
+                self.evictions += len(dropped)
+            self.entries[surface] = result
+        return result
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+# Stems shared by the indexer and the query parsers
+stem_cache = TermCache(stem)
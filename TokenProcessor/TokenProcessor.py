@@ -3,12 +3,15 @@ from nltk.tokenize import word_tokenize
 from nltk.corpus import stopwords
 from porter2stemmer import Porter2Stemmer
 from nltk.stem import SnowballStemmer
+from TokenProcessor.TermCache import TermCache, stem_cache
 
 class TokenProcessor:
     def __init__(self):
         self.stemmer = Porter2Stemmer()  # English stemmer
         self.non_alphanumeric_pattern = re.compile(r'^[^a-zA-Z0-9]+|[^a-zA-Z0-9]+$', re.UNICODE)
         self.stop_words = set(stopwords.words('english'))
+        # Whitespace separated word -> its (type, term) pairs, see tokenize
+        self.word_cache = TermCache(self.analyze_word)
 
     def process_token(self, token):
         # Step 1: Handle hyphens
@@ -35,8 +38,8 @@ class TokenProcessor:
         return list(cleaned_tokens)
 
     def normalize_type(self, type):
-        # Step 5: Stem using Porter2 Stemmer
-        return self.stemmer.stem(type)
+        # Step 5: Stem using Porter2 Stemmer, memoized in the shared stem cache
+        return stem_cache(type)
 
 
     def cleantoken(self,word):
@@ -57,29 +60,50 @@ class TokenProcessor:
 
 
 
+    def analyze_word(self, word):
+        """Returns the (type, term) pairs of one whitespace separated word, in position order."""
+        return tuple((token, self.normalize_type(self.cleantoken(token))) for token in self.process_token(word))
+
+    def cache_stats(self):
+        return {"stems": stem_cache.stats(), "words": self.word_cache.stats()}
+
+    def tokenize(self, text, forms=None):
+        """
+        Tokenize text in one pass, producing everything the indexer needs.
+        Args:
+            text (str): The document body.
+            forms (dict, optional): Counts every occurrence of a term's unstemmed form in it,
+                as forms[term][form], see add_forms of the indexes.
+        Returns:
+            tuple: (types, terms, positions). types are the stemmed vocabulary types, as
+                normalize_type applied to process_token(text), terms the term at every position
+                and positions maps each term to its positions, in order of first occurrence.
+        """
+        if not text:
+            return [], [], {}
+        types = {}
+        terms = []
+        positions = {}
+        for word in text.split():
+            for token, term in self.word_cache(word):
+                types[token] = None
+                if forms is not None:
+                    counts = forms.setdefault(term, {})
+                    counts[token] = counts.get(token, 0) + 1
+                if term in positions:
+                    positions[term].append(len(terms))
+                else:
+                    positions[term] = [len(terms)]
+                terms.append(term)
+        return [self.normalize_type(t) for t in types], terms, positions
+
     def get_tokens_and_positions(self, text):
-        words =  text.split()
-        tokens_with_positions = []
-        position = 0
-        for word in words:
-            tokens = self.process_token(word)
-            for token in tokens:
-                # Append token and its position
-                tokens_with_positions.append({"data":self.normalize_type(self.cleantoken(token)),"position": position})
-                position += 1  # Increment position for the next token
-        return tokens_with_positions
+        _, terms, _ = self.tokenize(text)
+        return [{"data": term, "position": position} for position, term in enumerate(terms)]
     
     
     def get_tokens_and_sqlite(self, text):
         if len(text)==0 or text==None:
             return []
-        words =  text.split()
-        tokens_with_positions = []
-        position = 0
-        for word in words:
-            tokens = self.process_token(word)
-            for token in tokens:
-                # Append token and its position
-                tokens_with_positions.append(self.normalize_type(self.cleantoken(token)))
-                position += 1  # Increment position for the next token
-        return tokens_with_positions
\ No newline at end of file
+        _, terms, _ = self.tokenize(text)
+        return terms
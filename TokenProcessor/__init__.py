@@ -1,3 +1,4 @@
 from TokenProcessor.TokenProcessor import TokenProcessor
 from TokenProcessor.frenchToken import frenchToken
-from TokenProcessor.spanishToken import spanishToken
\ No newline at end of file
+from TokenProcessor.spanishToken import spanishToken
+from TokenProcessor.TermCache import TermCache, stem_cache
@@ -4,19 +4,26 @@ from pathlib import Path
 from JsonFileDocument import JsonFileDocument
 import PyPDF2
 from XmlHtmlDocument import XmlHtmlDocument
-from TokenProcessor import TokenProcessor,spanishToken,frenchToken
-from indexing import PositionalInvertedIndex,PositionalInvertedIndexSqlite,DiskIndexWriter,DiskPositionalIndex
+from TokenProcessor import TokenProcessor,spanishToken,frenchToken,stem_cache
+from indexing import PositionalInvertedIndex,PositionalInvertedIndexSqlite,SpimiIndexer,DiskIndexWriter,DiskPositionalIndex,SegmentedIndex,SegmentedIndexWriter
+from indexing.DocumentStore import make_snippet
 from docx import Document 
 from langdetect import detect
-from querying import BooleanQueryParser
+from querying import BooleanQueryParser, QueryCache, SpellingCorrector, QueryPool, Overloaded, QueryMetrics
+from querying.QueryMetrics import stage
+from concurrent.futures import TimeoutError as PoolTimeout
 import sys
-from textblob import TextBlob
 from flask_cors import CORS
-from porter2stemmer import Porter2Stemmer
 import re
+import threading
+import multiprocessing
+import json
+import queue
+import logging
 
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
 CORS(app, origins=["http://localhost:3000","http://localhost:3000"])
 documents = {}
 directories = ["Data/json", "Data/txt", "Data/pdf", "Data/xml", "Data/docx"]
@@ -29,6 +36,65 @@ filesJsonDiskSqlite = PositionalInvertedIndexSqlite()
 
 boolean_query_parser=None
 
+# Loading the stopword list is not free, one processor serves every document
+token_processor = TokenProcessor()
+
+# Incrementally updated index, used instead of the single index files once it exists
+SEGMENTS_DIR = "segments"
+
+# Process-wide index handle shared by all requests, see get_disk_index()
+disk_index = None
+disk_index_lock = threading.Lock()
+segment_writer = None
+
+# Results of repeated queries, dropped whenever the index generation changes
+query_cache = QueryCache()
+# Did you mean suggestions for queries without results, cached per misspelled word
+spelling_corrector = SpellingCorrector()
+# Query evaluation runs here, at most QUERY_WORKERS at once with QUERY_QUEUE more waiting,
+# further requests get a 503 instead of queueing
+QUERY_WORKERS = 4
+QUERY_QUEUE = 16
+QUERY_TIMEOUT = 10.0
+query_pool = QueryPool(QUERY_WORKERS, QUERY_QUEUE, QUERY_TIMEOUT)
+# Latency histograms of every query by stage, served by /metrics. With enabled=False queries
+# are only timed when a request asks for "timing"
+query_metrics = QueryMetrics(enabled=True)
+MAX_BATCH = 10000
+
+def get_disk_index():
+    """Returns the index a request should use. A request calls this once and keeps the result:
+    newer indexes replace the shared reference as a whole, the one it holds never changes."""
+    global disk_index
+    current = disk_index
+    index = current
+    if isinstance(index, DiskPositionalIndex) and index.stale():
+        # Rebuilt by another process, the cached results are dropped with the generation
+        index = None
+    elif isinstance(index, SegmentedIndex):
+        # Segments added, deleted or merged since the last request give a new snapshot
+        index = index.refreshed()
+    if index is None:
+        with disk_index_lock:
+            # Another request may have opened the new index meanwhile
+            if disk_index is current:
+                if os.path.exists(os.path.join(SEGMENTS_DIR, "segments.json")):
+                    disk_index = SegmentedIndex(SEGMENTS_DIR)
+                else:
+                    disk_index = DiskPositionalIndex("vocab_term_mapping.db", "postings.bin")
+            index = disk_index
+    elif index is not current:
+        disk_index = index
+    return index
+
+def reset_disk_index():
+    # Called once the rewritten index files are renamed into place, so the next request maps
+    # the new ones. Requests still running keep the old index, it is not closed under them:
+    # its files and mappings are released when the last reference goes away
+    global disk_index
+    with disk_index_lock:
+        disk_index = None
+
 def load_pdf(pdf_file_path):
     with open(pdf_file_path, 'rb') as pdf_file:
         pdf_reader = PyPDF2.PdfReader(pdf_file)
@@ -42,44 +108,51 @@ def load_pdf(pdf_file_path):
         title = os.path.splitext(os.path.basename(pdf_file_path))[0] # Use the file name as the title
         return {"title":title, "body":body, 'filetype':'pdf'}
 
+def load_document(directory_path, filename):
+    # Returns the document dict for a supported file type, None otherwise
+    file_path = os.path.join(directory_path, filename)
+    if filename.endswith('.txt'):
+        with open(file_path, 'r', encoding='utf-8') as txt_file:
+            title = os.path.splitext(filename)[0]  # Use the file name as the title
+            content = txt_file.read()
+            return {'title': title, 'body': content,'filetype':'txt'}
+    elif filename.endswith('.json'):
+        json_document = JsonFileDocument(file_path)
+        return {'title': file_path.split('/')[-1]+" "+json_document.get_title(), 'name': json_document.get_title(), 'body': json_document.get_body(), 'url': json_document.get_url(),'filetype':'json'}
+    elif filename.endswith(('.xml', '.html', '.htm')):
+        xml_html_document = XmlHtmlDocument(file_path)
+        return xml_html_document.dataSend()
+    elif filename.endswith('.pdf'):
+        return load_pdf(file_path)
+    elif filename.endswith('.docx'):
+        doc = Document(file_path)
+        text_content = " ".join([paragraph.text for paragraph in doc.paragraphs])
+        return {'title': os.path.splitext(os.path.basename(file_path))[0], 'body': text_content, 'filetype':'docx'}
+    return None
+
 def LoadDocuments(directory_path):
     documents = []
     for filename in os.listdir(directory_path):
-        file_path = os.path.join(directory_path, filename)
-        if filename.endswith('.txt'):
-            with open(file_path, 'r', encoding='utf-8') as txt_file:
-                title = os.path.splitext(filename)[0]  # Use the file name as the title
-                content = txt_file.read()
-                documents.append({'title': title, 'body': content,'filetype':'txt'})
-        elif filename.endswith('.json'):
-            json_document = JsonFileDocument(file_path)
-            documents.append({'title': file_path.split('/')[-1]+" "+json_document.get_title(), 'body': json_document.get_body(), 'url': json_document.get_url(),'filetype':'json'})
-        elif filename.endswith(('.xml', '.html', '.htm')):
-            xml_html_document = XmlHtmlDocument(file_path)
-            documents.append(xml_html_document.dataSend())
-        elif filename.endswith('.pdf'):
-            pdf_document = load_pdf(file_path)
-            documents.append(pdf_document)
-        elif filename.endswith('.docx'):
-            doc = Document(file_path)
-            text_content = " ".join([paragraph.text for paragraph in doc.paragraphs])
-            documents.append({'title': os.path.splitext(os.path.basename(file_path))[0], 'body': text_content, 'filetype':'docx'})
+        document = load_document(directory_path, filename)
+        if document is not None:
+            documents.append(document)
     return documents
 
 def GetTokenData(rowdata):
     # Check if rowdata['body'] is empty or None
     if not rowdata['body']:
-        return {"fileName": rowdata["title"], "tokenData": [],"indexAndToken":[],"sqlitesDatatoken":[]}
+        return {"fileName": rowdata["title"], "tokenData": [],"indexAndToken":[],"sqlitesDatatoken":[],"positions":{},"forms":{}}
     resulting_types=[]
     detected_language = detect(rowdata['body'])
-    print(f"\n\nThe detected language is: {detected_language}\n\n") 
+    logger.debug("Detected language %s for %s", detected_language, rowdata["title"])
 
     if True:
-        token_processor = TokenProcessor()
-        resulting_types = token_processor.process_token(rowdata['body'])
-        resulting_terms = [token_processor.normalize_type(t) for t in resulting_types]
+        # One tokenizer pass gives the types, the terms and their positions together
+        # forms counts the words each term was stemmed from, for spelling suggestions
+        forms = {}
+        resulting_terms, terms, positions = token_processor.tokenize(rowdata['body'], forms)
         # filtered_terms = token_processor.remove_stopwords(resulting_types)
-        return {"fileName": rowdata["title"], "tokenData": resulting_terms , "indexAndToken":token_processor.get_tokens_and_positions(rowdata['body']),"sqlitesDatatoken":token_processor.get_tokens_and_sqlite(rowdata['body'])}
+        return {"fileName": rowdata["title"], "tokenData": resulting_terms , "indexAndToken":[{"data": term, "position": position} for position, term in enumerate(terms)],"sqlitesDatatoken":terms, "positions":positions, "forms":forms}
     
     # elif detected_language == "es":
     #     processor = spanishToken()
@@ -108,26 +181,109 @@ def tokenize_with_positions(document):
     return positions
 
 
-def load_filesDB():
-    for i in range(len(['Data/json'])):     
-        documents['Data/json']=LoadDocuments('Data/json')
-    for document_id, document in enumerate(documents["Data/json"]):
-        data=GetTokenData(document)
-        positions = tokenize_with_positions(data["sqlitesDatatoken"])
-        for term, term_positions in positions.items():
-            filesJsonDiskSqlite.add_term(term, int(data['fileName'].split('.')[0]), term_positions)
-    writer = DiskIndexWriter(filesJsonDiskSqlite, "vocab_term_mapping.db", "postings.bin")
-    writer.write_index()
+def add_document(index, document):
+    data=GetTokenData(document)
+    positions = data["positions"]
+    doc_id = int(data['fileName'].split('.')[0])
+    for term, term_positions in positions.items():
+        index.add_term(term, doc_id, term_positions)
+    index.add_forms(data["forms"])
+    # Result titles are served from the document store instead of re-reading the file
+    index.add_document(doc_id, document.get('name', document['title']), document.get('url', ''), make_snippet(document['body']))
+
+def index_partition(directory_path, filenames):
+    # Runs in a worker process: loads, tokenizes and indexes one slice of the corpus
+    partial = PositionalInvertedIndexSqlite()
+    for filename in filenames:
+        document = load_document(directory_path, filename)
+        if document is not None:
+            add_document(partial, document)
+    return partial
+
+def index_partition_args(args):
+    return index_partition(*args)
+
+def index_parallel(directory_path, index, workers, chunks_per_worker=4):
+    """Spreads parsing and tokenization of directory_path over a pool of workers processes
+    and merges their partial indexes into index. Files are split into contiguous slices of the
+    sorted listing and merged back in that order, and DiskIndexWriter sorts terms and postings,
+    so the files written are the same as for a serial build."""
+    filenames = sorted(os.listdir(directory_path))
+    chunk_count = max(1, min(len(filenames), workers * chunks_per_worker))
+    chunk_size = -(-len(filenames) // chunk_count)
+    chunks = [filenames[i:i + chunk_size] for i in range(0, len(filenames), chunk_size)]
+    # fork keeps the parent's hash seed, so set iteration order in TokenProcessor matches the serial build
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    with context.Pool(workers) as pool:
+        # imap hands partials over one at a time, in order, so a SpimiIndexer can spill as they arrive
+        for partial in pool.imap(index_partition_args, [(directory_path, chunk) for chunk in chunks]):
+            index.merge(partial)
+
+def load_filesDB(workers=1, memory_budget=None, segmented=False):
+    """Builds the disk index from Data/json. workers > 1 tokenizes in a process pool. With a
+    memory_budget in bytes postings are built by a SpimiIndexer that spills sorted runs to disk,
+    and documents are streamed one at a time instead of being kept in documents. segmented
+    writes the build as a segment of SEGMENTS_DIR, which add_files and delete_files then update."""
+    index = filesJsonDiskSqlite
+    if memory_budget is not None:
+        index = SpimiIndexer(memory_budget)
+    if workers > 1:
+        # Documents are not kept in memory in this mode, workers only send back their postings
+        index_parallel('Data/json', index, workers)
+    elif memory_budget is not None:
+        for filename in sorted(os.listdir('Data/json')):
+            document = load_document('Data/json', filename)
+            if document is not None:
+                add_document(index, document)
+    else:
+        for i in range(len(['Data/json'])):     
+            documents['Data/json']=LoadDocuments('Data/json')
+        for document_id, document in enumerate(documents["Data/json"]):
+            add_document(index, document)
+    if segmented:
+        get_segment_writer().add_segment(index)
+    else:
+        writer = DiskIndexWriter(index, "vocab_term_mapping.db", "postings.bin")
+        writer.write_index()
+        writer.close()
+    if memory_budget is not None:
+        index.close()
+    reset_disk_index()
+
+def get_segment_writer():
+    global segment_writer
+    with disk_index_lock:
+        if segment_writer is None:
+            segment_writer = SegmentedIndexWriter(SEGMENTS_DIR)
+            segment_writer.start_background_merges()
+    return segment_writer
+
+def add_files(filenames, directory_path='Data/json'):
+    """Indexes the given files as a new segment, replacing older versions of the same documents."""
+    partial = index_partition(directory_path, filenames)
+    get_segment_writer().add_segment(partial)
+    if not isinstance(disk_index, SegmentedIndex):
+        reset_disk_index()
+
+def delete_files(filenames):
+    get_segment_writer().delete_documents(int(filename.split('.')[0]) for filename in filenames)
+    if not isinstance(disk_index, SegmentedIndex):
+        reset_disk_index()
 
     
 
 
 # with app.app_context():
 #         load_filesDB()
+
+# Open the index at startup so the first request does not pay for it
+if os.path.exists(os.path.join(SEGMENTS_DIR, "segments.json")) or (os.path.exists("vocab_term_mapping.db") and os.path.exists("postings.bin")):
+    get_disk_index()
    
 def convert_text_to_query_format(text):
-        result2 = re.findall(r'\w+|AND|OR|NOT|"[^"]+"|[+-]', text)
-        stemmer = Porter2Stemmer()
+        # "a NEAR/k b" is kept together as one proximity term, like a quoted phrase
+        # Words may hold * wildcards, e.g. nation* or *ment
+        result2 = re.findall(r'\w+(?:\s+NEAR/\d+\s+\w+)+|\**\w[\w*]*|AND|OR|NOT|"[^"]+"|[+-]', text)
         terms = []
         operations=[]
         
@@ -137,9 +293,14 @@ def convert_text_to_query_format(text):
                 result.append("OR")
             elif result2[i] == "-":
                 result.append("AND NOT")
+            elif len(result2[i].split()) > 1:
+                # Phrases are stemmed word by word when they are evaluated
+                result.append(result2[i])
+            elif '*' in result2[i]:
+                # Wildcards are matched against the vocabulary, see DiskPositionalIndex.expand_wildcard
+                result.append(result2[i].lower())
             else:
-                result.append(stemmer.stem(result2[i]))
-        print(result)
+                result.append(stem_cache(result2[i]))
         for i in range(len(result)):
             if result[i]== "OR" or result[i]== "AND NOT":
                 operations.append(result[i])
@@ -150,17 +311,80 @@ def convert_text_to_query_format(text):
                         operations.append("AND")
                         
             
-        print(terms,operations)
         return terms, operations
     
 def convert_text_to_query_formatfor_rankquery(text):
-        result2 = re.findall(r'\w+|AND|OR|NOT|"[^"]+"|[+-]', text)
-        stemmer = Porter2Stemmer()
+        result2 = re.findall(r'\**\w[\w*]*|AND|OR|NOT|"[^"]+"|[+-]', text)
         result=[]
         for i in range(len(result2)):
-            result.append(stemmer.stem(result2[i]))
+            result.append(result2[i].lower() if '*' in result2[i] else stem_cache(result2[i]))
         return result
 
+def not_found(disk_index, text):
+    response_data = {'data':[],"message":"Term not found in any documents","file":0}
+    suggestion = spelling_corrector.suggest(disk_index, text)
+    if suggestion is not None:
+        response_data["did_you_mean"] = suggestion
+    return response_data
+
+def search_response(disk_index, text, result):
+    ids1 = []
+    with stage("metadata"):
+        for item in result:
+            entry = {"doc_id":str(item[0])+'.json'}
+            document = disk_index.document(item[0])
+            if document is not None:
+                entry["name"] = document["title"]
+                entry["url"] = document["url"]
+            ids1.append(entry)
+    if not ids1:
+        return not_found(disk_index, text)
+    return {'data':ids1,"message":"done","file":len(ids1)}
+
+def rank_response(disk_index, text, result):
+    if not result:
+        return not_found(disk_index, text)
+    return {'data':result,"message":"done","file":len(result)}
+
+def search_results(disk_index, text, terms, operations, timer):
+    # Runs on a query_pool worker: all request state is passed in, the index and caches
+    # are the only shared objects and they are safe to use from several threads
+    with timer:
+        return search_response(disk_index, text, disk_index.query(terms, operations))
+
+def rank_results(disk_index, text, terms, type, timer):
+    # Runs on a query_pool worker, see search_results
+    with timer:
+        return rank_response(disk_index, text, disk_index.queryRank(terms,type))
+
+def timed_response(response_data, timer):
+    # The stage breakdown is added for requests that asked for it, such responses are not cached
+    query_metrics.record(timer)
+    if timer.requested:
+        response_data["timing"] = timer.report()
+    return response_data
+
+def batch_results(disk_index, texts, queries, lines, timer):
+    # Runs on a query_pool worker, puts one JSON line per finished query on lines, then None
+    try:
+        with timer:
+            for i, result in disk_index.batch(queries):
+                if "type" in queries[i]:
+                    response_data = rank_response(disk_index, texts[i], result)
+                else:
+                    response_data = search_response(disk_index, texts[i], result)
+                response_data["index"] = i
+                lines.put(json.dumps(response_data) + "\n")
+        query_metrics.record(timer)
+    except Exception as e:
+        lines.put(json.dumps({'error': str(e)}) + "\n")
+    finally:
+        lines.put(None)
+
+def pool_busy(message):
+    # Overload is answered at once, clients retry instead of piling up behind slow queries
+    return jsonify({'error': message}), 503, {'Retry-After': '1'}
+
 @app.route('/searchdata', methods=['POST'])
 def readDisk_string():
     try:
@@ -169,17 +393,34 @@ def readDisk_string():
         if 'text' not in data:
             return jsonify({'error': 'Missing "text" field in JSON data'}), 400
         text=data['text']
-        disk_index = DiskPositionalIndex("vocab_term_mapping.db", "postings.bin")
-        terms, operations = convert_text_to_query_format(text)
-        result = disk_index.query(terms, operations)
-        ids1 = [{"doc_id":str(item[0])+'.json'} for item in result]
-        
-        if not ids1:
-            response_data = {'data':[],"message":"Term not found in any documents","file":0}
-        else:
-            response_data = {'data':ids1,"message":"done","file":len(ids1)}
-        return jsonify(response_data), 200
-
+        # The request keeps the index it started with even if a newer one is loaded meanwhile
+        disk_index = get_disk_index()
+        # {"timing": true} adds the time spent in each stage to the response
+        timer = query_metrics.timer("search", data.get('timing'))
+        with timer, stage("parse"):
+            terms, operations = convert_text_to_query_format(text)
+        if data.get('explain'):
+            # The chosen plan with estimated and actual cardinalities, never cached
+            return jsonify({'plan': query_pool.run(disk_index.explain, terms, operations)}), 200
+        cache_key = ("search", tuple(terms), tuple(operations))
+        # Read once: the result is cached under the generation it was computed against
+        generation = disk_index.generation
+        if not timer.requested:
+            cached = query_cache.get(cache_key, generation)
+            if cached is not None:
+                query_metrics.record(timer)
+                return app.response_class(cached, mimetype='application/json'), 200
+        response_data = timed_response(query_pool.run(search_results, disk_index, text, terms, operations, timer), timer)
+        response = jsonify(response_data)
+        if not timer.requested:
+            # Cached serialized, a hit then costs no JSON encoding
+            query_cache.put(cache_key, generation, response.get_data(), response_data["file"])
+        return response, 200
+
+    except Overloaded:
+        return pool_busy("Too many queries in progress, try again")
+    except PoolTimeout:
+        return pool_busy("Query timed out")
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
@@ -195,21 +436,91 @@ def rankquery():
         text=data['text']
         type=data['type']
         
-        disk_index = DiskPositionalIndex("vocab_term_mapping.db", "postings.bin")
-        terms = convert_text_to_query_formatfor_rankquery(text)
-        
-        result = disk_index.queryRank(terms,type)
+        disk_index = get_disk_index()
+        timer = query_metrics.timer("rank", data.get('timing'))
+        with timer, stage("parse"):
+            terms = convert_text_to_query_formatfor_rankquery(text)
+        cache_key = ("rank", tuple(terms), type)
+        generation = disk_index.generation
+        if not timer.requested:
+            cached = query_cache.get(cache_key, generation)
+            if cached is not None:
+                query_metrics.record(timer)
+                return app.response_class(cached, mimetype='application/json'), 200
         
-        if not result:
-            response_data = {'data':[],"message":"Term not found in any documents","file":0}
-        else:
-            response_data = {'data':result,"message":"done","file":len(result)}
-        return jsonify(response_data), 200
+        response_data = timed_response(query_pool.run(rank_results, disk_index, text, terms, type, timer), timer)
+        response = jsonify(response_data)
+        if not timer.requested:
+            query_cache.put(cache_key, generation, response.get_data(), response_data["file"])
+        return response, 200
+
+    except Overloaded:
+        return pool_busy("Too many queries in progress, try again")
+    except PoolTimeout:
+        return pool_busy("Query timed out")
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """Evaluates {"queries": [{"text": ...}, {"text": ..., "type": "okapi"}, ...]}, Boolean
+    queries like /searchdata and ranked ones, with a type, like /rankquery. Every distinct
+    term is decoded once for the whole batch. Results stream back as newline-delimited JSON,
+    one object per query in order, its "index" telling which."""
+    try:
+        data = request.get_json()
+        if 'queries' not in data:
+            return jsonify({'error': 'Missing "queries" field in JSON data'}), 400
+        if len(data['queries']) > MAX_BATCH:
+            return jsonify({'error': 'At most %d queries per batch' % MAX_BATCH}), 400
+        disk_index = get_disk_index()
+        # Timed as a whole, responses stream out before it is done so they carry no breakdown
+        timer = query_metrics.timer("batch")
+        texts = []
+        queries = []
+        with timer, stage("parse"):
+            for query in data['queries']:
+                text = query['text']
+                texts.append(text)
+                if 'type' in query:
+                    queries.append({"terms": convert_text_to_query_formatfor_rankquery(text), "type": query['type']})
+                else:
+                    terms, operations = convert_text_to_query_format(text)
+                    queries.append({"terms": terms, "operations": operations})
+        lines = queue.Queue()
+        # The whole batch takes one pool slot
+        query_pool.submit(batch_results, disk_index, texts, queries, lines, timer)
+
+        def stream():
+            while True:
+                line = lines.get()
+                if line is None:
+                    return
+                yield line
+        return app.response_class(stream(), mimetype='application/x-ndjson')
+
+    except Overloaded:
+        return pool_busy("Too many queries in progress, try again")
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Query latency histograms, in total and per stage, in the Prometheus text format."""
+    return app.response_class(query_metrics.exposition(), mimetype='text/plain; version=0.0.4'), 200
+
 
+@app.route('/poolstats', methods=['GET'])
+def poolstats():
+    return jsonify(query_pool.stats()), 200
 
 
+@app.route('/cachestats', methods=['GET'])
+def cachestats():
+    stats = {"queries": query_cache.stats(), "terms": token_processor.cache_stats(), "corrections": spelling_corrector.stats()}
+    index = disk_index
+    if index is not None:
+        stats["postings"] = index.cache_stats()
+    return jsonify(stats), 200
@@ -0,0 +1,57 @@
+import argparse
+import json
+import sys
+
+# Measurements where smaller is better, everything else numeric that ends in _per_second is a rate
+LOWER_IS_BETTER = ("_ms", "seconds")
+
+
+def flatten(results, prefix=""):
+    """Yields (dotted path, value) for the timing and rate entries of a results dict."""
+    for key, value in results.items():
+        path = prefix + key
+        if isinstance(value, dict):
+            yield from flatten(value, path + ".")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and (key.endswith(LOWER_IS_BETTER) or key.endswith("_per_second")):
+            yield path, value
+
+
+def compare(base, new):
+    """Returns (path, base value, new value, relative change) for every measurement in both,
+    the change being positive when new is slower."""
+    if base.get("version") != new.get("version"):
+        raise ValueError("Results versions %s and %s cannot be compared" % (base.get("version"), new.get("version")))
+    new_values = dict(flatten(new))
+    rows = []
+    for path, before in flatten(base):
+        after = new_values.get(path)
+        if after is None or not before:
+            continue
+        if path.endswith("_per_second"):
+            # As a change in time per unit of work, so rates and timings read alike
+            change = before / after - 1 if after else float("inf")
+        else:
+            change = (after - before) / before
+        rows.append((path, before, after, change))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files.")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Only show changes larger than this fraction.")
+    args = parser.parse_args(argv)
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+    if base.get("corpus") != new.get("corpus"):
+        print("warning: the runs used different corpora", file=sys.stderr)
+    for path, before, after, change in compare(base, new):
+        if abs(change) >= args.threshold:
+            print("%-55s %12.3f %12.3f %+7.1f%% %s" % (path, before, after, change * 100, "slower" if change > 0 else "faster"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import itertools
+import json
+import os
+import random
+
+# Pseudo-words are built from these, so the stemmer and tokenizer see English-like letters
+ONSETS = ["b", "c", "d", "f", "g", "h", "j", "k", "l", "m", "n", "p", "r", "s", "t", "v", "w", "z",
+          "br", "ch", "cl", "dr", "fl", "gr", "pl", "pr", "sh", "st", "str", "th", "tr"]
+VOWELS = ["a", "e", "i", "o", "u", "ai", "ea", "ee", "io", "ou"]
+CODAS = ["", "", "", "n", "r", "s", "t", "l", "m", "nd", "ng", "rk", "st"]
+
+
+def make_vocabulary(size, rng):
+    """Returns size distinct pseudo-words of one to four syllables."""
+    words = []
+    seen = set()
+    while len(words) < size:
+        syllables = rng.choice((1, 2, 2, 3, 3, 4))
+        word = "".join(rng.choice(ONSETS) + rng.choice(VOWELS) + rng.choice(CODAS) for _ in range(syllables))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def zipf_weights(size, exponent):
+    """Cumulative weights of ranks 1 to size under a Zipf law, for random.choices."""
+    return list(itertools.accumulate(1.0 / rank ** exponent for rank in range(1, size + 1)))
+
+
+class Corpus:
+    """A deterministic synthetic collection: the same seed and sizes always give the same
+    vocabulary and documents. Terms of bodies and titles follow a Zipf law of the given
+    exponent over the vocabulary, the most frequent word being words[0]. Body lengths are
+    uniform between a quarter and seven quarters of mean_length."""
+    def __init__(self, documents: int = 1000, vocabulary: int = 20000, mean_length: int = 200, exponent: float = 1.1, seed: int = 0):
+        self.documents = documents
+        self.mean_length = mean_length
+        self.exponent = exponent
+        self.seed = seed
+        self.words = make_vocabulary(vocabulary, random.Random(seed))
+        self.cum_weights = zipf_weights(vocabulary, exponent)
+
+    def sample(self, rng, count):
+        """count words drawn from the Zipf distribution."""
+        return rng.choices(self.words, cum_weights=self.cum_weights, k=count)
+
+    def document(self, doc_id):
+        # Every document has its own generator, so any one can be rebuilt without the others
+        rng = random.Random("%d/%d" % (self.seed, doc_id))
+        length = rng.randint(max(1, self.mean_length // 4), max(1, self.mean_length * 7 // 4))
+        return {
+            "title": " ".join(self.sample(rng, rng.randint(2, 6))).title(),
+            "body": " ".join(self.sample(rng, length)),
+            "url": "https://example.org/doc/%d" % doc_id,
+        }
+
+    def write(self, directory):
+        """Writes the documents as directory/<doc id>.json, like Data/json. Returns the number
+        of bytes written."""
+        os.makedirs(directory, exist_ok=True)
+        written = 0
+        for doc_id in range(self.documents):
+            data = json.dumps(self.document(doc_id)).encode('utf-8')
+            with open(os.path.join(directory, "%d.json" % doc_id), 'wb') as file:
+                file.write(data)
+            written += len(data)
+        return written
+
+    def config(self):
+        return {
+            "documents": self.documents,
+            "vocabulary": len(self.words),
+            "mean_length": self.mean_length,
+            "exponent": self.exponent,
+            "seed": self.seed,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic Data/json corpus with Zipfian term frequencies.")
+    parser.add_argument("directory", nargs="?", default="Data/json")
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--mean-length", type=int, default=200)
+    parser.add_argument("--exponent", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    corpus = Corpus(args.documents, args.vocabulary, args.mean_length, args.exponent, args.seed)
+    written = corpus.write(args.directory)
+    print("Wrote %d documents, %.1f MB to %s" % (corpus.documents, written / (1024 * 1024), args.directory))
+
+
+if __name__ == "__main__":
+    main()
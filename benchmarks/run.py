@@ -0,0 +1,257 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+
+from benchmarks.corpus import Corpus
+
+# Bumped whenever the layout of the results changes, compare.py refuses to mix versions
+RESULTS_VERSION = 1
+QUERY_KINDS = ("term", "and", "or", "not", "phrase", "wildcard")
+
+
+def log(message):
+    # stdout belongs to the code under test, whose prints are discarded
+    print(message, file=sys.stderr, flush=True)
+
+
+def summarize(seconds):
+    """Latency distribution of a list of timings in seconds, reported in milliseconds."""
+    if not seconds:
+        return {"count": 0}
+    ms = np.asarray(seconds) * 1000.0
+    total = float(np.sum(seconds))
+    return {
+        "count": len(ms),
+        "mean_ms": float(np.mean(ms)),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(np.max(ms)),
+        "total_seconds": total,
+        "queries_per_second": len(ms) / total if total else 0.0,
+    }
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started
+
+
+def make_queries(corpus, count, seed):
+    """Returns count (kind, text) pairs cycling through QUERY_KINDS. Words are drawn from the
+    corpus' Zipf distribution like its documents, phrases are adjacent words of a document."""
+    rng = random.Random(seed)
+    queries = []
+    for i in range(count):
+        kind = QUERY_KINDS[i % len(QUERY_KINDS)]
+        if kind == "term":
+            text = corpus.sample(rng, 1)[0]
+        elif kind == "and":
+            text = " ".join(corpus.sample(rng, rng.randint(2, 3)))
+        elif kind == "or":
+            text = " + ".join(corpus.sample(rng, 2))
+        elif kind == "not":
+            text = " - ".join(corpus.sample(rng, 2))
+        elif kind == "phrase":
+            words = corpus.document(rng.randrange(corpus.documents))["body"].split()
+            start = rng.randrange(max(1, len(words) - 1))
+            text = '"%s"' % " ".join(words[start:start + 2])
+        else:
+            text = wildcard_pattern(corpus.sample(rng, 1)[0], rng)
+        queries.append((kind, text))
+    return queries
+
+
+def wildcard_pattern(word, rng):
+    # Trailing, leading or inner wildcard, always matching word itself
+    shape = rng.randrange(3)
+    if shape == 0 or len(word) < 4:
+        return word[:max(1, len(word) // 2)] + "*"
+    if shape == 1:
+        return "*" + word[len(word) // 2:]
+    return word[:2] + "*" + word[-2:]
+
+
+def bench_build(app, corpus_bytes, documents, workers):
+    log("Building the disk index")
+    _, seconds = timed(app.load_filesDB, workers)
+    load = {
+        "workers": workers,
+        "seconds": seconds,
+        "documents_per_second": documents / seconds if seconds else 0.0,
+        "corpus_mb_per_second": corpus_bytes / (1024 * 1024) / seconds if seconds else 0.0,
+    }
+    # The same in-memory index written again on its own, so tokenizing is not counted
+    os.makedirs("rewrite", exist_ok=True)
+    writer = app.DiskIndexWriter(app.filesJsonDiskSqlite, os.path.join("rewrite", "vocab_term_mapping.db"), os.path.join("rewrite", "postings.bin"))
+    write = writer.write_index()
+    writer.close()
+    shutil.rmtree("rewrite")
+    return {"load_filesDB": load, "write_index": write}
+
+
+def run_passes(run, items):
+    # The first pass starts with empty caches, the second finds them filled by the first
+    passes = {}
+    for name in ("cold", "warm"):
+        timings = []
+        for item in items:
+            timings.append(timed(run, *item)[1])
+        passes[name] = timings
+    return passes
+
+
+def bench_query(app, index_factory, queries):
+    log("Timing DiskPositionalIndex.query")
+    parsed = [app.convert_text_to_query_format(text) for _, text in queries]
+    index = index_factory()
+    passes = run_passes(index.query, parsed)
+    index.close()
+    result = {name: summarize(timings) for name, timings in passes.items()}
+    result["by_kind"] = {kind: summarize([t for (k, _), t in zip(queries, passes["warm"]) if k == kind]) for kind in QUERY_KINDS}
+    return result
+
+
+def bench_rank(app, index_factory, queries):
+    result = {}
+    for type in ("okapi", "cosine"):
+        log("Timing DiskPositionalIndex.queryRank (%s)" % type)
+        items = [(app.convert_text_to_query_formatfor_rankquery(text), type) for kind, text in queries if kind != "not"]
+        index = index_factory()
+        passes = run_passes(index.queryRank, items)
+        index.close()
+        result[type] = {name: summarize(timings) for name, timings in passes.items()}
+    return result
+
+
+def bench_boolean_parser(app, corpus, queries):
+    log("Timing BooleanQueryParser")
+    from indexing import PositionalInvertedIndex
+    from querying import BooleanQueryParser
+
+    def build():
+        index = PositionalInvertedIndex()
+        for doc_id in range(corpus.documents):
+            _, terms, _ = app.token_processor.tokenize(corpus.document(doc_id)["body"])
+            for position, term in enumerate(terms):
+                index.add_term(term, doc_id)
+                index.add_termIndex({"data": term, "position": position}, doc_id)
+        return index
+
+    index, build_seconds = timed(build)
+    parser = BooleanQueryParser(index)
+    # The parser has no wildcard syntax
+    texts = [(text,) for kind, text in queries if kind != "wildcard"]
+    timings = [timed(lambda text: parser.get_postings(parser.parse_query(text)), *item)[1] for item in texts]
+    return {"build_seconds": build_seconds, "queries": summarize(timings)}
+
+
+def bench_wildcards(corpus, index_factory, count, seed):
+    log("Timing wildcard search")
+    from indexing import KGramIndex
+    rng = random.Random(seed)
+    patterns = [wildcard_pattern(word, rng) for word in corpus.sample(rng, count)]
+
+    def build():
+        kgrams = KGramIndex(3)
+        for doc_id in range(corpus.documents):
+            kgrams.add_object({"filename": doc_id, "words": sorted(set(corpus.document(doc_id)["body"].split()))})
+        return kgrams
+
+    kgrams, build_seconds = timed(build)
+    document_level = {"build_seconds": build_seconds, "queries": summarize([timed(kgrams.search_wildcard, pattern)[1] for pattern in patterns])}
+
+    # Vocabulary level, as wildcard queries of the disk index expand them
+    index = index_factory()
+    term_kgrams, load_seconds = timed(index.kgram_index)
+    term_level = {"load_seconds": load_seconds, "queries": summarize([timed(term_kgrams.expand, pattern)[1] for pattern in patterns])}
+    index.close()
+    return {"patterns": len(patterns), "KGramIndex": document_level, "TermKGramIndex": term_level}
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "commit": commit,
+    }
+
+
+def run(args):
+    corpus = Corpus(args.documents, args.vocabulary, args.mean_length, args.exponent, args.seed)
+    queries = make_queries(corpus, args.queries, args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="se-bench-")
+    results = {
+        "version": RESULTS_VERSION,
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "environment": environment(),
+        "config": {"queries": len(queries), "workers": args.workers, "cache_bytes": args.cache_bytes},
+    }
+    cwd = os.getcwd()
+    try:
+        log("Writing %d documents to %s" % (corpus.documents, workdir))
+        corpus_bytes = corpus.write(os.path.join(workdir, "Data", "json"))
+        results["corpus"] = dict(corpus.config(), bytes=corpus_bytes)
+        # app reads Data/json and writes the index relative to the working directory
+        os.chdir(workdir)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            import app
+
+            def index_factory():
+                return app.DiskPositionalIndex("vocab_term_mapping.db", "postings.bin", cache_bytes=args.cache_bytes)
+
+            results["build"] = bench_build(app, corpus_bytes, corpus.documents, args.workers)
+            results["query"] = bench_query(app, index_factory, queries)
+            results["rank"] = bench_rank(app, index_factory, queries)
+            results["boolean_parser"] = bench_boolean_parser(app, corpus, queries)
+            results["wildcard"] = bench_wildcards(corpus, index_factory, args.queries, args.seed)
+    finally:
+        os.chdir(cwd)
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark indexing and querying on a synthetic corpus.")
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--mean-length", type=int, default=200)
+    parser.add_argument("--exponent", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=300, help="Queries per benchmark.")
+    parser.add_argument("--workers", type=int, default=1, help="Tokenizing processes for load_filesDB.")
+    parser.add_argument("--cache-bytes", type=int, default=64 * 1024 * 1024, help="Postings cache of the opened indexes.")
+    parser.add_argument("--workdir", help="Build here and keep the files, instead of in a temporary directory.")
+    parser.add_argument("--output", default="benchmark-results.json")
+    args = parser.parse_args(argv)
+    results = run(args)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    log("Results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
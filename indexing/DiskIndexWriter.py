@@ -1,10 +1,15 @@
 import struct
 import sqlite3
 from indexing import PositionalInvertedIndexSqlite
-from porter2stemmer import Porter2Stemmer
+from indexing.DiskLexicon import write_lexicon, lexicon_path
+from indexing.TermKGramIndex import write_kgram_index, kgram_path
+from indexing.DocumentStore import write_document_store, document_store_paths
+from indexing.varint import encode_into, decode_frequencies, skip_interval
 from JsonFileDocument import JsonFileDocument
 import math
+import mmap
 import os
+import time
 import numpy as np
 import json
 
@@ -33,82 +38,252 @@ def decode_bytes(byte_stream):
         shift += 7
     return number
 
+# postings.bin starts with POSTINGS_MAGIC followed by the variable byte encoded format version.
+# Files without it were written before versioning: absolute doc ids, positions either
+# interleaved with the postings or, if vocab_term_mapping has positions_position, in positions.bin.
+# Since FORMAT_SKIPS every run has a skip table after df, see varint.read_skips.
+POSTINGS_MAGIC = b'SEPI'
+FORMAT_INTERLEAVED = 0
+FORMAT_SPLIT = 1
+FORMAT_GAPS = 2
+FORMAT_SKIPS = 3
+POSTINGS_VERSION = FORMAT_SKIPS
+
+def postings_header(version=POSTINGS_VERSION):
+    return POSTINGS_MAGIC + bytes(encode_number(version))
+
+def read_format_version(postings, split_positions):
+    """Returns the format version of a postings file given its contents."""
+    if postings[:len(POSTINGS_MAGIC)] == POSTINGS_MAGIC:
+        return decode_bytes(postings[len(POSTINGS_MAGIC):len(POSTINGS_MAGIC) + 10])
+    return FORMAT_SPLIT if split_positions else FORMAT_INTERLEAVED
+
+def positions_path(postings_file):
+    # positions.bin lives next to postings.bin
+    return os.path.join(os.path.dirname(postings_file), "positions.bin")
+
+def temporary_path(path):
+    # Same directory, so os.replace can rename it over path
+    return "%s.%d.tmp" % (path, os.getpid())
+
 class DiskIndexWriter:
-    def __init__(self, index: PositionalInvertedIndexSqlite, db_path: str, postings_file: str):
+    """Writes an index as two streams. postings.bin starts with a versioned header and holds,
+    for every term, the document frequency followed by (doc_id gap, tf, positions byte length)
+    per document in increasing doc_id order, so ranking can read it without touching positions.
+    positions.bin holds the position gaps of every document, in the same order.
+    vocab_term_mapping and vocab.lex store where each term starts in both, terms are written
+    in sorted order. vocab.lex also stores per-term score upper bounds for top-k pruning.
+    If index records document metadata, it is written to the document store next to them.
+    The k-gram index of the vocabulary for wildcard queries goes next to db_path.
+
+    Files are written under temporary names and renamed over the old ones once all are complete:
+    readers keep the old files memory-mapped, truncating them in place would crash them.
+    postings.bin is renamed last, after every file it refers to: readers identify the index by
+    it, see DiskPositionalIndex.stale, so one that opened a mix of old and new files holds the
+    old postings.bin and is stale once the rename completes.
+
+    index is read through its sorted_items(), so a SpimiIndexer can stream merged runs.
+    The SQLite tables are built in a new database at a temporary path, in one transaction: rows are inserted with executemany in
+    batches of batch_size and the term index is only created once the table is filled."""
+    def __init__(self, index: PositionalInvertedIndexSqlite, db_path: str, postings_file: str, positions_file: str = None, batch_size: int = 10000):
         self.index = index
-        self.conn = sqlite3.connect(db_path)
+        self.conn = None
+        self.db_path = db_path
         self.postings_file = postings_file
+        self.positions_file = positions_file or positions_path(postings_file)
+        self.lexicon_file = lexicon_path(postings_file)
+        self.batch_size = batch_size
         self.total_length={}
         self.total_length_LD={}
-        
-        # self.conn.execute("DROP TABLE IF EXISTS vocab_term_mapping")
-        # self.conn.execute("""
-        #     CREATE TABLE vocab_term_mapping (
-        #         term TEXT PRIMARY KEY,
-        #         byte_position INTEGER
-        #     )
-        # """)
-        # self.conn.execute("DROP TABLE IF EXISTS All_length")
-        # self.conn.execute("""
-        #     CREATE TABLE All_length (
-        #         id TEXT PRIMARY KEY,
-        #         All_length INTEGER
-        #     )
-        # """)
-        # self.conn.execute("DROP TABLE IF EXISTS total_length")
-        # self.conn.execute("""
-        #     CREATE TABLE total_length (
-        #         id TEXT PRIMARY KEY,
-        #         total_position INTEGER,
-        #         ld REAL
-        #     )
-        # """)
 
-        self.conn.commit()
-    
+    def create_tables(self):
+        self.conn.execute("DROP TABLE IF EXISTS vocab_term_mapping")
+        # No key yet, vocab_term_index is built after the bulk insert
+        self.conn.execute("""
+            CREATE TABLE vocab_term_mapping (
+                term TEXT,
+                byte_position INTEGER,
+                positions_position INTEGER
+            )
+        """)
+        self.conn.execute("DROP TABLE IF EXISTS All_length")
+        self.conn.execute("""
+            CREATE TABLE All_length (
+                id TEXT PRIMARY KEY,
+                All_length INTEGER
+            )
+        """)
+        self.conn.execute("DROP TABLE IF EXISTS total_length")
+        self.conn.execute("""
+            CREATE TABLE total_length (
+                id TEXT PRIMARY KEY,
+                total_position INTEGER,
+                ld REAL
+            )
+        """)
+
+    def create_indexes(self):
+        self.conn.execute("CREATE UNIQUE INDEX vocab_term_index ON vocab_term_mapping (term)")
+
+    def encode_postings(self, postings, doc_buffer, positions_buffer):
+        """Encodes one term's postings, sorted by doc id, into doc_buffer and positions_buffer
+        and updates the document length statistics. A skip pointer is recorded every
+        skip_interval(df) documents so readers can decode only the blocks they need."""
+        # Variable byte encode the document frequency
+        encode_into(doc_buffer, len(postings))
+
+        interval = skip_interval(len(postings))
+        triples = bytearray()
+        skips = bytearray()
+        skip_count = 0
+        last_skip = (0, 0, 0)
+        positions_start = len(positions_buffer)
+        last_doc_id = 0
+        for i, (doc_id, positions) in enumerate(postings):
+            if i and i % interval == 0:
+                # The block starts after last_doc_id, its offsets count from the first document
+                skip = (last_doc_id, len(triples), len(positions_buffer) - positions_start)
+                for value, previous in zip(skip, last_skip):
+                    encode_into(skips, value - previous)
+                last_skip = skip
+                skip_count += 1
+
+            # Encode the gap between document IDs
+            encode_into(triples, doc_id - last_doc_id)
+            last_doc_id = doc_id
+            tf = len(positions)
+            self.total_length[doc_id] = self.total_length.get(doc_id, 0) + tf
+            wdt = 1 + math.log(tf)
+            self.total_length_LD[doc_id] = self.total_length_LD.get(doc_id, 0) + wdt * wdt
+
+            # Encode the term frequency
+            encode_into(triples, tf)
+
+            start = len(positions_buffer)
+            last_position = 0
+            for pos in positions:
+                # Encode the gap between positions
+                encode_into(positions_buffer, pos - last_position)
+                last_position = pos
+
+            # The positions go to their own stream, postings only record their length
+            encode_into(triples, len(positions_buffer) - start)
+
+        encode_into(doc_buffer, skip_count)
+        encode_into(doc_buffer, len(skips))
+        doc_buffer += skips
+        doc_buffer += triples
+
+    def document_arrays(self):
+        """Returns the document lengths and Ld of every document as arrays indexed by doc id."""
+        size = max(self.total_length) + 1 if self.total_length else 0
+        lengths = np.zeros(size)
+        ld = np.ones(size)
+        for doc_id, length in self.total_length.items():
+            lengths[doc_id] = length
+            ld[doc_id] = np.sqrt(self.total_length_LD[doc_id])
+        return lengths, ld
+
+    def term_bounds(self, entries, postings_file):
+        """Adds max_tf, min_dl and the largest cosine (wdt / Ld) and Okapi wdt contributions of
+        each term to its lexicon entry. Ld is only known once every term is written, so the
+        doc/tf streams are read back from postings_file, positions are not touched."""
+        lengths, ld = self.document_arrays()
+        average_length = lengths.sum() / len(self.total_length) if self.total_length else 1.0
+        with open(postings_file, 'rb') as file:
+            postings = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for term, byte_position, positions_position, df in entries:
+                    run = decode_frequencies(postings, byte_position, positions_position, True, True)
+                    tfs = run.tfs.astype(np.float64)
+                    doc_lengths = lengths[run.doc_ids]
+                    cosine = (1 + np.log(tfs)) / ld[run.doc_ids]
+                    # Same arithmetic as DiskPositionalIndex.calculate_wdtOkapi
+                    K = 1.2 * ((0.25) + (0.75 * (doc_lengths / average_length)))
+                    okapi = (2.2 * tfs) / (K + tfs)
+                    yield (term, byte_position, positions_position, df, int(run.tfs.max()), int(doc_lengths.min()),
+                           float(cosine.max()), float(okapi.max()))
+            finally:
+                postings.close()
+
     def write_index(self):
-        with open(self.postings_file, 'wb') as file:
-            All_length=0
-            for term, postings in self.index.index.items():
-                byte_position = file.tell()
-
-                # Variable byte encode the document frequency
-                file.write(bytes(encode_number(len(postings))))
-
-                last_doc_id = 0
-                for doc_id, positions in postings:
-                    # Encode and write the gap between document IDs
-                    file.write(bytes(encode_number(doc_id)))
-                    last_doc_id = doc_id
-                    if doc_id in self.total_length:
-                        self.total_length[doc_id]+=len(positions)
-                    else:
-                        self.total_length[doc_id]=len(positions)
-                    if doc_id in self.total_length_LD:
-                        self.total_length_LD[doc_id]+=(1+math.log(len(positions)))*(1+math.log(len(positions)))
-                    else:
-                        self.total_length_LD[doc_id]=(1+math.log(len(positions)))*(1+math.log(len(positions)))
-
-                    # Encode and write the term frequency
-                    file.write(bytes(encode_number(len(positions))))
-
-                    last_position = 0
-                    for pos in positions:
-                        # Encode and write the gap between positions
-                        file.write(bytes(encode_number(pos - last_position)))
-                        last_position = pos
-
-                self.conn.execute("INSERT OR REPLACE INTO vocab_term_mapping (term, byte_position) VALUES (?, ?)", (term, byte_position))
-                self.conn.commit()
-            for id, total_position in  self.total_length.items():
-                All_length += total_position
-                self.conn.execute("INSERT OR REPLACE INTO total_length (id, total_position,ld) VALUES (?, ?,?)", (id, total_position,np.sqrt(self.total_length_LD[id])))
-                self.conn.commit()
-            self.conn.execute("INSERT OR REPLACE INTO All_length (id, All_length) VALUES (?, ?)", (1, All_length))
-            self.conn.commit()
-                
-            
+        """Writes postings.bin, positions.bin, vocab.lex, the document store and the SQLite tables.
+        Returns build statistics: terms, bytes written, seconds, terms per second and MB per second."""
+        started = time.perf_counter()
+        index_file, data_file = document_store_paths(self.postings_file)
+        targets = [self.positions_file, self.lexicon_file, kgram_path(self.db_path)]
+        if hasattr(self.index, 'document_items'):
+            targets += [index_file, data_file]
+        targets += [self.db_path, self.postings_file]
+        temporary = {path: temporary_path(path) for path in targets}
+        try:
+            for path in temporary.values():
+                # Left over by an earlier build of this process that failed
+                if os.path.exists(path):
+                    os.remove(path)
+            self.conn = sqlite3.connect(temporary[self.db_path])
+            try:
+                stats = self.write_files(temporary)
+            finally:
+                self.conn.close()
+                self.conn = None
+            for path in targets:
+                os.replace(temporary[path], path)
+        finally:
+            for path in temporary.values():
+                if os.path.exists(path):
+                    os.remove(path)
+        elapsed = time.perf_counter() - started
+        stats["seconds"] = elapsed
+        stats["terms_per_second"] = stats["terms"] / elapsed if elapsed else 0.0
+        stats["mb_per_second"] = stats["bytes"] / (1024 * 1024) / elapsed if elapsed else 0.0
+        return stats
+
+    def write_files(self, temporary):
+        # Writes every file of write_index to its path in temporary and commits the SQLite tables
+        self.conn.execute("BEGIN")
+        self.create_tables()
+        lexicon = []
+        rows = []
+        doc_buffer = bytearray()
+        positions_buffer = bytearray()
+        with open(temporary[self.postings_file], 'wb') as file, open(temporary[self.positions_file], 'wb') as positions_file:
+            file.write(postings_header())
+            byte_position = file.tell()
+            positions_position = 0
+            # Documents may have been added in any order, gaps need the postings sorted
+            for term, postings in self.index.sorted_items():
+                doc_buffer.clear()
+                positions_buffer.clear()
+                self.encode_postings(postings, doc_buffer, positions_buffer)
+                file.write(doc_buffer)
+                positions_file.write(positions_buffer)
+
+                rows.append((term, byte_position, positions_position))
+                lexicon.append((term, byte_position, positions_position, len(postings)))
+                byte_position += len(doc_buffer)
+                positions_position += len(positions_buffer)
+                if len(rows) >= self.batch_size:
+                    self.conn.executemany("INSERT INTO vocab_term_mapping (term, byte_position, positions_position) VALUES (?, ?, ?)", rows)
+                    rows = []
+        self.conn.executemany("INSERT INTO vocab_term_mapping (term, byte_position, positions_position) VALUES (?, ?, ?)", rows)
+        write_lexicon(temporary[self.lexicon_file], self.term_bounds(lexicon, temporary[self.postings_file]))
+        # Spelling suggestions show terms as the word they were most often stemmed from
+        forms = self.index.term_forms() if hasattr(self.index, 'term_forms') else None
+        write_kgram_index(self.db_path, [entry[0] for entry in lexicon], path=temporary[kgram_path(self.db_path)], forms=forms)
+        if hasattr(self.index, 'document_items'):
+            index_file, data_file = document_store_paths(self.postings_file)
+            write_document_store(self.postings_file, self.index.document_items(), (temporary[index_file], temporary[data_file]))
+
+        All_length = sum(self.total_length.values())
+        self.conn.executemany("INSERT OR REPLACE INTO total_length (id, total_position,ld) VALUES (?, ?,?)",
+                              ((id, total_position, np.sqrt(self.total_length_LD[id])) for id, total_position in self.total_length.items()))
+        self.conn.execute("INSERT OR REPLACE INTO All_length (id, All_length) VALUES (?, ?)", (1, All_length))
+        self.create_indexes()
+        self.conn.commit()
+        return {"terms": len(lexicon), "bytes": byte_position + positions_position}
     
     def close(self):
-        self.conn.close()
-
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
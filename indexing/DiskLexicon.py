@@ -0,0 +1,185 @@
+import mmap
+import os
+import struct
+import numpy as np
+from indexing.varint import encode_into, read_number
+
+# vocab.lex layout:
+#   header: LEXICON_MAGIC, version (u8), block size (u32), term count (u64), block count (u64),
+#           byte offset of the block offset array (u64)
+#   blocks: BLOCK_SIZE entries each, the first one stores its whole term. An entry is
+#           shared prefix length, suffix length, suffix bytes, byte_position, positions_position, df,
+#           then from version 2 on max_tf, min_dl and the cosine and Okapi score bounds
+#           (variable byte numbers except the suffix and the bounds, which are float32).
+#   block offsets: one little-endian u64 per block, the byte offset where the block starts.
+LEXICON_MAGIC = b'SELX'
+LEXICON_VERSION = 2
+BLOCK_SIZE = 16
+HEADER = struct.Struct('<4sBIQQQ')
+BLOCK_OFFSET = struct.Struct('<Q')
+BOUNDS = struct.Struct('<ff')
+
+
+def round_up_float32(value):
+    # Bounds must never be below the real value, float32 rounding may go either way
+    rounded = np.float32(value)
+    if rounded < value:
+        rounded = np.nextafter(rounded, np.float32(np.inf))
+    return float(rounded)
+
+
+def lexicon_path(postings_file):
+    # vocab.lex lives next to postings.bin
+    return os.path.join(os.path.dirname(postings_file), "vocab.lex")
+
+
+def write_lexicon(path, entries):
+    """
+    Write a front-coded vocabulary file.
+    Args:
+        path (str): Where to write vocab.lex.
+        entries (iterable): (term, byte_position, positions_position, df, max_tf, min_dl, max_cosine, max_okapi)
+            tuples in increasing term order. max_cosine is the largest wdt / Ld and max_okapi the
+            largest Okapi wdt over the term's documents, see DiskIndexWriter.term_bounds.
+    """
+    data = bytearray()
+    block_offsets = []
+    previous = b''
+    count = 0
+    for term, byte_position, positions_position, df, max_tf, min_dl, max_cosine, max_okapi in entries:
+        key = term.encode('utf-8')
+        if count and key <= previous:
+            raise ValueError("Lexicon entries must be unique and sorted, got %r after %r" % (term, previous.decode('utf-8')))
+        if count % BLOCK_SIZE == 0:
+            # Block heads are stored whole so a block can be decoded on its own
+            block_offsets.append(HEADER.size + len(data))
+            shared = 0
+        else:
+            shared = 0
+            limit = min(len(key), len(previous))
+            while shared < limit and key[shared] == previous[shared]:
+                shared += 1
+        encode_into(data, shared)
+        encode_into(data, len(key) - shared)
+        data += key[shared:]
+        encode_into(data, byte_position)
+        encode_into(data, positions_position)
+        encode_into(data, df)
+        encode_into(data, max_tf)
+        encode_into(data, min_dl)
+        data += BOUNDS.pack(round_up_float32(max_cosine), round_up_float32(max_okapi))
+        previous = key
+        count += 1
+
+    with open(path, 'wb') as file:
+        offsets_start = HEADER.size + len(data)
+        file.write(HEADER.pack(LEXICON_MAGIC, LEXICON_VERSION, BLOCK_SIZE, count, len(block_offsets), offsets_start))
+        file.write(data)
+        file.write(struct.pack('<%dQ' % len(block_offsets), *block_offsets))
+
+
+class DiskLexicon:
+    """Memory-mapped reader for vocab.lex. Lookups binary search the block heads and scan one
+    block in place, nothing is loaded up front and no locking is needed between threads."""
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.block_size, self.term_count, self.block_count, self.data_end = HEADER.unpack_from(self.data, 0)
+        if magic != LEXICON_MAGIC or version not in (1, LEXICON_VERSION):
+            raise ValueError("%s is not a lexicon file" % path)
+        self.has_bounds = version >= 2
+
+    def __len__(self):
+        return self.term_count
+
+    def _read_entry(self, offset, previous):
+        shared, offset = read_number(self.data, offset)
+        suffix_length, offset = read_number(self.data, offset)
+        key = previous[:shared] + self.data[offset:offset + suffix_length]
+        offset += suffix_length
+        byte_position, offset = read_number(self.data, offset)
+        positions_position, offset = read_number(self.data, offset)
+        df, offset = read_number(self.data, offset)
+        if not self.has_bounds:
+            return key, (byte_position, positions_position, df), offset
+        max_tf, offset = read_number(self.data, offset)
+        min_dl, offset = read_number(self.data, offset)
+        max_cosine, max_okapi = BOUNDS.unpack_from(self.data, offset)
+        offset += BOUNDS.size
+        return key, (byte_position, positions_position, df, max_tf, min_dl, max_cosine, max_okapi), offset
+
+    def _block_offset(self, block):
+        if block == self.block_count:
+            return self.data_end
+        return BLOCK_OFFSET.unpack_from(self.data, self.data_end + BLOCK_OFFSET.size * block)[0]
+
+    def _block_head(self, block):
+        shared, offset = read_number(self.data, self._block_offset(block))
+        suffix_length, offset = read_number(self.data, offset)
+        return self.data[offset:offset + suffix_length]
+
+    def _find_block(self, key):
+        # Last block whose head is <= key, or -1 if key sorts before every term
+        low, high = 0, self.block_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._block_head(middle) <= key:
+                low = middle + 1
+            else:
+                high = middle
+        return low - 1
+
+    def _entries_from(self, block):
+        """Yields (key, entry) for every term from the start of block to the end of the lexicon."""
+        for current in range(max(block, 0), self.block_count):
+            offset = self._block_offset(current)
+            end = self._block_offset(current + 1)
+            previous = b''
+            while offset < end:
+                key, entry, offset = self._read_entry(offset, previous)
+                previous = key
+                yield key, entry
+
+    def lookup(self, term):
+        """Returns (byte_position, positions_position, df, max_tf, min_dl, max_cosine, max_okapi)
+        for term, or None. Version 1 files only have the first three."""
+        key = term.encode('utf-8')
+        block = self._find_block(key)
+        if block < 0:
+            return None
+        offset = self._block_offset(block)
+        end = self._block_offset(block + 1)
+        previous = b''
+        while offset < end:
+            found, entry, offset = self._read_entry(offset, previous)
+            if found == key:
+                return entry
+            if found > key:
+                break
+            previous = found
+        return None
+
+    def scan(self, start='', stop=None):
+        """Yields (term, entry) for start <= term < stop, in order, entries as returned by lookup."""
+        start_key = start.encode('utf-8')
+        stop_key = stop.encode('utf-8') if stop is not None else None
+        for key, entry in self._entries_from(self._find_block(start_key)):
+            if key < start_key:
+                continue
+            if stop_key is not None and key >= stop_key:
+                return
+            yield key.decode('utf-8'), entry
+
+    def prefix(self, prefix):
+        """Yields every (term, entry) whose term starts with prefix."""
+        start_key = prefix.encode('utf-8')
+        for key, entry in self._entries_from(self._find_block(start_key)):
+            if key < start_key:
+                continue
+            if not key.startswith(start_key):
+                return
+            yield key.decode('utf-8'), entry
+
+    def close(self):
+        self.data.close()
+        self.file.close()
@@ -1,12 +1,27 @@
 import struct
 import sqlite3
 from indexing import PositionalInvertedIndexSqlite
-from porter2stemmer import Porter2Stemmer
 from JsonFileDocument import JsonFileDocument
 import math
+import mmap
 import os
+import threading
+import copy
 import numpy as np
 import json
+from indexing.varint import decode_postings, decode_frequencies, decode_positions, read_number, read_skips, decode_blocks
+from indexing.DiskLexicon import DiskLexicon, lexicon_path
+from indexing.DiskIndexWriter import positions_path, read_format_version, FORMAT_GAPS, FORMAT_SKIPS
+from indexing.MaxScore import MaxScoreRanker, TermCursor, document_arrays
+from indexing.DocumentStore import DocumentStore, document_store_paths, make_snippet
+from indexing.PostingsCache import PostingsCache
+from TokenProcessor.TermCache import stem_cache
+from indexing.proximity import parse_proximity, join_documents
+from indexing.intersect import intersect_sorted, common_sorted, union_sorted
+from indexing.TermKGramIndex import TermKGramIndex
+from indexing.bitmap import DocBitmap
+from querying.QueryPlanner import Plan, QueryPlanner
+from querying.QueryMetrics import stage
 
 def encode_number(number):
     if number < 0:
@@ -33,17 +48,362 @@ def decode_bytes(byte_stream):
         shift += 7
     return number
 
+def map_file(path):
+    """Opens path and memory-maps it read-only. Returns the file object and the mapping."""
+    file = open(path, 'rb')
+    if os.fstat(file.fileno()).st_size == 0:
+        # mmap cannot map an empty file
+        return file, b''
+    return file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def file_generation(status):
+    # Inode, modification time and size: a rename or an in-place rewrite changes at least one
+    return (status.st_ino, status.st_mtime_ns, status.st_size)
+
+def attach_titles(results, index=None):
+    """Adds the title, url and snippet of each result's document as "name", "url" and "snippet",
+    dropping documents without a title. They are read from index's document store, documents
+    it does not have are parsed from Data/json."""
+    finalresult = []
+    with stage("metadata"):
+        for item in results:
+            doc_id = item["doc_id"]
+            document = index.document(int(doc_id.split('.')[0])) if index is not None else None
+            if document is None:
+                json_document = JsonFileDocument(os.path.join('Data/json', doc_id))
+                document = {"title": json_document.get_title(), "url": json_document.get_url(), "snippet": make_snippet(json_document.get_body())}
+            if document["title"]:
+                item["name"] = document["title"]
+                item["url"] = document["url"]
+                item["snippet"] = document["snippet"]
+                finalresult.append(item)
+
+    return finalresult
+
+def query_terms(index, query):
+    """Returns the vocabulary terms a batch query reads, see run_batch."""
+    if "type" in query:
+        return index.expand_terms(query["terms"])
+    terms = []
+    for text in query["terms"]:
+        if len(text.split()) > 1:
+            words = [word.replace("\"","") for word in text.split()]
+            terms.extend(stem_cache(term) for term in parse_proximity([word for word in words if word])[0])
+        elif '*' in text:
+            terms.extend(index.expand_wildcard(text))
+        else:
+            terms.append(stem_cache(text))
+    return terms
+
+
+def run_batch(index, queries):
+    """
+    Evaluate many queries against one set of decoded postings: the distinct terms of all of them
+    are fetched and decoded once, so the cost grows with the number of distinct terms rather
+    than the number of queries.
+    Args:
+        index: A DiskPositionalIndex or SegmentedIndex.
+        queries (list): Dicts with "terms" and "operations" for a Boolean query as for query(),
+            or "terms", "type" and optionally "k" for a ranked one as for queryRank().
+    Yields:
+        tuple: (position of the query in queries, its results) as each query finishes.
+    """
+    terms = set()
+    for query in queries:
+        terms.update(query_terms(index, query))
+    view = index.pinned_view(terms)
+    for i, query in enumerate(queries):
+        if "type" in query:
+            yield i, view.queryRank(query["terms"], query["type"], query.get("k", 100))
+        else:
+            yield i, view.query(query["terms"], query.get("operations", []))
+
+
+# Boolean queries use bitmaps for terms in at least this many documents
+BITMAP_MIN_DF = 4096
+
+
+def okapi_bound(max_tf, min_dl, average_length):
+    """Largest Okapi wdt a term can have given its max_tf and min_dl, for any average length."""
+    K = 1.2 * ((0.25) + (0.75 * (min_dl / average_length)))
+    return (2.2 * max_tf) / (K + max_tf)
+
+def top_k_results(results, k=100, index=None):
+    """Returns the first k MaxScoreRanker results with "<doc id>.json" doc ids, see attach_titles."""
+    for item in results[:k]:
+        item["doc_id"] = str(item["doc_id"]) + '.json'
+    return attach_titles(results[:k], index)
 
 class DiskPositionalIndex():
-    def __init__(self, db_path: str, postings_file: str):
-        self.conn = sqlite3.connect(db_path)
+    """Read-only view of an index written by DiskIndexWriter. An instance is meant to be
+    opened once and shared: postings.bin is memory-mapped, the vocabulary and document
+    length tables are loaded up front, and lexicon lookups are safe to run from many threads.
+    Every postings format DiskIndexWriter has produced is readable, see read_format_version.
+
+    Decoded postings of recently used terms are kept in a PostingsCache of cache_bytes, or in
+    cache if one is given so several indexes can share a budget. cache_bytes=0 disables it.
+    Boolean queries read terms with a document frequency of at least bitmap_min_df as
+    DocBitmaps, built on first use and kept, see precompute_bitmaps."""
+    def __init__(self, db_path: str, postings_file: str, positions_file: str = None, cache_bytes: int = 64 * 1024 * 1024, cache: PostingsCache = None,
+                 bitmap_min_df: int = BITMAP_MIN_DF):
+        # Mapped before any other file is opened: a rebuild renames postings.bin last, so if
+        # this maps the new one every other file is new too, see DiskIndexWriter
+        self.file, self.postings = map_file(postings_file)
+        # Identity of the mapped postings.bin, lets callers tell stale cached results apart. A
+        # rebuild renames a new file over it, see stale()
+        self.generation = file_generation(os.fstat(self.file.fileno()))
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.db_path = db_path
+        self.lexicon_lock = threading.Lock()
         self.postings_file = postings_file
-        self.rankQuery = {}
         self.total_len =self.conn.execute("SELECT * FROM All_length").fetchone()
         self.doctotal_len = {int(id_str): (value, ld) for id_str, value, ld in self.conn.execute("SELECT * FROM total_length").fetchall()}
+        self.document_count = len(self.doctotal_len)
+        self.doc_lengths, self.doc_ld = document_arrays(self.doctotal_len)
+
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(vocab_term_mapping)")]
+        self.split_positions = 'positions_position' in columns
+        self.format_version = read_format_version(self.postings, self.split_positions)
+        self.positions_file = None
+        self.positions = b''
+        if self.split_positions:
+            self.positions_file, self.positions = map_file(positions_file or positions_path(postings_file))
+
+        # Prefer the memory-mapped vocabulary when the index has one, SQLite otherwise
+        self.cache = cache
+        if cache is None and cache_bytes > 0:
+            self.cache = PostingsCache(cache_bytes)
+
+        self.lexicon = None
+        if os.path.exists(lexicon_path(postings_file)):
+            self.lexicon = DiskLexicon(lexicon_path(postings_file))
+        self.documents = None
+        if os.path.exists(document_store_paths(postings_file)[0]):
+            self.documents = DocumentStore(postings_file)
+        self.bitmap_min_df = bitmap_min_df
+        self.kgrams = None
+        # Decoded runs of a batch, set on the views made by pinned_view only
+        self.pinned = None
+        self.bitmaps = {}
+        self.all_documents = None
+
+    def stale(self):
+        """True if postings.bin was rewritten since this index mapped it, e.g. by a rebuild in
+        another process. The mapping keeps serving the old file until the index is reopened."""
+        try:
+            return file_generation(os.stat(self.postings_file)) != self.generation
+        except OSError:
+            return False
+
+    def document(self, doc_id):
+        """Returns {"title", "url", "snippet"} of doc_id from the document store, or None."""
+        if self.documents is None:
+            return None
+        return self.documents.get(doc_id)
+
+    def lookup_term(self, term):
+        """Returns the byte positions of the term in postings.bin and positions.bin, or None.
+        The second one is None for indexes without a separate positions file."""
+        with stage("lexicon"):
+            if self.lexicon is not None:
+                entry = self.lexicon.lookup(term)
+                if entry is None:
+                    return None
+                return entry[0], entry[1]
+            with self.lexicon_lock:
+                if self.split_positions:
+                    result = self.conn.execute("SELECT byte_position, positions_position FROM vocab_term_mapping WHERE term=?", (term,)).fetchone()
+                else:
+                    result = self.conn.execute("SELECT byte_position, NULL FROM vocab_term_mapping WHERE term=?", (term,)).fetchone()
+        if not result:
+            return None
+        return result
+
+    def document_frequency(self, term):
+        """Returns the number of documents containing term without decoding its postings."""
+        if self.lexicon is not None:
+            with stage("lexicon"):
+                entry = self.lexicon.lookup(term)
+            return entry[2] if entry is not None else 0
+        result = self.lookup_term(term)
+        if result is None:
+            return 0
+        # Every postings run starts with the document frequency
+        return read_number(self.postings, result[0])[0]
+
+    def expand_prefix(self, prefix):
+        """Returns every vocabulary term starting with prefix, in sorted order."""
+        with stage("lexicon"):
+            if self.lexicon is not None:
+                return [term for term, _ in self.lexicon.prefix(prefix)]
+            with self.lexicon_lock:
+                rows = self.conn.execute("SELECT term FROM vocab_term_mapping WHERE substr(term, 1, ?) = ? ORDER BY term", (len(prefix), prefix)).fetchall()
+        return [row[0] for row in rows]
+
+    def kgram_index(self):
+        """Returns the TermKGramIndex of the vocabulary. Indexes without a readable vocab.kgrams
+        get an in-memory one on first use."""
+        if self.kgrams is None:
+            try:
+                self.kgrams = TermKGramIndex.load(self.db_path)
+            except (OSError, ValueError):
+                # Missing, or written in an older format
+                self.kgrams = TermKGramIndex.build(self.expand_prefix(""))
+        return self.kgrams
+
+    def expand_wildcard(self, pattern):
+        """Returns the vocabulary terms matching a wildcard pattern such as "nation*", sorted."""
+        with stage("lexicon"):
+            return self.kgram_index().expand(pattern)
+
+    def similar_terms(self, word, min_jaccard=0.2, limit=50):
+        """Returns the vocabulary terms sharing most k-grams with word, see TermKGramIndex.similar."""
+        with stage("lexicon"):
+            return [term for term, _ in self.kgram_index().similar(word, min_jaccard, limit)]
+
+    def display_form(self, term):
+        """Returns the word term was most often stemmed from, to show it to users, see
+        TermKGramIndex.form."""
+        with stage("lexicon"):
+            return self.kgram_index().form(term)
+
+    def expand_terms(self, terms):
+        """Replaces every wildcard pattern in terms by the terms it matches.
+        Repeated terms are kept, so a term given twice weighs twice in the ranking."""
+        expanded = []
+        for term in terms:
+            expanded.extend(self.expand_wildcard(term) if '*' in term else [term])
+        return expanded
+
+    def get_frequencies(self, term):
+        """Returns the decoded doc ids and term frequencies of a term, or None if it is not in the
+        vocabulary. For split indexes positions are not read at all. The arrays are read-only."""
+        if self.pinned is not None and term in self.pinned:
+            return self.pinned[term]
+        key = (self.postings_file, term, False)
+        if self.cache is not None:
+            run = self.cache.get(key)
+            if run is not None:
+                return run
+        result = self.lookup_term(term)
+        if result is None:
+            return None
+        byte_position, positions_position = result
+        with stage("decode"):
+            if positions_position is None:
+                run = decode_postings(self.postings, byte_position)
+            else:
+                run = decode_frequencies(self.postings, byte_position, positions_position, self.format_version >= FORMAT_GAPS,
+                                         self.format_version >= FORMAT_SKIPS)
+        if self.cache is not None:
+            self.cache.put(key, run)
+        return run
+
+    def intersect_doc_ids(self, term, doc_ids):
+        """
+        AND a term with a sorted array of doc ids, typically the much shorter list of a rarer
+        term. With skip pointers only the blocks of term that may hold one of doc_ids are
+        decoded when they are few, otherwise the whole run is decoded and cached.
+        Returns:
+            array: The doc ids in both, sorted.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        run = self.pinned.get(term) if self.pinned is not None else None
+        if run is None and self.cache is not None:
+            run = self.cache.get((self.postings_file, term, False))
+        if run is None and self.format_version >= FORMAT_SKIPS and len(doc_ids):
+            result = self.lookup_term(term)
+            if result is None:
+                return doc_ids[:0]
+            with stage("decode"):
+                skips = read_skips(self.postings, result[0], result[1])
+                blocks = skips.blocks_for(doc_ids)
+                if 2 * len(blocks) < len(skips):
+                    run = decode_blocks(self.postings, skips, blocks)
+            if run is not None:
+                return run.doc_ids[intersect_sorted(doc_ids, run.doc_ids)]
+        if run is None:
+            run = self.get_frequencies(term)
+            if run is None:
+                return doc_ids[:0]
+        term_ids = run.doc_ids
+        if self.format_version < FORMAT_GAPS:
+            # Files written before postings were sorted by doc id
+            term_ids = np.sort(term_ids)
+        return term_ids[intersect_sorted(doc_ids, term_ids)]
+
+    def get_positions(self, term, run, selected=None):
+        """Returns (positions_run, full): a PostingsRun with positions for the selected documents
+        of run, a FrequencyRun of term, in the order of selected, or if full is True for all of
+        its documents in run order. Positions of the whole run are cached when most of it is read."""
+        key = (self.postings_file, term, True)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            return cached, True
+        if selected is not None and (self.cache is None or 2 * len(selected) < len(run)):
+            with stage("decode"):
+                return decode_positions(self.positions, run, selected), False
+        with stage("decode"):
+            full = decode_positions(self.positions, run)
+        if self.cache is not None:
+            self.cache.put(key, full)
+        return full, True
+
+    def candidate_positions(self, term, candidates):
+        """Returns (tfs, positions) of term in each of candidates, a sorted array of doc ids
+        that all contain term, positions holding every document's sorted positions in turn."""
+        run = self.get_frequencies(term)
+        if self.format_version >= FORMAT_GAPS:
+            selected = intersect_sorted(candidates, run.doc_ids)
+        else:
+            selected = np.flatnonzero(np.isin(run.doc_ids, candidates))
+            # Files written before postings were sorted by doc id need the selection reordered
+            selected = selected[np.argsort(run.doc_ids[selected], kind='stable')]
+        if getattr(run, 'positions', None) is None:
+            positions_run, full = self.get_positions(term, run, selected)
+            if not full:
+                return positions_run.tfs, positions_run.positions
+            run = positions_run
+        tfs = run.tfs[selected]
+        starts = run.position_starts[selected]
+        # Index of every wanted position in the full run
+        offsets = np.arange(int(tfs.sum()), dtype=np.int64) - np.repeat(np.cumsum(tfs) - tfs, tfs)
+        return tfs, run.positions[np.repeat(starts, tfs) + offsets]
+
+    def proximity_postings(self, words, doc_ids=None):
+        """
+        Evaluate a phrase or proximity query such as "national park" or "park NEAR/3 trail".
+        Args:
+            words (list): The query words, unstemmed, see parse_proximity.
+            doc_ids (array, optional): Only match these documents, sorted.
+        Returns:
+            list: (doc_id, [positions of the first term where a match starts]) by doc id.
+        """
+        words = [word.replace("\"","") for word in words]
+        terms, gaps = parse_proximity([word for word in words if word])
+        stems = [stem_cache(term) for term in terms]
+        # Positions are only needed for documents that contain every term
+        runs = [self.get_frequencies(stem) for stem in stems]
+        if not runs or any(run is None for run in runs):
+            return []
+        # Rarest term first, the others are galloped through for its documents only
+        order = sorted(set(stems), key=lambda stem: len(runs[stems.index(stem)]))
+        if doc_ids is None:
+            candidates = self.term_doc_ids(order[0])
+            if isinstance(candidates, DocBitmap):
+                candidates = candidates.to_array()
+            order = order[1:]
+        else:
+            candidates = np.asarray(doc_ids, dtype=np.int64)
+        for stem in order:
+            if not len(candidates):
+                return []
+            candidates = self.intersect_doc_ids(stem, candidates)
+        if not len(candidates):
+            return []
+        return join_documents(candidates, [self.candidate_positions(stem, candidates) for stem in stems], gaps)
 
-        
-        
     def calculate_wqtOkapi(self, df_t,N):
    
         return max(0.1, np.log((N - df_t + 0.5) / (df_t + 0.5)))
@@ -61,255 +421,223 @@ class DiskPositionalIndex():
     def calculate_wdt(tf):
         return 1 + np.log(tf)
     
-    def get_postings(self, term):
-        cur = self.conn.cursor()
-        cur.execute("SELECT * FROM vocab_term_mapping WHERE term=?", (term,))
-        result = cur.fetchone()
-        if not result:
+    def get_postings(self, term, with_positions=True, doc_ids=None):
+        """
+        Retrieve the postings list of a term as [(doc_id, [positions])].
+        Args:
+            term (str): The stemmed term.
+            with_positions (bool): If False the position lists are left empty and, for split
+                indexes, positions.bin is not read.
+            doc_ids (array, optional): Only return postings of these documents.
+        """
+        run = self.get_frequencies(term)
+        if run is None:
             return []
 
-        byte_position = result[1]
-        postings = []
-
-        with open(self.postings_file, 'rb') as file:
-            file.seek(byte_position)
-
-            # Decode the document frequency
-            dft = decode_bytes(iter(lambda: ord(file.read(1)), 0))
-            last_doc_id = 0
-            for _ in range(dft):
-                # Decode the document ID gap
-                doc_id_gap = decode_bytes(iter(lambda: ord(file.read(1)), 0))
-                doc_id =  doc_id_gap
-                last_doc_id = doc_id
-
-                # Decode the term frequency
-                tftd = decode_bytes(iter(lambda: ord(file.read(1)), 0))
-                wdt= 1 + np.log(tftd)
-                
-                positions = []
-                last_position = 0
-                for _ in range(tftd):
-                    # Decode the position gap
-                    pos_gap = decode_bytes(iter(lambda: ord(file.read(1)), 0))
-                    position = last_position + pos_gap
-                    positions.append(position)
-                    last_position = position
-
-                postings.append((doc_id, positions))
-
-        return postings
+        selected = None
+        if doc_ids is not None:
+            selected = np.flatnonzero(np.isin(run.doc_ids, doc_ids))
+        if not with_positions:
+            ids = run.doc_ids if selected is None else run.doc_ids[selected]
+            return [(doc_id, []) for doc_id in ids.tolist()]
+        if getattr(run, 'positions', None) is None:
+            # Split index, fetch positions of the wanted documents only, or the cached ones
+            positions_run, full = self.get_positions(term, run, selected)
+            # A partial decode holds just the selected documents, a full one is sliced below
+            if not full or selected is None:
+                return positions_run.to_postings()
+            run = positions_run
+        if selected is None:
+            return run.to_postings()
+        positions = run.positions
+        starts = run.position_starts
+        return [(doc_id, positions[starts[i]:starts[i + 1]].tolist()) for i, doc_id in zip(selected.tolist(), run.doc_ids[selected].tolist())]
     
-    def phrase_intersect(self, postings1, postings2, distance=1):
+    def query(self, terms, operations):
+        """Evaluates a Boolean query, operations ("AND", "OR" or "AND NOT") applying left to
+        right between consecutive terms, through a QueryPlanner. Returns [(doc_id, [])] by doc id."""
+        if not terms:
+            return []
+        # Lexicon lookups and decoding inside are charged to their own stages
+        with stage("merge"):
+            doc_ids = QueryPlanner(self).run(Plan.from_operations(terms, operations))
+            if isinstance(doc_ids, DocBitmap):
+                doc_ids = doc_ids.to_array()
+        return [(doc_id, []) for doc_id in doc_ids.tolist()]
 
-        results = []
-        index=[]
-        postings2_dict = {}
-        for doc_id, positions in postings2:
-            postings2_dict[doc_id] = positions
-        
-        for doc_id, positions in postings1:
-            if doc_id in postings2_dict:
-                # For each position in postings1, check if position+1 exists in postings2
-                
-                for pos in positions:
-                    if pos + 1 in postings2_dict[doc_id]:
-                        results.append((doc_id, [pos+1]))
-        print(results)
-        return results
-        
-    def merge_postings(self, postings1, postings2, operation):
+    def explain(self, terms, operations):
+        """Runs a query like query() and returns its plan with estimated and actual cardinalities."""
+        if not terms:
+            return None
+        plan = Plan.from_operations(terms, operations)
+        QueryPlanner(self).run(plan)
+        return plan.explain()
 
-        if operation == "AND":
-            ids1 = {item[0] for item in postings1}
-            common_tuples = [item for item in postings2 if item[0] in ids1]
-            return common_tuples
+    def phrase_terms(self, plan):
+        words = [word.replace("\"","") for word in plan.text.split()]
+        return [stem_cache(term) for term in parse_proximity([word for word in words if word])[0]]
 
-        elif operation == "OR":
-            dict2 = {item[0]: item[1] for item in postings2}
-    
-            combined_tuples = []
-            
-            for item in postings1:
-                id1, positions1 = item
-                if id1 in dict2:
-                    # If id1 exists in arr2, use the positions from arr2
-                    combined_tuples.append((id1, dict2[id1]))
-                else:
-                    # Otherwise, combine the positions
-                    combined_tuples.append((id1, positions1 + dict2.get(id1, [])))
-            
-            # Now add the tuples from arr2 that are not in arr1
-            ids1 = {item[0] for item in postings1}
-            for id2, positions2 in dict2.items():
-                if id2 not in ids1:
-                    combined_tuples.append((id2, positions2))
-            
-            return combined_tuples
-
-        elif operation == "AND NOT":
-            ids1 = {item[0] for item in postings2}
-            filtered_tuples = []
-            for item in postings1:
-                id2, positions12 = item
-                if id2 not in ids1:
-                    # If id2 does not exist in arr1, append the item to the result
-                    filtered_tuples.append((id2, positions12))
-            
-            return filtered_tuples
+    def estimate(self, plan):
+        # QueryPlanner source: a phrase matches at most as many documents as its rarest term
+        if plan.kind == "term":
+            return self.document_frequency(stem_cache(plan.text))
+        if plan.kind == "wildcard":
+            return sum(self.document_frequency(term) for term in self.expand_wildcard(plan.text))
+        return min((self.document_frequency(term) for term in self.phrase_terms(plan)), default=0)
 
-    def query(self, terms, operations):
-        if not terms:
-            return []
+    def term_bitmap(self, term):
+        """Returns the DocBitmap of term if its document frequency is at least bitmap_min_df,
+        else None. Bitmaps are built from the postings on first use and kept."""
+        bitmap = self.bitmaps.get(term)
+        if bitmap is None and self.document_frequency(term) >= self.bitmap_min_df:
+            run = self.get_frequencies(term)
+            doc_ids = run.doc_ids if self.format_version >= FORMAT_GAPS else np.sort(run.doc_ids)
+            with stage("decode"):
+                bitmap = self.bitmaps[term] = DocBitmap.from_sorted(doc_ids)
+        return bitmap
+
+    def precompute_bitmaps(self, min_df=None):
+        """Builds the bitmaps of every term in at least min_df documents, bitmap_min_df by
+        default, so no query pays for them. Needs vocab.lex. Returns the number built."""
+        if self.lexicon is None:
+            return 0
+        if min_df is not None:
+            self.bitmap_min_df = min_df
+        built = 0
+        for term, entry in self.lexicon.prefix(""):
+            if entry[2] >= self.bitmap_min_df and term not in self.bitmaps:
+                self.term_bitmap(term)
+                built += 1
+        return built
 
-        stopwords = Porter2Stemmer()
+    def fetch(self, plan):
+        if plan.kind == "phrase":
+            return np.array([doc_id for doc_id, _ in self.proximity_postings(plan.text.split())], dtype=np.int64)
+        if plan.kind == "wildcard":
+            return union_sorted([self.term_doc_ids(term) for term in self.expand_wildcard(plan.text)] or [np.zeros(0, dtype=np.int64)])
+        return self.term_doc_ids(stem_cache(plan.text))
 
-        def get_phrase_postings(phrase):
-            words = phrase.split()
-            if len(words) == 1:
-                print("11111")
-                return self.get_postings(stopwords.stem(words[0]))
+    def term_doc_ids(self, term):
+        """Returns the documents containing term as a DocBitmap or a sorted array."""
+        bitmap = self.term_bitmap(term)
+        if bitmap is not None:
+            return bitmap
+        run = self.get_frequencies(term)
+        if run is None:
+            return np.zeros(0, dtype=np.int64)
+        # Files written before postings were sorted by doc id
+        return run.doc_ids if self.format_version >= FORMAT_GAPS else np.sort(run.doc_ids)
+
+    def probe(self, plan, doc_ids):
+        if plan.kind == "phrase":
+            if isinstance(doc_ids, DocBitmap):
+                return common_sorted(self.fetch(plan), doc_ids)
+            # Positions are only decoded for the candidates that hold every word
+            return np.array([doc_id for doc_id, _ in self.proximity_postings(plan.text.split(), doc_ids)], dtype=np.int64)
+        if plan.kind == "wildcard":
+            return union_sorted([self.probe_term(term, doc_ids) for term in self.expand_wildcard(plan.text)] or [np.zeros(0, dtype=np.int64)])
+        return self.probe_term(stem_cache(plan.text), doc_ids)
+
+    def probe_term(self, term, doc_ids):
+        bitmap = self.term_bitmap(term)
+        if bitmap is not None or isinstance(doc_ids, DocBitmap):
+            return common_sorted(bitmap if bitmap is not None else self.term_doc_ids(term), doc_ids)
+        return self.intersect_doc_ids(term, doc_ids)
+
+    def all_doc_ids(self):
+        # The complement of a NOT is a bitmap difference with this
+        if self.all_documents is None:
+            self.all_documents = DocBitmap.from_sorted(np.flatnonzero(self.doc_lengths))
+        return self.all_documents
+
+    def term_cursor(self, term, stats=None, deleted_ids=None, df=None):
+        """Returns a TermCursor for term, or None if no live document contains it. stats provides
+        document_count, total_len, doctotal_len and document_frequency() and defaults to this
+        index, a SegmentedIndex passes itself so every segment scores with collection-wide
+        statistics. Documents in deleted_ids, a numpy array, are skipped. df is the document
+        frequency of term in stats if the caller already knows it."""
+        stats = stats or self
+        run = self.get_frequencies(term)
+        if run is None:
+            return None
+        doc_ids, tfs = run.doc_ids, run.tfs
+        if len(doc_ids) > 1 and (np.diff(doc_ids) < 0).any():
+            # Files written before postings were sorted by doc id
+            order = np.argsort(doc_ids, kind='stable')
+            doc_ids, tfs = doc_ids[order], tfs[order]
+        if deleted_ids is not None and len(deleted_ids):
+            live = ~np.isin(doc_ids, deleted_ids)
+            doc_ids, tfs = doc_ids[live], tfs[live]
+            if not len(doc_ids):
+                return None
+
+        if df is not None:
+            dft = df
+        else:
+            dft = len(run) if stats is self else stats.document_frequency(term)
+        N = stats.document_count
+        wqt = self._calculate_wqt(dft, N)
+        wqt_okapi = self.calculate_wqtOkapi(dft, N)
+        cursor = TermCursor(doc_ids, tfs, wqt, wqt_okapi)
+        entry = self.lexicon.lookup(term) if self.lexicon is not None and self.lexicon.has_bounds else None
+        if entry is not None:
+            _, _, _, max_tf, min_dl, max_cosine, max_okapi = entry
+            cursor.cosine_bound = max_cosine * wqt
+            if stats is self:
+                cursor.okapi_bound = max_okapi * wqt_okapi
             else:
-                # Start with postings of the first word
-                
-                current_postings = self.get_postings(stopwords.stem(words[0].replace("\"","")))
-                # Iterate over the rest of the words in the phrase
-                print("22222",stopwords.stem(words[0].replace("\"","")))
-                
-                for i in range(1, len(words)):
-                    next_postings = self.get_postings(stopwords.stem(words[i].replace("\"","")))
-                    current_postings = self.phrase_intersect(current_postings, next_postings, i)
-                    print("22222",stopwords.stem(words[i].replace("\"","")))
-                    
-                return current_postings
-
-        postings = get_phrase_postings(terms[0])
-
-        # Process the rest of the terms and operations
-        for i in range(1, len(terms)):
-            next_postings = get_phrase_postings(terms[i])
-            postings = self.merge_postings(postings, next_postings, operations[i-1])
-
-        return postings
-  
-  
-    def get_postings_rank(self, term):
-        cur = self.conn.cursor()
-        cur.execute("SELECT * FROM vocab_term_mapping WHERE term=?", (term,))
-        
-        result = cur.fetchone()
-        if not result:
+                # The stored bound is for this segment's average length only
+                cursor.okapi_bound = okapi_bound(max_tf, min_dl, stats.total_len[1] / N) * wqt_okapi
+        return cursor
+
+    def top_k(self, terms, type, k=100, stats=None, deleted_ids=None, dfs=None):
+        """Scores terms with MaxScoreRanker. Returns up to k result dicts with integer doc ids.
+        dfs optionally maps terms to their document frequency in stats, see term_cursor."""
+        stats = stats or self
+        if not stats.document_count:
             return []
-        print(self.total_len[1])
-        byte_position = result[1]
-        postings = []
-
-        with open(self.postings_file, 'rb') as file:
-            file.seek(byte_position)
-
-            # Decode the document frequency
-            dft = decode_bytes(iter(lambda: ord(file.read(1)), 0))
-            print(term,"DFT",dft)
-            
-            calculate_wqt =self._calculate_wqt(dft,36803)
-            calculate_wqtOkapi =self.calculate_wqtOkapi(dft,36803)
-            print(term,"Wqt",calculate_wqt)
-            last_doc_id = 0
-            for _ in range(dft):
-                # Decode the document ID gap
-                doc_id_gap = decode_bytes(iter(lambda: ord(file.read(1)), 0))
-             
-                doc_id =  doc_id_gap
-                last_doc_id = doc_id
-
-                # Decode the term frequency
-                tftd = decode_bytes(iter(lambda: ord(file.read(1)), 0))
-                wdt= 1 + np.log(tftd)
-                calculate_wdtOkapi=self.calculate_wdtOkapi(tftd,self.doctotal_len[doc_id][0],(self.total_len[1]/36803))
-                
-                if(doc_id)==21744:
-                               print("wdt: ",wdt,tftd)
-                
-                positions = []
-                last_position = 0
-                for _ in range(tftd):
-                    # Decode the position gap
-                    pos_gap = decode_bytes(iter(lambda: ord(file.read(1)), 0))
-                    position = last_position + pos_gap
-                    positions.append(position)
-                    last_position = position
-                
-                if doc_id in self.rankQuery:
-                            # Existing entry: Update A_d and ld
-                            self.rankQuery[doc_id]['A_d'] += wdt * calculate_wqt
-                            self.rankQuery[doc_id]['ld'] += wdt * wdt
-                            self.rankQuery[doc_id]['Okapi'] += calculate_wdtOkapi*calculate_wqtOkapi
-                            
-                            if(doc_id)==21744:
-                                print("2",term, wdt * calculate_wqt, wdt * wdt)
-                else:
-                            # New entry: Add to rankQuery
-                            if(doc_id)==21744:
-                                print("1",term, wdt * calculate_wqt, wdt * wdt)
-                                
-                            self.rankQuery[doc_id] = {
-                                'tftd': tftd,
-                                'A_d': wdt * calculate_wqt,
-                                'ld': wdt * wdt,
-                                'score':0,
-                                'Okapi':calculate_wdtOkapi*calculate_wqtOkapi,
-                                "wdt":wdt
-                                
-                            }
-                    
+        dfs = dfs or {}
+        with stage("score"):
+            cursors = [self.term_cursor(term, stats, deleted_ids, dfs.get(term)) for term in terms]
+            ranker = MaxScoreRanker([cursor for cursor in cursors if cursor is not None], stats.doc_lengths,
+                                    stats.doc_ld, stats.total_len[1] / stats.document_count, type, k)
+            return ranker.run()
 
-    
-    def queryRank(self, terms,type):
+    def queryRank(self, terms, type, k=100):
+        """Returns the k best documents for terms by Okapi BM25 score if type is "okapi" and by
+        cosine score otherwise."""
+        terms = self.expand_terms(terms)
         if not terms:
             return []
-        result={}
-        for i in range(0,len(terms)):
-            self.get_postings_rank(terms[i])
-        intermediate_results=[]
-        for doc_id, doc_data in  self.rankQuery.items():
-            A_d = doc_data["A_d"]
-            ld = doc_data["ld"]
-            tftd = doc_data["tftd"]
-            Okapi=doc_data["Okapi"]
-            wdt=doc_data["wdt"]
-            
-            score = A_d / self.doctotal_len[doc_id][1]  # Ensure ld is not zero in real scenario
-            intermediate_results.append({
-                "doc_id": str(doc_id)+'.json',
-                "A_d": A_d,
-                "ld":  self.doctotal_len[doc_id][1],
-                "score": score,
-                'Okapi':Okapi,
-                'wdt':wdt
-            })
-
-        # Sorting the intermediate results by score in descending order
-        if type=="okapi":
-            intermediate_results.sort(key=lambda x: x["Okapi"], reverse=True)
-        else:
-            intermediate_results.sort(key=lambda x: x["score"], reverse=True)
-            
-            
+        return top_k_results(self.top_k(terms, type, k), k, self)
 
-        # Retrieve file names for only the top 10 results
-        finalresult = []
-        for item in intermediate_results[:100]:
-            doc_id = item["doc_id"]
-            file_path = os.path.join('Data/json', doc_id)
-            json_document = JsonFileDocument(file_path)
-            if json_document.get_title():
-                item["name"] =json_document.get_title()
-                finalresult.append(item)
+    def pinned_view(self, terms):
+        """Returns a copy of this index sharing its files and caches that decodes each of terms
+        once, up front, and reuses those runs for every query it evaluates."""
+        view = copy.copy(self)
+        view.pinned = {}
+        for term in sorted(terms):
+            run = self.get_frequencies(term)
+            if run is not None:
+                view.pinned[term] = run
+        return view
 
-        return finalresult
+    def batch(self, queries):
+        """Evaluates many queries sharing term fetches, see run_batch."""
+        return run_batch(self, queries)
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache is not None else {}
 
-        
-    
-    
     def close(self):
+        for mapped in (self.postings, self.positions):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        self.file.close()
+        if self.positions_file is not None:
+            self.positions_file.close()
+        if self.lexicon is not None:
+            self.lexicon.close()
+        if self.documents is not None:
+            self.documents.close()
         self.conn.close()
@@ -0,0 +1,105 @@
+import mmap
+import os
+import struct
+import numpy as np
+from indexing.varint import encode_into, read_number
+
+# documents.dat holds DOCUMENTS_MAGIC, then one record per document: the variable byte length
+# of the title, url and snippet, each followed by its utf-8 bytes. documents.idx holds
+# DOCUMENTS_MAGIC, the version (u8) and the number of slots (u64), then a little-endian
+# (offset, length) u64 pair per doc id giving where its record is in documents.dat,
+# a length of 0 for doc ids that are not stored.
+DOCUMENTS_MAGIC = b'SEDS'
+DOCUMENTS_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sBQ')
+SNIPPET_LENGTH = 300
+
+
+def document_store_paths(postings_file):
+    # The document store lives next to postings.bin
+    directory = os.path.dirname(postings_file)
+    return os.path.join(directory, "documents.idx"), os.path.join(directory, "documents.dat")
+
+
+def make_snippet(body, length=SNIPPET_LENGTH):
+    """Returns the start of body with whitespace collapsed, at most length characters."""
+    return " ".join((body or "")[:length * 2].split())[:length]
+
+
+def write_document_store(postings_file, documents, paths=None):
+    """
+    Write documents.idx and documents.dat next to postings_file.
+    Args:
+        postings_file (str): Path of the index's postings.bin.
+        documents (iterable): (doc_id, (title, url, snippet)) pairs in any order.
+        paths (tuple, optional): Where to write documents.idx and documents.dat instead.
+    Returns:
+        int: The number of documents written.
+    """
+    index_file, data_file = paths or document_store_paths(postings_file)
+    slots = {}
+    record = bytearray()
+    with open(data_file, 'wb') as file:
+        file.write(DOCUMENTS_MAGIC)
+        offset = len(DOCUMENTS_MAGIC)
+        for doc_id, fields in documents:
+            record.clear()
+            for field in fields:
+                data = (field or "").encode('utf-8')
+                encode_into(record, len(data))
+                record += data
+            file.write(record)
+            slots[doc_id] = (offset, len(record))
+            offset += len(record)
+
+    table = np.zeros((max(slots) + 1 if slots else 0, 2), dtype='<u8')
+    for doc_id, slot in slots.items():
+        table[doc_id] = slot
+    with open(index_file, 'wb') as file:
+        file.write(INDEX_HEADER.pack(DOCUMENTS_MAGIC, DOCUMENTS_VERSION, len(table)))
+        file.write(table.tobytes())
+    return len(slots)
+
+
+class DocumentStore:
+    """Memory-mapped reader for the document store. get() is one array lookup and one record
+    decode, nothing is read up front and instances can be shared between threads."""
+    def __init__(self, postings_file):
+        index_file, data_file = document_store_paths(postings_file)
+        self.index_file = open(index_file, 'rb')
+        self.index = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = INDEX_HEADER.unpack_from(self.index, 0)
+        if magic != DOCUMENTS_MAGIC or version != DOCUMENTS_VERSION:
+            raise ValueError("%s is not a version %d document store" % (index_file, DOCUMENTS_VERSION))
+        self.slots = np.frombuffer(self.index, dtype='<u8', count=2 * count, offset=INDEX_HEADER.size).reshape(-1, 2)
+        self.data_file = open(data_file, 'rb')
+        self.data = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, doc_id):
+        return 0 <= doc_id < len(self.slots) and self.slots[doc_id, 1] != 0
+
+    def get(self, doc_id):
+        """Returns {"title", "url", "snippet"} for doc_id, or None if it is not stored."""
+        if doc_id not in self:
+            return None
+        offset = int(self.slots[doc_id, 0])
+        fields = []
+        for _ in range(3):
+            length, offset = read_number(self.data, offset)
+            fields.append(self.data[offset:offset + length].decode('utf-8'))
+            offset += length
+        return {"title": fields[0], "url": fields[1], "snippet": fields[2]}
+
+    def items(self):
+        """Yields (doc_id, (title, url, snippet)) for every stored document, by doc id."""
+        for doc_id in np.flatnonzero(self.slots[:, 1]).tolist():
+            document = self.get(doc_id)
+            yield doc_id, (document["title"], document["url"], document["snippet"])
+
+    def close(self):
+        # The array view must go before the mapping can be closed
+        self.slots = None
+        self.index.close()
+        self.index_file.close()
+        self.data.close()
+        self.data_file.close()
@@ -23,7 +23,6 @@ class KGramIndex:
                 # Build a reverse index for leading wildcard queries
                 if i == 0:
                     self.reverse_index[kgram[::-1]].add(filename)
-        print(self.index) 
 
     def search_trailing_wildcard(self, query):
         query = query.lower()  # Convert query to lowercase
@@ -0,0 +1,170 @@
+import heapq
+import numpy as np
+
+# Candidates are scored in blocks of this many documents, best upper bound first, so the
+# threshold rises between blocks and the rest can be skipped as soon as none can enter the top k
+BLOCK_SIZE = 4096
+
+
+def document_arrays(doctotal_len):
+    """Returns the document lengths and Ld of doctotal_len as arrays indexed by doc id."""
+    size = max(doctotal_len) + 1 if doctotal_len else 0
+    lengths = np.zeros(size)
+    ld = np.ones(size)
+    for doc_id, (length, doc_ld) in doctotal_len.items():
+        lengths[doc_id] = length
+        ld[doc_id] = doc_ld
+    return lengths, ld
+
+
+class TermCursor:
+    """The doc ids and term frequencies of one query term with its query weights and the
+    upper bounds of its cosine (wdt * wqt / Ld) and Okapi (wdt * wqt) contributions. A bound
+    left as None is computed from the postings when it is needed."""
+    def __init__(self, doc_ids, tfs, wqt, wqt_okapi, cosine_bound=None, okapi_bound=None):
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.wqt = wqt
+        self.wqt_okapi = wqt_okapi
+        self.cosine_bound = cosine_bound
+        self.okapi_bound = okapi_bound
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def find(self, docs):
+        """Returns the index of each of docs in this cursor and whether it is there at all."""
+        index = np.minimum(np.searchsorted(self.doc_ids, docs), len(self.doc_ids) - 1)
+        return index, self.doc_ids[index] == docs
+
+
+class MaxScoreRanker:
+    """Top-k document retrieval with MaxScore pruning. Terms are ordered by the upper bound
+    of their contribution, and once the k-th best score found so far (the threshold) exceeds
+    the summed bounds of the weakest terms, those terms become non-essential: documents that
+    only contain them cannot make the top k and are never scored, and the remaining candidates
+    are dropped as soon as their partial score plus those bounds falls under the threshold.
+    The best k documents are kept in a min-heap of size k.
+
+    Scores are summed in query term order with the same arithmetic as scoring every document
+    of every term, so results match exhaustive scoring."""
+    def __init__(self, cursors, lengths, ld, average_length, type, k=100):
+        self.cursors = [cursor for cursor in cursors if len(cursor)]
+        self.lengths = lengths
+        self.ld = ld
+        self.average_length = average_length
+        self.okapi = type == "okapi"
+        self.k = k
+        self.heap = []
+
+    def wdt_okapi(self, tfs, docs):
+        K = 1.2 * ((0.25) + (0.75 * (self.lengths[docs] / self.average_length)))
+        return (2.2 * tfs) / (K + tfs)
+
+    def contribution(self, cursor, index, docs):
+        """The ranking score contribution of cursor to docs, index as returned by find."""
+        tfs = cursor.tfs[index]
+        if self.okapi:
+            return self.wdt_okapi(tfs, docs) * cursor.wqt_okapi
+        return (1 + np.log(tfs)) * cursor.wqt / self.ld[docs]
+
+    def bound(self, cursor):
+        bound = cursor.okapi_bound if self.okapi else cursor.cosine_bound
+        if bound is None:
+            bound = float(self.contribution(cursor, np.arange(len(cursor)), cursor.doc_ids).max())
+        return bound
+
+    def score(self, docs):
+        """Exact scores of docs. Returns A_d, the Okapi score and the wdt of the first query term
+        each document contains."""
+        A_d = np.zeros(len(docs))
+        okapi = np.zeros(len(docs))
+        wdt = np.full(len(docs), np.nan)
+        for cursor in self.cursors:
+            index, found = cursor.find(docs)
+            if not found.any():
+                continue
+            index, hits = index[found], docs[found]
+            tfs = cursor.tfs[index]
+            term_wdt = 1 + np.log(tfs)
+            A_d[found] += term_wdt * cursor.wqt
+            okapi[found] += self.wdt_okapi(tfs, hits) * cursor.wqt_okapi
+            first = found & np.isnan(wdt)
+            wdt[first] = term_wdt[first[found]]
+        return A_d, okapi, wdt
+
+    def ranking_scores(self, docs):
+        A_d, okapi, _ = self.score(docs)
+        return okapi if self.okapi else A_d / self.ld[docs]
+
+    def threshold(self):
+        return self.heap[0][0] if len(self.heap) == self.k else -np.inf
+
+    def offer(self, docs, scores):
+        """Pushes scored documents through the heap. Ties go to the lower doc id."""
+        order = np.lexsort((docs, -scores))[:self.k]
+        for score, doc_id in zip(scores[order].tolist(), docs[order].tolist()):
+            item = (score, -doc_id)
+            if len(self.heap) < self.k:
+                heapq.heappush(self.heap, item)
+            elif item > self.heap[0]:
+                heapq.heapreplace(self.heap, item)
+
+    def run(self):
+        """Returns the top k as dicts with doc_id, A_d, ld, score, Okapi and wdt, best first."""
+        if not self.cursors or self.k <= 0:
+            return []
+
+        # A threshold to start from: fully score the documents of the shortest postings list
+        seed = min(self.cursors, key=len)
+        self.offer(seed.doc_ids, self.ranking_scores(seed.doc_ids))
+
+        # Split the terms into non-essential and essential ones
+        threshold = self.threshold()
+        bounds = sorted((self.bound(cursor), i) for i, cursor in enumerate(self.cursors))
+        non_essential = 0.0
+        essential = []
+        for bound, i in bounds:
+            if not essential and non_essential + bound < threshold:
+                non_essential += bound
+            else:
+                essential.append(self.cursors[i])
+
+        if not essential:
+            # Not even a document containing every term can beat the threshold
+            return self.results()
+        candidates = np.unique(np.concatenate([cursor.doc_ids for cursor in essential]))
+        candidates = np.setdiff1d(candidates, seed.doc_ids, assume_unique=True)
+        upper = np.full(len(candidates), non_essential)
+        for cursor in essential:
+            index, found = cursor.find(candidates)
+            upper[found] += self.contribution(cursor, index[found], candidates[found])
+
+        # Small slack so rounding in the bounds never drops a document that ties the threshold
+        order = np.argsort(-upper, kind='stable')
+        for start in range(0, len(order), BLOCK_SIZE):
+            cutoff = self.threshold()
+            cutoff -= 1e-9 * abs(cutoff)
+            block = order[start:start + BLOCK_SIZE]
+            if upper[block[0]] < cutoff:
+                break
+            docs = candidates[block[upper[block] >= cutoff]]
+            self.offer(docs, self.ranking_scores(docs))
+        return self.results()
+
+    def results(self):
+        top = sorted(self.heap, reverse=True)
+        docs = np.array([-doc_id for _, doc_id in top], dtype=np.int64)
+        A_d, okapi, wdt = self.score(docs)
+        results = []
+        for doc_id, doc_A_d, doc_okapi, doc_wdt in zip(docs.tolist(), A_d.tolist(), okapi.tolist(), wdt.tolist()):
+            ld = float(self.ld[doc_id])
+            results.append({
+                "doc_id": doc_id,
+                "A_d": doc_A_d,
+                "ld": ld,
+                "score": doc_A_d / ld,
+                "Okapi": doc_okapi,
+                "wdt": doc_wdt
+            })
+        return results
@@ -1,58 +1,120 @@
-from bisect import bisect_left
-from decimal import InvalidOperation
-from pydoc import doc
-from typing import Iterable
-from .postings import Posting
-from .index import Index
-
-
-class PositionalInvertedIndexSqlite(Index):
-    def __init__(self):
-            self.index = {}  # Initialize the inverted index as an empty dictionary.
-
-    def add_term(self, term, doc_id, positions):
-        """
-        Add a term to the index with its associated document ID and positions.
-        Args:
-            term (str): The term to add to the index.
-            doc_id (int): The ID of the document containing the term.
-            positions (list): A list of positions where the term occurs in the document.
-        """
-        if term not in self.index:
-            self.index[term] = []
-        self.index[term].append((doc_id, positions))  # Append (doc_id, positions) to the list.
-
-    def get_postings(self, term):
-        """
-        Retrieve the postings list for a given term.
-        Args:
-            term (str): The term for which to retrieve the postings list.
-        Returns:
-            list: A list of (doc_id, positions) pairs.
-        """
-        return self.index.get(term, [])  # Return the postings list for the term or an empty list if not found.
-
-    def search(self, query):
-        """
-        Perform a positional search query.
-        Args:
-            query (str): The search query, e.g., "apple AND car".
-        Returns:
-            list: A list of document IDs that match the query.
-        """
-        query_terms = query.split()  # Split the query into individual terms
-
-        # Initialize the result set with the first term's postings
-        result_set = set(doc_id for doc_id, _ in self.get_postings(query_terms[0]))
-
-        # Iterate through the query terms
-        for term in query_terms[1:]:
-            if term.upper() == "AND":
-                continue  # Skip the logical operator
-            term_postings = self.get_postings(term)
-            term_set = set(doc_id for doc_id, _ in term_postings)
-
-            # Apply positional intersection logic
-            result_set = result_set.intersection(term_set)
-
+from bisect import bisect_left
+from decimal import InvalidOperation
+from pydoc import doc
+from typing import Iterable
+from .postings import Posting
+from .index import Index
+
+
+class PositionalInvertedIndexSqlite(Index):
+    def __init__(self):
+            self.index = {}  # Initialize the inverted index as an empty dictionary.
+            self.documents = {}  # doc_id -> (title, url, snippet) for the document store.
+            self.forms = {}  # term -> {unstemmed form: occurrences} for spelling suggestions.
+
+    def add_document(self, doc_id, title, url, snippet):
+        """
+        Record the metadata DiskIndexWriter puts in the document store.
+        Args:
+            doc_id (int): The ID of the document.
+            title (str): The title shown in results.
+            url (str): The document's URL, empty if it has none.
+            snippet (str): The start of the document body.
+        """
+        self.documents[doc_id] = (title, url, snippet)
+
+    def add_forms(self, forms):
+        """
+        Count the unstemmed forms terms occur as.
+        Args:
+            forms (dict): term -> {form: occurrences}, as counted by TokenProcessor.tokenize.
+        """
+        for term, counts in forms.items():
+            total = self.forms.setdefault(term, {})
+            for form, count in counts.items():
+                total[form] = total.get(form, 0) + count
+
+    def term_forms(self):
+        """
+        Returns:
+            dict: term -> {unstemmed form: occurrences} over every document added.
+        """
+        return self.forms
+
+    def add_term(self, term, doc_id, positions):
+        """
+        Add a term to the index with its associated document ID and positions.
+        Args:
+            term (str): The term to add to the index.
+            doc_id (int): The ID of the document containing the term.
+            positions (list): A list of positions where the term occurs in the document.
+        """
+        if term not in self.index:
+            self.index[term] = []
+        self.index[term].append((doc_id, positions))  # Append (doc_id, positions) to the list.
+
+    def merge(self, other):
+        """
+        Add every posting of another index to this one, e.g. a partial index built by a worker process.
+        Args:
+            other (PositionalInvertedIndexSqlite): The index to merge in.
+        """
+        for term, postings in other.index.items():
+            if term not in self.index:
+                self.index[term] = []
+            self.index[term].extend(postings)
+        self.documents.update(other.documents)
+        self.add_forms(other.term_forms())
+
+    def sorted_items(self):
+        """
+        Iterate the index in the order DiskIndexWriter writes it.
+        Returns:
+            iterator: (term, postings sorted by doc_id) pairs in increasing term order.
+        """
+        for term in sorted(self.index):
+            yield term, sorted(self.index[term], key=lambda posting: posting[0])
+
+    def document_items(self):
+        """
+        Iterate the recorded document metadata.
+        Returns:
+            iterator: (doc_id, (title, url, snippet)) pairs in increasing doc_id order.
+        """
+        for doc_id in sorted(self.documents):
+            yield doc_id, self.documents[doc_id]
+
+    def get_postings(self, term):
+        """
+        Retrieve the postings list for a given term.
+        Args:
+            term (str): The term for which to retrieve the postings list.
+        Returns:
+            list: A list of (doc_id, positions) pairs.
+        """
+        return self.index.get(term, [])  # Return the postings list for the term or an empty list if not found.
+
+    def search(self, query):
+        """
+        Perform a positional search query.
+        Args:
+            query (str): The search query, e.g., "apple AND car".
+        Returns:
+            list: A list of document IDs that match the query.
+        """
+        query_terms = query.split()  # Split the query into individual terms
+
+        # Initialize the result set with the first term's postings
+        result_set = set(doc_id for doc_id, _ in self.get_postings(query_terms[0]))
+
+        # Iterate through the query terms
+        for term in query_terms[1:]:
+            if term.upper() == "AND":
+                continue  # Skip the logical operator
+            term_postings = self.get_postings(term)
+            term_set = set(doc_id for doc_id, _ in term_postings)
+
+            # Apply positional intersection logic
+            result_set = result_set.intersection(term_set)
+
         return list(result_set)
\ No newline at end of file
@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def run_nbytes(run):
+    """Memory taken by the numpy arrays of a decoded run."""
+    return sum(value.nbytes for value in vars(run).values() if isinstance(value, np.ndarray))
+
+
+def freeze(run):
+    # Cached arrays are shared between queries, nobody may modify them in place
+    for value in vars(run).values():
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+    return run
+
+
+class PostingsCache:
+    """LRU cache of decoded postings runs bounded by max_bytes of array memory. Keys are
+    chosen by the caller, DiskPositionalIndex uses (term, with_positions). Runs larger than
+    the whole budget are not cached. Safe to share between threads."""
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes_used = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, run):
+        """Caches run under key and returns it, read-only."""
+        size = run_nbytes(run)
+        freeze(run)
+        if size > self.max_bytes:
+            return run
+        with self.lock:
+            if key in self.entries:
+                self.bytes_used -= self.entries.pop(key)[1]
+            self.entries[key] = (run, size)
+            self.bytes_used += size
+            while self.bytes_used > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes_used -= evicted_size
+                self.evictions += 1
+        return run
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes_used = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes_used,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
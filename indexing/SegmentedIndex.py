@@ -0,0 +1,443 @@
+import copy
+import heapq
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import numpy as np
+from indexing.DiskIndexWriter import DiskIndexWriter
+from indexing.DiskPositionalIndex import DiskPositionalIndex, top_k_results, run_batch
+from indexing.MaxScore import document_arrays
+from indexing.PostingsCache import PostingsCache
+from querying.QueryMetrics import stage
+
+# An index directory holds one sub-directory per segment, each a complete index written by
+# DiskIndexWriter, and segments.json listing the live segments with their deleted doc ids.
+# Segments are never modified once written: deleting or replacing a document only adds a
+# tombstone, and merges write a new segment and swap it into the manifest.
+MANIFEST = "segments.json"
+
+
+def segment_paths(directory, name):
+    """Returns the vocabulary database and postings file of a segment."""
+    path = os.path.join(directory, name)
+    return os.path.join(path, "vocab_term_mapping.db"), os.path.join(path, "postings.bin")
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {"generation": 0, "next_segment": 0, "segments": []}
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def manifest_status(directory):
+    """Returns what identifies the current manifest file: writers replace it on every commit,
+    so a changed inode, modification time or size means it must be read again. None if there
+    is none yet."""
+    try:
+        status = os.stat(os.path.join(directory, MANIFEST))
+    except FileNotFoundError:
+        return None
+    return status.st_ino, status.st_mtime_ns, status.st_size
+
+
+def write_manifest(directory, manifest):
+    # Write then rename so readers never see a half written manifest
+    path = os.path.join(directory, MANIFEST)
+    with open(path + ".tmp", 'w', encoding='utf-8') as file:
+        json.dump(manifest, file)
+    os.replace(path + ".tmp", path)
+
+
+class SegmentMerger:
+    """Presents several segments as one index for DiskIndexWriter: sorted_items() walks their
+    vocabularies in a k-way merge and leaves out the postings of deleted documents."""
+    def __init__(self, segments):
+        # segments is a list of (DiskPositionalIndex, deleted doc ids)
+        self.segments = segments
+
+    def terms(self, i):
+        # (term, segment number) for every term of segment i, in order
+        index, _ = self.segments[i]
+        for term, _ in index.lexicon.scan():
+            yield term, i
+
+    def sorted_items(self):
+        streams = [self.terms(i) for i in range(len(self.segments))]
+        term, sources = None, []
+        for next_term, i in heapq.merge(*streams):
+            if next_term != term:
+                if term is not None:
+                    postings = self.collect(term, sources)
+                    if postings:
+                        yield term, postings
+                term, sources = next_term, []
+            sources.append(i)
+        if term is not None:
+            postings = self.collect(term, sources)
+            if postings:
+                yield term, postings
+
+    def collect(self, term, sources):
+        postings = []
+        for i in sources:
+            index, deleted = self.segments[i]
+            postings.extend(posting for posting in index.get_postings(term) if posting[0] not in deleted)
+        return sorted(postings, key=lambda posting: posting[0])
+
+    def term_forms(self):
+        # Each segment only kept the most frequent form of a term, weighed by the term's df there
+        forms = {}
+        for index, _ in self.segments:
+            for term, form in index.kgram_index().display_forms():
+                counts = forms.setdefault(term, {})
+                counts[form] = counts.get(form, 0) + index.document_frequency(term)
+        return forms
+
+    def document_items(self):
+        for index, deleted in self.segments:
+            if index.documents is not None:
+                for doc_id, fields in index.documents.items():
+                    if doc_id not in deleted:
+                        yield doc_id, fields
+
+
+class MergePolicy:
+    """Chooses segments to merge. A segment with more than max_deleted_ratio of its documents
+    deleted is rewritten on its own, and once there are more than max_segments segments the
+    merge_factor smallest ones are merged together."""
+    def __init__(self, max_segments: int = 8, merge_factor: int = 4, max_deleted_ratio: float = 0.3):
+        self.max_segments = max_segments
+        self.merge_factor = merge_factor
+        self.max_deleted_ratio = max_deleted_ratio
+
+    def select(self, segments):
+        """Returns the names of the segments to merge next, or an empty list."""
+        for segment in segments:
+            if segment["documents"] and len(segment["deleted"]) / segment["documents"] > self.max_deleted_ratio:
+                return [segment["name"]]
+        if len(segments) > self.max_segments:
+            smallest = sorted(segments, key=lambda segment: segment["documents"] - len(segment["deleted"]))
+            return [segment["name"] for segment in smallest[:self.merge_factor]]
+        return []
+
+
+class SegmentedIndexWriter:
+    """Adds documents to an index directory as new segments and records deletions as
+    tombstones, merging segments according to merge_policy, optionally in a background thread.
+    A directory must only have one writer at a time."""
+    def __init__(self, directory: str, merge_policy: MergePolicy = None):
+        self.directory = directory
+        self.merge_policy = merge_policy or MergePolicy()
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.RLock()
+        self.manifest = read_manifest(directory)
+        self.segment_doc_ids = {}
+        self.merge_requested = threading.Event()
+        self.merge_thread = None
+        self.stopping = False
+
+    def doc_ids(self, name):
+        """Returns the set of doc ids stored in a segment, deleted or not."""
+        if name not in self.segment_doc_ids:
+            db_path, _ = segment_paths(self.directory, name)
+            conn = sqlite3.connect(db_path)
+            self.segment_doc_ids[name] = {int(row[0]) for row in conn.execute("SELECT id FROM total_length")}
+            conn.close()
+        return self.segment_doc_ids[name]
+
+    def new_segment_name(self):
+        with self.lock:
+            name = "segment%06d" % self.manifest["next_segment"]
+            self.manifest["next_segment"] += 1
+            return name
+
+    def write_segment(self, index, name):
+        """Writes index as segment name. Returns the doc ids it holds."""
+        os.makedirs(os.path.join(self.directory, name))
+        db_path, postings_file = segment_paths(self.directory, name)
+        writer = DiskIndexWriter(index, db_path, postings_file)
+        writer.write_index()
+        writer.close()
+        self.segment_doc_ids[name] = set(writer.total_length)
+        return self.segment_doc_ids[name]
+
+    def commit(self):
+        self.manifest["generation"] += 1
+        write_manifest(self.directory, self.manifest)
+        self.merge_requested.set()
+
+    def add_segment(self, index):
+        """
+        Write the documents of index as a new segment. Documents that already exist in older
+        segments are replaced: their old versions get a tombstone.
+        Args:
+            index: A PositionalInvertedIndexSqlite, or anything with sorted_items().
+        Returns:
+            str: The name of the new segment, None if index held no documents.
+        """
+        name = self.new_segment_name()
+        doc_ids = self.write_segment(index, name)
+        if not doc_ids:
+            shutil.rmtree(os.path.join(self.directory, name))
+            return None
+        with self.lock:
+            for segment in self.manifest["segments"]:
+                replaced = self.doc_ids(segment["name"]) & doc_ids
+                if replaced:
+                    segment["deleted"] = sorted(set(segment["deleted"]) | replaced)
+            self.manifest["segments"].append({"name": name, "documents": len(doc_ids), "deleted": []})
+            self.commit()
+        return name
+
+    def delete_documents(self, doc_ids):
+        """Marks the given doc ids as deleted in every segment that holds them."""
+        doc_ids = set(doc_ids)
+        with self.lock:
+            for segment in self.manifest["segments"]:
+                hits = self.doc_ids(segment["name"]) & doc_ids
+                if hits:
+                    segment["deleted"] = sorted(set(segment["deleted"]) | hits)
+            self.commit()
+
+    def merge(self, names):
+        """Merges the named segments into one new segment, dropping their deleted documents."""
+        with self.lock:
+            merging = [segment for segment in self.manifest["segments"] if segment["name"] in names]
+            snapshot = {segment["name"]: set(segment["deleted"]) for segment in merging}
+        name = self.new_segment_name()
+        # Merges read every term once, caching them would only evict the query workload
+        readers = [DiskPositionalIndex(*segment_paths(self.directory, segment["name"]), cache_bytes=0) for segment in merging]
+        try:
+            merger = SegmentMerger([(reader, snapshot[segment["name"]]) for reader, segment in zip(readers, merging)])
+            doc_ids = self.write_segment(merger, name)
+        finally:
+            for reader in readers:
+                reader.close()
+
+        with self.lock:
+            # Deletions that arrived while merging still apply to the merged documents
+            late_deletes = set()
+            for segment in self.manifest["segments"]:
+                if segment["name"] in snapshot:
+                    late_deletes |= set(segment["deleted"]) - snapshot[segment["name"]]
+            segments = []
+            for segment in self.manifest["segments"]:
+                if segment["name"] not in snapshot:
+                    segments.append(segment)
+                elif doc_ids and not any(s["name"] == name for s in segments):
+                    # The merged segment takes the place of the first segment it replaces
+                    segments.append({"name": name, "documents": len(doc_ids), "deleted": sorted(late_deletes & doc_ids)})
+            self.manifest["segments"] = segments
+            self.commit()
+        if not doc_ids:
+            shutil.rmtree(os.path.join(self.directory, name))
+        for merged_name in snapshot:
+            # Open readers keep their memory maps, the files only disappear from the directory
+            shutil.rmtree(os.path.join(self.directory, merged_name), ignore_errors=True)
+            self.segment_doc_ids.pop(merged_name, None)
+
+    def maybe_merge(self):
+        """Runs merges until the merge policy has nothing left to do."""
+        while not self.stopping:
+            with self.lock:
+                names = self.merge_policy.select(self.manifest["segments"])
+            if not names:
+                return
+            self.merge(names)
+
+    def start_background_merges(self):
+        """Starts a daemon thread that runs maybe_merge whenever segments are added or deleted."""
+        if self.merge_thread is not None:
+            return
+        self.stopping = False
+
+        def run():
+            while not self.stopping:
+                self.merge_requested.wait()
+                self.merge_requested.clear()
+                if not self.stopping:
+                    self.maybe_merge()
+
+        self.merge_thread = threading.Thread(target=run, name="segment-merges", daemon=True)
+        self.merge_thread.start()
+
+    def stop_background_merges(self):
+        if self.merge_thread is None:
+            return
+        self.stopping = True
+        self.merge_requested.set()
+        self.merge_thread.join()
+        self.merge_thread = None
+
+
+class SegmentedIndex:
+    """Queries every live segment of an index directory as one index. Statistics used for
+    ranking (document count, document lengths, All_length and document frequencies) only
+    count live documents, so scores match an index built from scratch from the same documents.
+    All segments share one PostingsCache of cache_bytes, or cache if one is given.
+
+    An instance is a snapshot of the manifest it was opened with and never changes: writers'
+    commits are picked up by refreshed(), which returns a new SegmentedIndex, so queries still
+    running on this one keep consistent segments, tombstones and statistics."""
+    def __init__(self, directory: str, cache_bytes: int = 64 * 1024 * 1024, cache: PostingsCache = None, readers: dict = None):
+        self.directory = directory
+        self.cache = cache
+        if cache is None and cache_bytes > 0:
+            self.cache = PostingsCache(cache_bytes)
+        self.load(readers or {})
+
+    def load(self, open_readers):
+        # open_readers maps segment names to readers of an older snapshot, they are reused
+        for attempt in range(3):
+            # Taken before reading, so a commit in between is seen by the next refreshed()
+            status = manifest_status(self.directory)
+            manifest = read_manifest(self.directory)
+            try:
+                readers = {}
+                for segment in manifest["segments"]:
+                    name = segment["name"]
+                    readers[name] = open_readers.get(name) or DiskPositionalIndex(*segment_paths(self.directory, name), cache_bytes=0, cache=self.cache)
+                break
+            except (FileNotFoundError, sqlite3.OperationalError):
+                # A merge replaced a segment between reading the manifest and opening it
+                if attempt == 2:
+                    raise
+
+        segments = []
+        doctotal_len = {}
+        doc_segments = {}
+        for segment in manifest["segments"]:
+            reader = readers[segment["name"]]
+            deleted = set(segment["deleted"])
+            segments.append((reader, deleted, np.array(segment["deleted"], dtype=np.int64)))
+            for doc_id, lengths in reader.doctotal_len.items():
+                if doc_id not in deleted:
+                    doctotal_len[doc_id] = lengths
+                    doc_segments[doc_id] = reader
+
+        # Segments dropped from the manifest are not closed here, queries still running may
+        # hold them, their memory maps are released once they are garbage collected
+        self.readers = readers
+        self.segments = segments
+        self.doctotal_len = doctotal_len
+        self.doc_segments = doc_segments
+        self.document_count = len(doctotal_len)
+        self.doc_lengths, self.doc_ld = document_arrays(doctotal_len)
+        self.total_len = (1, sum(length for length, _ in doctotal_len.values()))
+        self.generation = manifest["generation"]
+        self.manifest_status = status
+
+    def refreshed(self):
+        """Returns this index if no writer committed a new generation since it was loaded, else
+        a new snapshot sharing its cache and the readers of segments that are still live. The
+        manifest is only parsed again once its file changed."""
+        status = manifest_status(self.directory)
+        if status == self.manifest_status:
+            return self
+        if read_manifest(self.directory)["generation"] == self.generation:
+            self.manifest_status = status
+            return self
+        return SegmentedIndex(self.directory, cache=self.cache, readers=self.readers)
+
+    def document_frequency(self, term):
+        df = 0
+        for reader, deleted, deleted_ids in self.segments:
+            if not deleted:
+                df += reader.document_frequency(term)
+                continue
+            # Deleted documents still have postings until the segment is merged
+            run = reader.get_frequencies(term)
+            if run is not None:
+                df += len(run) - int(np.isin(run.doc_ids, deleted_ids).sum())
+        return df
+
+    def document(self, doc_id):
+        """Returns {"title", "url", "snippet"} of doc_id from the segment holding it, or None."""
+        reader = self.doc_segments.get(doc_id)
+        return reader.document(doc_id) if reader is not None else None
+
+    def expand_prefix(self, prefix):
+        terms = set()
+        for reader, _, _ in self.segments:
+            terms.update(reader.expand_prefix(prefix))
+        return sorted(terms)
+
+    def query(self, terms, operations):
+        # A document lives in exactly one live segment, so per segment results can be concatenated
+        results = []
+        for reader, deleted, _ in self.segments:
+            results.extend(posting for posting in reader.query(terms, operations) if posting[0] not in deleted)
+        with stage("merge"):
+            return sorted(results, key=lambda posting: posting[0])
+
+    def explain(self, terms, operations):
+        # Every segment plans with its own document frequencies
+        return {"op": "segments", "children": [reader.explain(terms, operations) for reader, _, _ in self.segments]}
+
+    def expand_wildcard(self, pattern):
+        terms = set()
+        for reader, _, _ in self.segments:
+            terms.update(reader.expand_wildcard(pattern))
+        return sorted(terms)
+
+    def display_form(self, term):
+        """Returns the form term is shown as in the segment where it is most frequent."""
+        best = None
+        for reader, _, _ in self.segments:
+            df = reader.document_frequency(term)
+            if df and (best is None or df > best[0]):
+                best = (df, reader)
+        return best[1].display_form(term) if best is not None else term
+
+    def similar_terms(self, word, min_jaccard=0.2, limit=50):
+        terms = set()
+        for reader, _, _ in self.segments:
+            terms.update(reader.similar_terms(word, min_jaccard, limit))
+        return sorted(terms)
+
+    def expand_terms(self, terms):
+        """Replaces every wildcard pattern in terms by the terms it matches in any segment.
+        Repeated terms are kept, so a term given twice weighs twice in the ranking."""
+        expanded = []
+        for term in terms:
+            expanded.extend(self.expand_wildcard(term) if '*' in term else [term])
+        return expanded
+
+    def queryRank(self, terms, type, k=100):
+        # Segments must score the same terms, so wildcards are expanded over all of them
+        terms = self.expand_terms(terms)
+        if not terms:
+            return []
+        # Collection-wide document frequencies, counted once for all the segments' cursors
+        dfs = {term: self.document_frequency(term) for term in set(terms)}
+        # Every segment returns its own top k, the overall top k is among them
+        results = []
+        for reader, _, deleted_ids in self.segments:
+            results.extend(reader.top_k(terms, type, k, stats=self, deleted_ids=deleted_ids, dfs=dfs))
+        key = "Okapi" if type == "okapi" else "score"
+        with stage("score"):
+            results.sort(key=lambda item: (-item[key], item["doc_id"]))
+        return top_k_results(results, k, self)
+
+    def pinned_view(self, terms):
+        """Returns a copy whose segments each decode terms once, see DiskPositionalIndex.pinned_view."""
+        view = copy.copy(self)
+        view.segments = [(reader.pinned_view(terms), deleted, deleted_ids) for reader, deleted, deleted_ids in self.segments]
+        return view
+
+    def batch(self, queries):
+        return run_batch(self, queries)
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache is not None else {}
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+        self.segments = []
+        self.doc_segments = {}
@@ -0,0 +1,137 @@
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+
+# Rough CPython sizes used to estimate how much memory the in-memory postings take
+TERM_OVERHEAD = 120
+POSTING_OVERHEAD = 120
+POSITION_SIZE = 36
+DOCUMENT_OVERHEAD = 300
+
+
+class SpimiIndexer:
+    """Single-pass in-memory indexing. Postings are collected like in PositionalInvertedIndexSqlite
+    until their estimated size reaches memory_budget bytes, then the block is written to a
+    temporary run file sorted by term and memory is released. Document metadata counts against
+    the same budget and is spilled with it, sorted by doc id. sorted_items() and
+    document_items() k-way merge the runs, so DiskIndexWriter can write an index much larger
+    than the memory available, identical to one built in memory. The counts of the forms
+    terms were stemmed from stay in memory, they grow with the vocabulary only."""
+    def __init__(self, memory_budget: int = 256 * 1024 * 1024, temp_dir: str = None):
+        self.memory_budget = memory_budget
+        self.index = {}
+        self.memory_used = 0
+        self.runs = []
+        self.documents = {}
+        self.document_runs = []
+        self.forms = {}
+        self.temp_dir = tempfile.mkdtemp(prefix="spimi-", dir=temp_dir)
+
+    def add_term(self, term, doc_id, positions):
+        """
+        Add a term to the current block with its associated document ID and positions.
+        Args:
+            term (str): The term to add to the index.
+            doc_id (int): The ID of the document containing the term.
+            positions (list): A list of positions where the term occurs in the document.
+        """
+        if term not in self.index:
+            self.index[term] = []
+            self.memory_used += TERM_OVERHEAD + len(term)
+        self.index[term].append((doc_id, positions))
+        self.memory_used += POSTING_OVERHEAD + POSITION_SIZE * len(positions)
+        if self.memory_used >= self.memory_budget:
+            self.flush()
+
+    def add_forms(self, forms):
+        """Count the unstemmed forms terms occur as, see PositionalInvertedIndexSqlite.add_forms."""
+        for term, counts in forms.items():
+            total = self.forms.setdefault(term, {})
+            for form, count in counts.items():
+                total[form] = total.get(form, 0) + count
+
+    def term_forms(self):
+        return self.forms
+
+    def add_document(self, doc_id, title, url, snippet):
+        """Record the metadata DiskIndexWriter puts in the document store."""
+        self.documents[doc_id] = (title, url, snippet)
+        self.memory_used += DOCUMENT_OVERHEAD + sum(len(field or "") for field in (title, url, snippet))
+        if self.memory_used >= self.memory_budget:
+            self.flush()
+
+    def merge(self, other):
+        """Add every posting of a PositionalInvertedIndexSqlite, flushing as the budget requires."""
+        for term, postings in other.index.items():
+            for doc_id, positions in postings:
+                self.add_term(term, doc_id, positions)
+        for doc_id, fields in other.document_items():
+            self.add_document(doc_id, *fields)
+        self.add_forms(other.term_forms())
+
+    def flush(self):
+        """Writes the current block to run files, one pickled (term, postings) record per term
+        and one (doc_id, (title, url, snippet)) record per document."""
+        if self.index:
+            path = os.path.join(self.temp_dir, "run%05d.bin" % len(self.runs))
+            self.write_run(path, ((term, self.index[term]) for term in sorted(self.index)))
+            self.runs.append(path)
+            self.index = {}
+        if self.documents:
+            path = os.path.join(self.temp_dir, "documents%05d.bin" % len(self.document_runs))
+            self.write_run(path, ((doc_id, self.documents[doc_id]) for doc_id in sorted(self.documents)))
+            self.document_runs.append(path)
+            self.documents = {}
+        self.memory_used = 0
+
+    def write_run(self, path, records):
+        with open(path, 'wb') as file:
+            for record in records:
+                pickle.dump(record, file, pickle.HIGHEST_PROTOCOL)
+
+    def read_run(self, path):
+        with open(path, 'rb') as file:
+            while True:
+                try:
+                    yield pickle.load(file)
+                except EOFError:
+                    return
+
+    def sorted_items(self):
+        """Yields (term, postings sorted by doc id) for every term in increasing term order."""
+        if not self.runs:
+            for term in sorted(self.index):
+                yield term, sorted(self.index[term], key=lambda posting: posting[0])
+            return
+
+        self.flush()
+        merged = heapq.merge(*(self.read_run(path) for path in self.runs), key=lambda record: record[0])
+        term, postings = None, []
+        for next_term, next_postings in merged:
+            if next_term != term:
+                if term is not None:
+                    yield term, sorted(postings, key=lambda posting: posting[0])
+                term, postings = next_term, []
+            postings.extend(next_postings)
+        if term is not None:
+            yield term, sorted(postings, key=lambda posting: posting[0])
+
+    def document_items(self):
+        """Yields (doc_id, (title, url, snippet)) for every document added, by doc id."""
+        if not self.document_runs:
+            for doc_id in sorted(self.documents):
+                yield doc_id, self.documents[doc_id]
+            return
+
+        self.flush()
+        yield from heapq.merge(*(self.read_run(path) for path in self.document_runs), key=lambda record: record[0])
+
+    def close(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+        self.index = {}
+        self.runs = []
+        self.documents = {}
+        self.document_runs = []
+        self.forms = {}
@@ -0,0 +1,220 @@
+import os
+import re
+from bisect import bisect_left
+from collections import defaultdict
+import numpy as np
+from indexing.varint import encode_into, read_number, decode_numbers
+from indexing.intersect import common_sorted
+
+# vocab.kgrams holds KGRAM_MAGIC, then as variable byte numbers the version, the number of k-gram
+# lengths and each length, the number of terms, every term as its utf-8 length and bytes in sorted
+# order followed since version 3 by the form it is shown as, its most frequent unstemmed form, the
+# same way or with length 0 if that is the term itself, the number of k-grams and per k-gram, in sorted order, its utf-8 length and bytes, the
+# number of terms containing it, the byte length of their ids and the ids themselves as gaps.
+# Term ids are positions in the term list. Wildcards use the longest k-grams, which are the most
+# selective, spelling correction the shortest, which still overlap when letters are swapped.
+KGRAM_MAGIC = b'SEKG'
+KGRAM_VERSION = 3
+# Oldest version still readable, it has no display forms
+KGRAM_MIN_VERSION = 2
+KGRAM_LENGTHS = (2, 3)
+
+
+def kgram_path(db_path):
+    # The k-gram index lives next to vocab_term_mapping.db
+    return os.path.join(os.path.dirname(db_path), "vocab.kgrams")
+
+
+def term_kgrams(term, k):
+    """Returns the k-grams of term with $ marking its start and end."""
+    marked = '$' + term + '$'
+    return {marked[i:i + k] for i in range(len(marked) - k + 1)}
+
+
+def display_form(term, forms):
+    """Returns the most frequent of forms, a dict of unstemmed forms of term to their number of
+    occurrences, the first alphabetically among equally frequent ones. term if forms is empty."""
+    if not forms:
+        return term
+    return min(forms, key=lambda form: (-forms[form], form))
+
+
+def encode_kgram_index(terms, lengths=KGRAM_LENGTHS, forms=None):
+    """Returns the vocab.kgrams contents for a vocabulary. forms optionally maps terms to the
+    occurrences of their unstemmed forms, see display_form."""
+    terms = sorted(set(terms))
+    forms = forms or {}
+    kgrams = defaultdict(list)
+    for term_id, term in enumerate(terms):
+        for k in lengths:
+            for kgram in term_kgrams(term, k):
+                kgrams[kgram].append(term_id)
+
+    out = bytearray(KGRAM_MAGIC)
+    for number in (KGRAM_VERSION, len(lengths), *lengths, len(terms)):
+        encode_into(out, number)
+    for term in terms:
+        data = term.encode('utf-8')
+        encode_into(out, len(data))
+        out += data
+        form = display_form(term, forms.get(term))
+        data = form.encode('utf-8') if form != term else b''
+        encode_into(out, len(data))
+        out += data
+    encode_into(out, len(kgrams))
+    ids = bytearray()
+    for kgram in sorted(kgrams):
+        data = kgram.encode('utf-8')
+        encode_into(out, len(data))
+        out += data
+        ids.clear()
+        last_id = 0
+        for term_id in kgrams[kgram]:
+            encode_into(ids, term_id - last_id)
+            last_id = term_id
+        encode_into(out, len(kgrams[kgram]))
+        encode_into(out, len(ids))
+        out += ids
+    return bytes(out)
+
+
+def write_kgram_index(db_path, terms, lengths=KGRAM_LENGTHS, path=None, forms=None):
+    """Writes the k-gram index of terms next to db_path, or to path if given. forms is as for
+    encode_kgram_index. Returns the number of bytes written."""
+    data = encode_kgram_index(terms, lengths, forms)
+    with open(path or kgram_path(db_path), 'wb') as file:
+        file.write(data)
+    return len(data)
+
+
+class TermKGramIndex:
+    """Maps the k-grams of every vocabulary term to the terms containing them, for wildcard
+    queries. The term lists of a k-gram are decoded when a pattern needs them. Also knows the
+    form every term is shown as, see form."""
+    def __init__(self, data):
+        if data[:len(KGRAM_MAGIC)] != KGRAM_MAGIC:
+            raise ValueError("Not a k-gram index")
+        version, offset = read_number(data, len(KGRAM_MAGIC))
+        if not KGRAM_MIN_VERSION <= version <= KGRAM_VERSION:
+            raise ValueError("Unsupported k-gram index version %d" % version)
+        self.data = data
+        count, offset = read_number(data, offset)
+        self.lengths = []
+        for _ in range(count):
+            length, offset = read_number(data, offset)
+            self.lengths.append(length)
+        self.k = max(self.lengths)
+        count, offset = read_number(data, offset)
+        self.terms = []
+        # term id -> display form, for the terms not shown as themselves
+        self.forms = {}
+        for term_id in range(count):
+            length, offset = read_number(data, offset)
+            self.terms.append(data[offset:offset + length].decode('utf-8'))
+            offset += length
+            if version >= 3:
+                length, offset = read_number(data, offset)
+                if length:
+                    self.forms[term_id] = data[offset:offset + length].decode('utf-8')
+                offset += length
+        # k-gram -> (number of terms, byte offset and length of their ids)
+        self.kgrams = {}
+        count, offset = read_number(data, offset)
+        for _ in range(count):
+            length, offset = read_number(data, offset)
+            kgram = data[offset:offset + length].decode('utf-8')
+            term_count, offset = read_number(data, offset + length)
+            nbytes, offset = read_number(data, offset)
+            self.kgrams[kgram] = (term_count, offset, nbytes)
+            offset += nbytes
+        # Number of distinct shortest k-grams of every term, computed when similar() first needs it
+        self.term_sizes = None
+
+    @classmethod
+    def load(cls, db_path):
+        with open(kgram_path(db_path), 'rb') as file:
+            return cls(file.read())
+
+    @classmethod
+    def build(cls, terms, lengths=KGRAM_LENGTHS):
+        """An in-memory index of terms, for indexes written without vocab.kgrams."""
+        return cls(encode_kgram_index(terms, lengths))
+
+    def form(self, term):
+        """Returns the most frequent unstemmed form of a vocabulary term, to show it to users.
+        Terms without a recorded form, or not in the vocabulary, are returned as they are."""
+        if not self.forms:
+            return term
+        term_id = bisect_left(self.terms, term)
+        if term_id < len(self.terms) and self.terms[term_id] == term:
+            return self.forms.get(term_id, term)
+        return term
+
+    def display_forms(self):
+        """Yields (term, the form it is shown as) for every term, in term order."""
+        for term_id, term in enumerate(self.terms):
+            yield term, self.forms.get(term_id, term)
+
+    def term_ids(self, kgram):
+        """Returns the sorted ids of the terms containing kgram."""
+        entry = self.kgrams.get(kgram)
+        if entry is None:
+            return np.zeros(0, dtype=np.int64)
+        _, offset, nbytes = entry
+        numbers, _ = decode_numbers(self.data[offset:offset + nbytes])
+        return np.cumsum(numbers.astype(np.int64))
+
+    def expand(self, pattern):
+        """
+        Expand a wildcard pattern such as "nation*", "*ment" or "co*ion" against the vocabulary.
+        Returns:
+            list: The matching terms, sorted.
+        """
+        pattern = pattern.lower()
+        # Only k-grams lying entirely between two *s constrain the candidates, the longest
+        # indexed ones that fit each fragment
+        kgrams = set()
+        for fragment in ('$' + pattern + '$').split('*'):
+            fitting = [length for length in self.lengths if length <= len(fragment)]
+            if fitting:
+                k = max(fitting)
+                kgrams.update(fragment[i:i + k] for i in range(len(fragment) - k + 1))
+        if kgrams:
+            if any(kgram not in self.kgrams for kgram in kgrams):
+                return []
+            # Rarest k-gram first, every intersection can only shrink the candidates
+            ordered = sorted(kgrams, key=lambda kgram: self.kgrams[kgram][0])
+            candidates = self.term_ids(ordered[0])
+            for kgram in ordered[1:]:
+                if not len(candidates):
+                    break
+                candidates = common_sorted(self.term_ids(kgram), candidates)
+        else:
+            candidates = np.arange(len(self.terms))
+        # k-grams match in any order, the pattern itself decides
+        regex = re.compile('.*'.join(re.escape(part) for part in pattern.split('*')), re.DOTALL)
+        return [self.terms[i] for i in candidates.tolist() if regex.fullmatch(self.terms[i])]
+
+    def similar(self, word, min_jaccard=0.2, limit=50):
+        """
+        Find the terms sharing the most k-grams with word, for spelling correction.
+        Args:
+            word (str): A word, usually not in the vocabulary.
+            min_jaccard (float): Smallest Jaccard overlap of the k-gram sets to keep a term.
+            limit (int): Most terms to return.
+        Returns:
+            list: (term, jaccard) pairs, best overlap first.
+        """
+        k = min(self.lengths)
+        word_kgrams = term_kgrams(word.lower(), k)
+        kgrams = [kgram for kgram in word_kgrams if kgram in self.kgrams]
+        if not kgrams:
+            return []
+        term_ids, overlaps = np.unique(np.concatenate([self.term_ids(kgram) for kgram in kgrams]), return_counts=True)
+        if self.term_sizes is None:
+            self.term_sizes = np.array([len(term_kgrams(term, k)) for term in self.terms], dtype=np.int64)
+        jaccard = overlaps / (len(word_kgrams) + self.term_sizes[term_ids] - overlaps)
+        keep = np.flatnonzero(jaccard >= min_jaccard)
+        # Best overlap first, ties by term id which is alphabetical
+        keep = keep[np.argsort(-jaccard[keep], kind='stable')[:limit]]
+        return [(self.terms[i], float(score)) for i, score in zip(term_ids[keep].tolist(), jaccard[keep].tolist())]
@@ -1,7 +1,14 @@
-from indexing.PositionalInvertedIndex import PositionalInvertedIndex
-from indexing.PositionalInvertedIndexSqlite import PositionalInvertedIndexSqlite
-from indexing.postings import Posting
-from indexing.index import Index
-from indexing.KGramIndex import KGramIndex
-from indexing.DiskIndexWriter import DiskIndexWriter
-from indexing.DiskPositionalIndex import DiskPositionalIndex
+from indexing.PositionalInvertedIndex import PositionalInvertedIndex
+from indexing.PositionalInvertedIndexSqlite import PositionalInvertedIndexSqlite
+from indexing.postings import Posting
+from indexing.index import Index
+from indexing.KGramIndex import KGramIndex
+from indexing.TermKGramIndex import TermKGramIndex
+from indexing.SpimiIndexer import SpimiIndexer
+from indexing.DiskLexicon import DiskLexicon
+from indexing.DocumentStore import DocumentStore
+from indexing.bitmap import DocBitmap
+from indexing.MaxScore import MaxScoreRanker
+from indexing.DiskIndexWriter import DiskIndexWriter
+from indexing.DiskPositionalIndex import DiskPositionalIndex
+from indexing.SegmentedIndex import SegmentedIndex, SegmentedIndexWriter, MergePolicy
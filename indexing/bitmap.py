@@ -0,0 +1,161 @@
+import numpy as np
+
+# A container holds the doc ids sharing their high 16 bits, as a sorted uint16 array of the low
+# bits while it has at most ARRAY_MAX of them and as a 65536 bit uint64 bitmap past that
+ARRAY_MAX = 4096
+
+
+def _bits(container):
+    if container.dtype == np.uint64:
+        return container
+    flags = np.zeros(1 << 16, dtype=bool)
+    flags[container] = True
+    return np.packbits(flags, bitorder='little').view(np.uint64)
+
+
+def _lows(container):
+    if container.dtype == np.uint16:
+        return container
+    return np.flatnonzero(np.unpackbits(container.view(np.uint8), bitorder='little')).astype(np.uint16)
+
+
+def _cardinality(container):
+    if container.dtype == np.uint16:
+        return len(container)
+    return int(np.count_nonzero(np.unpackbits(container.view(np.uint8))))
+
+
+def _member(container, lows):
+    # Which of lows are in the container
+    if container.dtype == np.uint16:
+        return np.isin(lows, container, assume_unique=True)
+    return ((container[lows >> 6] >> (lows & 63).astype(np.uint64)) & np.uint64(1)).astype(bool)
+
+
+def _shrink(container):
+    # Back to an array container once few enough doc ids are left, None once empty
+    count = _cardinality(container)
+    if count == 0:
+        return None
+    if container.dtype == np.uint64 and count <= ARRAY_MAX:
+        return _lows(container)
+    return container
+
+
+class DocBitmap:
+    """Compressed set of doc ids in the layout of Roaring bitmaps: ids are grouped by their high
+    16 bits and each group is stored as a sorted array or a 8 KB bitmap, whichever is smaller.
+    &, | and - run container by container, dense ranges such as the whole collection cost
+    8 KB per 65536 documents. Instances are immutable."""
+    def __init__(self, containers=None):
+        self.containers = containers or {}
+
+    @classmethod
+    def from_sorted(cls, doc_ids):
+        """Builds a bitmap from sorted, distinct doc ids."""
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        containers = {}
+        if len(doc_ids):
+            highs = doc_ids >> 16
+            boundaries = np.flatnonzero(np.diff(highs)) + 1
+            for group in np.split(doc_ids, boundaries):
+                lows = (group & 0xFFFF).astype(np.uint16)
+                containers[int(group[0] >> 16)] = _bits(lows) if len(lows) > ARRAY_MAX else lows
+        return cls(containers)
+
+    @classmethod
+    def of(cls, doc_ids):
+        return doc_ids if isinstance(doc_ids, cls) else cls.from_sorted(doc_ids)
+
+    @classmethod
+    def full(cls, size):
+        """Every doc id from 0 to size - 1."""
+        containers = {}
+        for high in range((size + 0xFFFF) >> 16):
+            count = min(size - (high << 16), 1 << 16)
+            if count > ARRAY_MAX:
+                flags = np.zeros(1 << 16, dtype=bool)
+                flags[:count] = True
+                containers[high] = np.packbits(flags, bitorder='little').view(np.uint64)
+            else:
+                containers[high] = np.arange(count, dtype=np.uint16)
+        return cls(containers)
+
+    def __len__(self):
+        return sum(_cardinality(container) for container in self.containers.values())
+
+    def __contains__(self, doc_id):
+        container = self.containers.get(doc_id >> 16)
+        return container is not None and bool(_member(container, np.array([doc_id & 0xFFFF]))[0])
+
+    @property
+    def nbytes(self):
+        return sum(container.nbytes for container in self.containers.values())
+
+    def member(self, doc_ids):
+        """Returns a bool array telling which of the sorted doc_ids are in the bitmap."""
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        found = np.zeros(len(doc_ids), dtype=bool)
+        if not len(doc_ids):
+            return found
+        highs = doc_ids >> 16
+        boundaries = np.concatenate(([0], np.flatnonzero(np.diff(highs)) + 1, [len(doc_ids)]))
+        for start, end in zip(boundaries[:-1].tolist(), boundaries[1:].tolist()):
+            container = self.containers.get(int(highs[start]))
+            if container is not None:
+                found[start:end] = _member(container, doc_ids[start:end] & 0xFFFF)
+        return found
+
+    def to_array(self):
+        """Returns the doc ids as a sorted int64 array."""
+        parts = [(high << 16) + _lows(self.containers[high]).astype(np.int64) for high in sorted(self.containers)]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def __and__(self, other):
+        containers = {}
+        for high in self.containers.keys() & other.containers.keys():
+            a, b = self.containers[high], other.containers[high]
+            if a.dtype == np.uint16:
+                container = a[_member(b, a)]
+            elif b.dtype == np.uint16:
+                container = b[_member(a, b)]
+            else:
+                container = _shrink(a & b)
+            if container is not None and len(container):
+                containers[high] = container
+        return DocBitmap(containers)
+
+    def __or__(self, other):
+        return DocBitmap.union([self, other])
+
+    def __sub__(self, other):
+        containers = {}
+        for high, a in self.containers.items():
+            b = other.containers.get(high)
+            if b is None:
+                containers[high] = a
+                continue
+            if a.dtype == np.uint16:
+                container = a[~_member(b, a)]
+            else:
+                container = _shrink(a & ~_bits(b))
+            if container is not None and len(container):
+                containers[high] = container
+        return DocBitmap(containers)
+
+    @staticmethod
+    def union(bitmaps):
+        """Union of any number of bitmaps, container by container."""
+        groups = {}
+        for bitmap in bitmaps:
+            for high, container in bitmap.containers.items():
+                groups.setdefault(high, []).append(container)
+        containers = {}
+        for high, group in groups.items():
+            if len(group) == 1:
+                containers[high] = group[0]
+            elif sum(len(container) if container.dtype == np.uint16 else ARRAY_MAX + 1 for container in group) <= ARRAY_MAX:
+                containers[high] = np.unique(np.concatenate(group))
+            else:
+                containers[high] = _shrink(np.bitwise_or.reduce([_bits(container) for container in group]))
+        return DocBitmap(containers)
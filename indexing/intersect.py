@@ -0,0 +1,117 @@
+import heapq
+from bisect import bisect_left
+import numpy as np
+from indexing.bitmap import DocBitmap
+
+
+def gallop(values, target, low=0):
+    """Returns the first index from low on with values[index] >= target, or len(values).
+    Probes low, low + 1, low + 3, low + 7, ... then binary searches the last step, so the
+    cost grows with the log of the distance travelled rather than the length of values."""
+    step = 1
+    high = low
+    while high < len(values) and values[high] < target:
+        low = high + 1
+        high += step
+        step *= 2
+    return bisect_left(values, target, low, min(high, len(values)))
+
+
+def intersect_sorted(a, b):
+    """
+    Intersect two ascending sequences of distinct doc ids. The shorter one is walked and the
+    longer one galloped through, O(m log(n / m)) for lengths m <= n, so a rare term ANDed
+    with a common one only touches a few places of the common list.
+    Args:
+        a (list or array): Sorted doc ids.
+        b (list or array): Sorted doc ids.
+    Returns:
+        list or array: The indexes in b of the doc ids also in a, ascending. An array when
+            either input is a numpy array.
+    """
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        a = np.asarray(a)
+        b = np.asarray(b)
+        if not len(a) or not len(b):
+            return np.zeros(0, dtype=np.int64)
+        if len(a) <= len(b):
+            # One binary search of b per element of a
+            found = np.searchsorted(b, a)
+            inside = found < len(b)
+            found = found[inside]
+            return found[b[found] == a[inside]]
+        found = np.searchsorted(a, b)
+        inside = found < len(a)
+        matches = np.zeros(len(b), dtype=bool)
+        matches[inside] = a[found[inside]] == b[inside]
+        return np.flatnonzero(matches)
+
+    indexes = []
+    if len(a) <= len(b):
+        position = 0
+        for value in a:
+            position = gallop(b, value, position)
+            if position == len(b):
+                break
+            if b[position] == value:
+                indexes.append(position)
+                position += 1
+    else:
+        position = 0
+        for index, value in enumerate(b):
+            position = gallop(a, value, position)
+            if position == len(a):
+                break
+            if a[position] == value:
+                indexes.append(index)
+                position += 1
+    return indexes
+
+
+def common_sorted(a, b):
+    """Returns the doc ids of b that are also in a, see intersect_sorted. Either may be a
+    DocBitmap, the result is one only if both are."""
+    if isinstance(a, DocBitmap) and isinstance(b, DocBitmap):
+        return a & b
+    if isinstance(a, DocBitmap):
+        return np.asarray(b, dtype=np.int64)[a.member(b)]
+    if isinstance(b, DocBitmap):
+        return np.asarray(a, dtype=np.int64)[b.member(a)]
+    indexes = intersect_sorted(a, b)
+    if isinstance(indexes, np.ndarray):
+        return np.asarray(b)[indexes]
+    return [b[i] for i in indexes]
+
+
+def difference_sorted(a, b):
+    """Returns the doc ids of a that are not in b, both sorted. Either may be a DocBitmap."""
+    if isinstance(a, DocBitmap):
+        return a - DocBitmap.of(b)
+    if isinstance(b, DocBitmap):
+        return np.asarray(a, dtype=np.int64)[~b.member(a)]
+    indexes = intersect_sorted(b, a)
+    if isinstance(indexes, np.ndarray):
+        keep = np.ones(len(a), dtype=bool)
+        keep[indexes] = False
+        return np.asarray(a)[keep]
+    dropped = set(indexes)
+    return [value for i, value in enumerate(a) if i not in dropped]
+
+
+def union_sorted(runs):
+    """
+    Union of any number of sorted doc id sequences in one k-way merge.
+    Returns:
+        list, array or DocBitmap: The distinct doc ids, sorted. A DocBitmap when any run is
+            one, an array when any run is a numpy array.
+    """
+    if any(isinstance(run, DocBitmap) for run in runs):
+        return DocBitmap.union([DocBitmap.of(run) for run in runs])
+    if any(isinstance(run, np.ndarray) for run in runs):
+        # numpy has no k-way merge, one sort of the concatenation is faster than heapq here
+        return np.unique(np.concatenate([np.asarray(run, dtype=np.int64) for run in runs]))
+    result = []
+    for value in heapq.merge(*runs):
+        if not result or result[-1] != value:
+            result.append(value)
+    return result
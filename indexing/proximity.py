@@ -0,0 +1,108 @@
+import re
+import numpy as np
+
+# Allowed distance (low, high) from one phrase term to the next: an exact phrase needs the
+# next term right after, NEAR/k within k positions before or after. A distance of 0 never
+# matches, two terms cannot be at the same position
+PHRASE_GAP = (1, 1)
+NEAR_PATTERN = re.compile(r'^NEAR/(\d+)$')
+
+
+def parse_proximity(words):
+    """
+    Split the words of a phrase or proximity query into terms and gaps.
+    Args:
+        words (list): e.g. ["national", "park"] or ["park", "NEAR/3", "trail"].
+    Returns:
+        tuple: (terms, gaps) where gaps[i] is the (low, high) distance allowed between
+            terms[i] and terms[i + 1]. NEAR/k is unordered: "park NEAR/3 trail" and
+            "trail NEAR/3 park" match the same documents.
+    """
+    terms = []
+    gaps = []
+    gap = PHRASE_GAP
+    for word in words:
+        near = NEAR_PATTERN.match(word)
+        if near:
+            distance = max(1, int(near.group(1)))
+            gap = (-distance, distance)
+            continue
+        if terms:
+            gaps.append(gap)
+        terms.append(word)
+        gap = PHRASE_GAP
+    return terms, gaps
+
+
+def in_range(targets, positions, low, high):
+    """Returns for each of positions whether sorted targets hold a value t with
+    low <= t - position <= high, t != position."""
+    left = np.searchsorted(targets, positions + low, 'left')
+    right = np.searchsorted(targets, positions + high, 'right')
+    count = right - left
+    if low <= 0 <= high:
+        # The same term on both sides of NEAR must not match itself
+        same = np.searchsorted(targets, positions, 'left')
+        count = count - (targets[np.minimum(same, len(targets) - 1)] == positions)
+    return count > 0
+
+
+def join_keys(keys, gaps):
+    """
+    Positional join of n sorted position arrays in one forward and one backward pass.
+    Args:
+        keys (list): One sorted int64 array per term.
+        gaps (list): (low, high) allowed between consecutive terms.
+    Returns:
+        array: The positions of the first term that start a full match.
+    """
+    reachable = [keys[0]]
+    for (low, high), positions in zip(gaps, keys[1:]):
+        # p is reachable if some previous r has low <= p - r <= high
+        reachable.append(positions[in_range(reachable[-1], positions, -high, -low)])
+        if not len(reachable[-1]):
+            return reachable[-1]
+    valid = reachable[-1]
+    for (low, high), positions in zip(reversed(gaps), reversed(reachable[:-1])):
+        # Keep the positions some valid position of the next term can be reached from
+        valid = positions[in_range(valid, positions, low, high)]
+    return valid
+
+
+def join_positions(positions, gaps):
+    """Returns the start positions of matches in one document given the sorted positions of
+    each term, as lists or arrays."""
+    keys = [np.asarray(p, dtype=np.int64) for p in positions]
+    if not keys or any(len(k) == 0 for k in keys):
+        return []
+    return join_keys(keys, gaps).tolist()
+
+
+def join_documents(doc_ids, term_positions, gaps):
+    """
+    Positional join over many documents at once.
+    Args:
+        doc_ids (array): Sorted ids of the candidate documents.
+        term_positions (list): Per term, (tfs, positions) where tfs[i] is its frequency in
+            doc_ids[i] and positions holds the sorted positions of every document in turn.
+        gaps (list): (low, high) allowed between consecutive terms.
+    Returns:
+        list: (doc_id, [start positions]) for every document with a match.
+    """
+    if not len(doc_ids):
+        return []
+    # Offset each document's positions so no gap can reach into the next document
+    stride = max(int(positions.max()) if len(positions) else 0 for _, positions in term_positions)
+    stride += max(max(-low, high) for low, high in gaps) + 1 if gaps else 1
+    ranks = np.arange(len(doc_ids), dtype=np.int64) * stride
+    keys = [np.repeat(ranks, tfs) + positions for tfs, positions in term_positions]
+    starts = join_keys(keys, gaps)
+    if not len(starts):
+        return []
+    documents = starts // stride
+    boundaries = np.flatnonzero(np.diff(documents)) + 1
+    results = []
+    for group in np.split(starts, boundaries):
+        rank = int(group[0] // stride)
+        results.append((int(doc_ids[rank]), (group - rank * stride).tolist()))
+    return results
@@ -0,0 +1,307 @@
+import math
+import numpy as np
+
+# Size of the first slice taken from the postings buffer when the length of a run is not known
+INITIAL_WINDOW = 4096
+# Runs shorter than this have a single block and no skip pointers
+SKIP_MIN_DF = 64
+
+
+def encode_into(out, number):
+    """Appends the variable byte encoding of number to the bytearray out."""
+    while number >= 0x80:
+        out.append((number & 0x7F) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def read_number(buffer, offset):
+    """Decodes one variable byte number at offset. Returns the number and the offset after it."""
+    number = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, offset
+        shift += 7
+
+
+def decode_numbers(data):
+    """
+    Decode every complete variable byte number in data at once.
+    Args:
+        data (bytes-like): Encoded bytes, as written by encode_number.
+    Returns:
+        tuple: (numbers, ends) where numbers is a uint64 array of the decoded values and ends
+        holds the index of the last byte of each number. Trailing bytes of an unfinished
+        number are ignored.
+    """
+    raw = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(raw < 0x80)
+    if len(ends) == 0:
+        return np.zeros(0, dtype=np.uint64), ends
+    raw = raw[:ends[-1] + 1]
+
+    starts = np.empty(len(ends), dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # Position of every byte inside its own number gives the shift of its 7 bits
+    byte_rank = np.arange(len(raw), dtype=np.int64) - np.repeat(starts, ends - starts + 1)
+    values = (raw & 0x7F).astype(np.uint64) << (byte_rank * 7).astype(np.uint64)
+    return np.add.reduceat(values, starts), ends
+
+
+class PostingsRun:
+    """The decoded postings of one term.
+    doc_ids and tfs have one entry per document. positions is the flat array of absolute
+    positions of every document, document i owning positions[position_starts[i]:position_starts[i + 1]].
+    nbytes is the encoded length of the run, so the next run starts at offset + nbytes."""
+    def __init__(self, doc_ids, tfs, positions, position_starts, nbytes):
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.positions = positions
+        self.position_starts = position_starts
+        self.nbytes = nbytes
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def get_positions(self, i):
+        return self.positions[self.position_starts[i]:self.position_starts[i + 1]]
+
+    def to_postings(self):
+        """Converts the run to the [(doc_id, [positions])] lists used by the query code."""
+        positions = self.positions.tolist()
+        starts = self.position_starts.tolist()
+        return [(doc_id, positions[starts[i]:starts[i + 1]]) for i, doc_id in enumerate(self.doc_ids.tolist())]
+
+
+def _absolute_positions(gaps, tfs, position_starts):
+    # Turn gaps into absolute positions, restarting the running sum at every document
+    running = np.cumsum(gaps)
+    base = np.zeros(len(tfs), dtype=np.int64)
+    has_before = position_starts[:-1] > 0
+    base[has_before] = running[position_starts[:-1][has_before] - 1]
+    return running - np.repeat(base, tfs)
+
+
+def _layout(numbers):
+    """Walks df, then (doc_id, tf, tf position gaps) per document. Returns the index of
+    every doc_id in numbers and the number of values used, or None if numbers is too short."""
+    available = len(numbers)
+    if available == 0:
+        return None
+    values = numbers.tolist()
+    dft = values[0]
+    doc_index = []
+    i = 1
+    for _ in range(dft):
+        if i + 1 >= available:
+            return None
+        doc_index.append(i)
+        i += 2 + values[i + 1]
+    if i > available:
+        return None
+    return doc_index, i
+
+
+def decode_postings(buffer, offset):
+    """
+    Decode the postings of one term written by DiskIndexWriter in a single pass.
+    Args:
+        buffer (bytes-like): The postings file contents, usually a mmap.
+        offset (int): Byte position of the term, as stored in the vocabulary.
+    Returns:
+        PostingsRun: The decoded document ids, term frequencies and positions.
+    """
+    window = INITIAL_WINDOW
+    while True:
+        end = min(offset + window, len(buffer))
+        numbers, ends = decode_numbers(buffer[offset:end])
+        layout = _layout(numbers)
+        if layout is not None:
+            break
+        if end == len(buffer):
+            raise ValueError("Postings run at byte %d is truncated" % offset)
+        window *= 2
+
+    doc_index, used = layout
+    doc_index = np.array(doc_index, dtype=np.int64)
+    doc_ids = numbers[doc_index].astype(np.int64)
+    tfs = numbers[doc_index + 1].astype(np.int64)
+
+    position_starts = np.zeros(len(tfs) + 1, dtype=np.int64)
+    np.cumsum(tfs, out=position_starts[1:])
+    # Gap values sit right after each (doc_id, tf) pair
+    gap_index = np.repeat(doc_index + 2 - position_starts[:-1], tfs) + np.arange(position_starts[-1], dtype=np.int64)
+    positions = _absolute_positions(numbers[gap_index].astype(np.int64), tfs, position_starts)
+
+    nbytes = int(ends[used - 1]) + 1
+    return PostingsRun(doc_ids, tfs, positions, position_starts, nbytes)
+
+
+class FrequencyRun:
+    """The doc/tf stream of one term in the split format. position_offsets[i] and
+    position_nbytes[i] locate the positions of document i in positions.bin."""
+    def __init__(self, doc_ids, tfs, position_offsets, position_nbytes, nbytes):
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.position_offsets = position_offsets
+        self.position_nbytes = position_nbytes
+        self.nbytes = nbytes
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+
+def skip_interval(df):
+    """Number of documents per block of a run with skip pointers, about sqrt(df)."""
+    if df < SKIP_MIN_DF:
+        return max(df, 1)
+    return math.isqrt(df - 1) + 1
+
+
+def _decode_triples(buffer, offset, count):
+    # Decodes count (doc, tf, positions byte length) triples. Returns a (count, 3) int64 array
+    # and the offset right after them.
+    if count == 0:
+        return np.zeros((0, 3), dtype=np.int64), offset
+    # Every number takes at least one byte
+    window = max(INITIAL_WINDOW, 3 * count)
+    while True:
+        end = min(offset + window, len(buffer))
+        numbers, ends = decode_numbers(buffer[offset:end])
+        if len(numbers) >= 3 * count:
+            break
+        if end == len(buffer):
+            raise ValueError("Postings run at byte %d is truncated" % offset)
+        window *= 2
+    triples = numbers[:3 * count].astype(np.int64).reshape(-1, 3)
+    return triples, offset + int(ends[3 * count - 1]) + 1
+
+
+def _frequency_run(triples, doc_base, positions_offset, nbytes, doc_gaps):
+    doc_ids = triples[:, 0]
+    if doc_gaps:
+        doc_ids = np.cumsum(doc_ids) + doc_base
+    position_nbytes = triples[:, 2]
+    position_offsets = np.empty(len(triples), dtype=np.int64)
+    if len(triples):
+        position_offsets[0] = positions_offset
+        np.cumsum(position_nbytes[:-1], out=position_offsets[1:])
+        position_offsets[1:] += positions_offset
+    return FrequencyRun(doc_ids, triples[:, 1], position_offsets, position_nbytes, nbytes)
+
+
+def decode_frequencies(buffer, offset, positions_offset, doc_gaps=False, skips=False):
+    """
+    Decode the doc/tf stream of one term: df, then (doc_id, tf, positions byte length) per document.
+    Args:
+        buffer (bytes-like): The postings file contents.
+        offset (int): Byte position of the term in postings.bin.
+        positions_offset (int): Byte position of the term in positions.bin.
+        doc_gaps (bool): True if doc ids are stored as gaps from the previous doc id.
+        skips (bool): True if a skip table follows df, see read_skips.
+    Returns:
+        FrequencyRun: Document ids, term frequencies and where each document's positions are.
+    """
+    df, start = read_number(buffer, offset)
+    if skips:
+        _, start = read_number(buffer, start)
+        skip_nbytes, start = read_number(buffer, start)
+        start += skip_nbytes
+    triples, end = _decode_triples(buffer, start, df)
+    return _frequency_run(triples, 0, positions_offset, end - offset, doc_gaps)
+
+
+class SkipTable:
+    """Where the blocks of a run with skip pointers start. Block j holds documents
+    j * interval up to (j + 1) * interval, last_doc_ids[j] is the last doc id before block j
+    (0 for the first block) and byte_offsets and position_offsets its start in postings.bin
+    and positions.bin."""
+    def __init__(self, df, last_doc_ids, byte_offsets, position_offsets):
+        self.df = df
+        self.interval = skip_interval(df)
+        self.last_doc_ids = last_doc_ids
+        self.byte_offsets = byte_offsets
+        self.position_offsets = position_offsets
+
+    def __len__(self):
+        return len(self.byte_offsets)
+
+    def blocks_for(self, doc_ids):
+        """Returns the sorted, distinct blocks that may hold any of doc_ids."""
+        return np.unique(np.searchsorted(self.last_doc_ids[1:], doc_ids, 'left'))
+
+
+def read_skips(buffer, offset, positions_offset):
+    """
+    Read the skip table of a run: df, the number of skip entries, their byte length, then per
+    block after the first the (last doc id before it, byte offset, positions byte offset),
+    each as a gap from the previous entry, offsets counted from the first document.
+    Returns:
+        SkipTable: The start of every block of the run, the first one included.
+    """
+    df, start = read_number(buffer, offset)
+    count, start = read_number(buffer, start)
+    skip_nbytes, start = read_number(buffer, start)
+    entries = np.zeros((count + 1, 3), dtype=np.int64)
+    if count:
+        numbers, _ = decode_numbers(buffer[start:start + skip_nbytes])
+        entries[1:] = np.cumsum(numbers.astype(np.int64).reshape(-1, 3), axis=0)
+    return SkipTable(df, entries[:, 0], entries[:, 1] + start + skip_nbytes, entries[:, 2] + positions_offset)
+
+
+def decode_blocks(buffer, skips, blocks):
+    """
+    Decode only some blocks of a run with skip pointers.
+    Args:
+        buffer (bytes-like): The postings file contents.
+        skips (SkipTable): The run's skip table.
+        blocks (array): Sorted block numbers.
+    Returns:
+        FrequencyRun: The documents of those blocks, in doc id order.
+    """
+    runs = []
+    for block in blocks.tolist():
+        count = min(skips.interval, skips.df - block * skips.interval)
+        triples, end = _decode_triples(buffer, int(skips.byte_offsets[block]), count)
+        runs.append(_frequency_run(triples, int(skips.last_doc_ids[block]), int(skips.position_offsets[block]),
+                                   end - int(skips.byte_offsets[block]), True))
+    if not runs:
+        empty = np.zeros(0, dtype=np.int64)
+        return FrequencyRun(empty, empty, empty, empty, 0)
+    return FrequencyRun(np.concatenate([run.doc_ids for run in runs]), np.concatenate([run.tfs for run in runs]),
+                        np.concatenate([run.position_offsets for run in runs]),
+                        np.concatenate([run.position_nbytes for run in runs]), sum(run.nbytes for run in runs))
+
+
+def decode_positions(buffer, run, selected=None):
+    """
+    Decode the positions of some documents of a FrequencyRun from positions.bin.
+    Args:
+        buffer (bytes-like): The positions file contents.
+        run (FrequencyRun): The term's doc/tf stream.
+        selected (array, optional): Indexes into the run of the documents to decode, all if None.
+    Returns:
+        PostingsRun: The selected documents with their positions.
+    """
+    if selected is None:
+        selected = np.arange(len(run), dtype=np.int64)
+    tfs = run.tfs[selected]
+    offsets = run.position_offsets[selected]
+    nbytes = run.position_nbytes[selected]
+    if len(selected) == len(run):
+        # The documents of a term are contiguous, read them in one slice
+        start = int(run.position_offsets[0]) if len(run) else 0
+        data = buffer[start:start + int(run.position_nbytes.sum())]
+    else:
+        data = b''.join(buffer[o:o + n] for o, n in zip(offsets.tolist(), nbytes.tolist()))
+    gaps, _ = decode_numbers(data)
+
+    position_starts = np.zeros(len(tfs) + 1, dtype=np.int64)
+    np.cumsum(tfs, out=position_starts[1:])
+    positions = _absolute_positions(gaps.astype(np.int64), tfs, position_starts)
+    return PostingsRun(run.doc_ids[selected], tfs, positions, position_starts, int(nbytes.sum()))
@@ -0,0 +1,68 @@
+import threading
+from collections import OrderedDict
+
+
+class QueryCache:
+    """LRU cache of query results. Keys are the normalized query form, e.g. the terms and
+    operations produced by convert_text_to_query_format, plus the rank type. Every lookup
+    passes the generation of the index it would run against: when that changes the whole
+    cache is dropped, so results never outlive the index files they were computed from.
+    Results longer than max_result_length are not cached."""
+    def __init__(self, max_entries: int = 1024, max_result_length: int = 10000):
+        self.max_entries = max_entries
+        self.max_result_length = max_result_length
+        self.entries = OrderedDict()
+        self.generation = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def check_generation(self, generation):
+        # Called with the lock held
+        if generation != self.generation:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.generation = generation
+
+    def get(self, key, generation):
+        """Returns the cached result for key, or None."""
+        with self.lock:
+            self.check_generation(generation)
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, generation, result, length=0):
+        """Caches result, length being the number of documents in it."""
+        if length > self.max_result_length or self.max_entries <= 0:
+            return
+        with self.lock:
+            self.check_generation(generation)
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,179 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+
+# Where a query's time goes. Postings are memory-mapped, so reading them from disk happens as
+# page faults while they are decoded and is part of "decode"
+STAGES = ("parse", "lexicon", "decode", "merge", "score", "metadata")
+# Upper bounds in seconds of the histogram buckets, a last one catches everything slower
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _Local(threading.local):
+    # The timer of the query the current thread works on, None when it is not timed. A class
+    # attribute, so threads that never set it read None without a failed lookup
+    timer = None
+
+
+_local = _Local()
+NOT_TIMED = nullcontext()
+
+
+def stage(name):
+    """Returns a context manager charging the time spent in it to stage name of the query the
+    current thread is timing. Stages nest: an inner stage's time is not counted again for the
+    outer one. When no query is timed this is a shared no-op, the only cost is the lookup."""
+    timer = _local.timer
+    if timer is None:
+        return NOT_TIMED
+    return _Stage(timer, name)
+
+
+class _Stage:
+    __slots__ = ("timer", "name", "outer")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        timer = self.timer
+        now = time.perf_counter()
+        self.outer = timer.current
+        if self.outer is not None:
+            timer.stages[self.outer] += now - timer.mark
+        timer.current = self.name
+        timer.mark = now
+
+    def __exit__(self, *exc):
+        timer = self.timer
+        now = time.perf_counter()
+        timer.stages[self.name] += now - timer.mark
+        timer.current = self.outer
+        timer.mark = now
+        return False
+
+
+class QueryTimer:
+    """Time spent by one query in each of STAGES, see stage. Entering the timer makes it the
+    current thread's until it is exited, a query handed to a worker thread enters it again
+    there. An inactive timer does nothing. requested tells whether the response should carry
+    the breakdown."""
+    def __init__(self, endpoint, active=True, requested=False):
+        self.endpoint = endpoint
+        self.active = active
+        self.requested = requested
+        self.started = time.perf_counter()
+        self.finished = None
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.current = None
+        self.mark = 0.0
+        self.previous = None
+
+    def __enter__(self):
+        if self.active:
+            self.previous = _local.timer
+            _local.timer = self
+        return self
+
+    def __exit__(self, *exc):
+        if self.active:
+            _local.timer = self.previous
+            self.previous = None
+        return False
+
+    def stop(self):
+        if self.finished is None:
+            self.finished = time.perf_counter()
+
+    @property
+    def total(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    def report(self):
+        """Returns the breakdown in milliseconds. "other" is the time outside every stage,
+        waiting for a worker included."""
+        stages = {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()}
+        total = self.total
+        return {
+            "total_ms": round(total * 1000, 3),
+            "stages_ms": stages,
+            "other_ms": round(max(0.0, total - sum(self.stages.values())) * 1000, 3),
+        }
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, buckets, value):
+        self.counts[bisect_left(buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class QueryMetrics:
+    """Latency histograms of timed queries, overall and per stage, by endpoint. When disabled,
+    queries are only timed if their response asks for the breakdown and nothing is recorded."""
+    def __init__(self, enabled: bool = True, buckets=BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # endpoint -> Histogram of total times, (endpoint, stage) -> Histogram
+        self.totals = {}
+        self.stages = {}
+
+    def timer(self, endpoint, requested=False):
+        """Returns the QueryTimer of a new query."""
+        return QueryTimer(endpoint, self.enabled or bool(requested), bool(requested))
+
+    def record(self, timer):
+        """Adds a finished query to the histograms. Stages it did not use are left out."""
+        timer.stop()
+        if not (self.enabled and timer.active):
+            return
+        with self.lock:
+            histogram = self.totals.get(timer.endpoint)
+            if histogram is None:
+                histogram = self.totals[timer.endpoint] = Histogram(self.buckets)
+            histogram.observe(self.buckets, timer.total)
+            for name, seconds in timer.stages.items():
+                if seconds > 0:
+                    key = (timer.endpoint, name)
+                    histogram = self.stages.get(key)
+                    if histogram is None:
+                        histogram = self.stages[key] = Histogram(self.buckets)
+                    histogram.observe(self.buckets, seconds)
+
+    def exposition(self):
+        """Returns the histograms in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            lines.append("# HELP query_duration_seconds Time from receiving a query to its response.")
+            lines.append("# TYPE query_duration_seconds histogram")
+            for endpoint, histogram in sorted(self.totals.items()):
+                self.histogram_lines(lines, "query_duration_seconds", 'endpoint="%s"' % endpoint, histogram)
+            lines.append("# HELP query_stage_seconds Time a query spent in each stage.")
+            lines.append("# TYPE query_stage_seconds histogram")
+            for (endpoint, name), histogram in sorted(self.stages.items()):
+                self.histogram_lines(lines, "query_stage_seconds", 'endpoint="%s",stage="%s"' % (endpoint, name), histogram)
+        return "\n".join(lines) + "\n"
+
+    def histogram_lines(self, lines, metric, labels, histogram):
+        # Prometheus buckets are cumulative
+        cumulative = 0
+        for bound, count in zip(self.buckets, histogram.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s,le="%g"} %d' % (metric, labels, bound, cumulative))
+        lines.append('%s_bucket{%s,le="+Inf"} %d' % (metric, labels, histogram.count))
+        lines.append("%s_sum{%s} %.6f" % (metric, labels, histogram.sum))
+        lines.append("%s_count{%s} %d" % (metric, labels, histogram.count))
+
+    def reset(self):
+        with self.lock:
+            self.totals.clear()
+            self.stages.clear()
@@ -0,0 +1,141 @@
+from indexing.intersect import common_sorted, difference_sorted, union_sorted
+
+
+class Plan:
+    """One node of a Boolean query plan. kind is "term", "phrase" or "wildcard" for leaves,
+    holding the query text, "and", "or" or "not". An "and" node keeps the documents in all of children
+    and none of excluded. estimate is the planner's cardinality guess, actual the number of
+    documents the node produced, access how a leaf was read: "scan" for a full read, "probe"
+    for a lookup of the current candidates only, "skipped" if the result was already empty."""
+    def __init__(self, kind, children=None, excluded=None, text=None):
+        self.kind = kind
+        self.children = children or []
+        self.excluded = excluded or []
+        self.text = text
+        self.estimate = None
+        self.actual = None
+        self.access = None
+
+    @classmethod
+    def leaf(cls, text):
+        if len(text.split()) > 1:
+            return cls("phrase", text=text)
+        return cls("wildcard" if '*' in text else "term", text=text)
+
+    @classmethod
+    def from_operations(cls, terms, operations):
+        """Builds the plan of a DiskPositionalIndex query, operations ("AND", "OR" or
+        "AND NOT") applying left to right between consecutive terms."""
+        plan = cls.leaf(terms[0])
+        for term, operation in zip(terms[1:], operations):
+            if operation == "AND":
+                plan = cls("and", [plan, cls.leaf(term)])
+            elif operation == "OR":
+                plan = cls("or", [plan, cls.leaf(term)])
+            elif operation == "AND NOT":
+                plan = cls("and", [plan], [cls.leaf(term)])
+        return plan
+
+    def explain(self):
+        """Returns the plan as nested dicts with estimated and actual cardinalities."""
+        node = {"op": self.kind, "estimate": self.estimate, "actual": self.actual}
+        if self.text is not None:
+            node["text"] = self.text
+            node["access"] = self.access
+        if self.children:
+            node["children"] = [child.explain() for child in self.children]
+        if self.excluded:
+            node["excluded"] = [child.explain() for child in self.excluded]
+        return node
+
+
+class QueryPlanner:
+    """Rewrites and runs Plans against a source, any object with:
+        estimate(plan): the document frequency of a leaf, an upper bound for phrases and
+            wildcards.
+        fetch(plan): the sorted doc ids of a leaf.
+        probe(plan, doc_ids): the doc ids among sorted doc_ids that match a leaf.
+        all_doc_ids(): every sorted doc id, only read for a NOT with nothing to filter.
+    Nested ANDs and ORs are flattened, NOTs inside an AND become filters of its result, AND
+    operands run by ascending estimate so the smallest list drives the others, which are only
+    probed for the surviving candidates, and evaluation stops once the result is empty."""
+    def __init__(self, source):
+        self.source = source
+
+    def plan(self, plan):
+        """Rewrites plan in place and fills in its estimates. Returns the plan."""
+        for child in plan.children + plan.excluded:
+            self.plan(child)
+        if plan.kind == "and":
+            children, excluded = [], list(plan.excluded)
+            for child in plan.children:
+                if child.kind == "and":
+                    children.extend(child.children)
+                    excluded.extend(child.excluded)
+                elif child.kind == "not":
+                    excluded.extend(child.children)
+                else:
+                    children.append(child)
+            # Stable, equal estimates keep the query order
+            plan.children = sorted(children, key=lambda child: child.estimate)
+            plan.excluded = excluded
+            plan.estimate = plan.children[0].estimate if plan.children else None
+        elif plan.kind == "or":
+            children = []
+            for child in plan.children:
+                children.extend(child.children if child.kind == "or" else [child])
+            plan.children = children
+            plan.estimate = sum(child.estimate or 0 for child in children)
+        elif plan.kind == "not":
+            plan.estimate = None
+        else:
+            plan.estimate = self.source.estimate(plan)
+        return plan
+
+    def execute(self, plan):
+        """Runs a planned query and records the actual cardinalities. Returns sorted doc ids."""
+        if plan.kind == "and":
+            result = self.execute_and(plan)
+        elif plan.kind == "or":
+            result = union_sorted([self.execute(child) for child in plan.children])
+        elif plan.kind == "not":
+            result = difference_sorted(self.source.all_doc_ids(), self.execute(plan.children[0]))
+        else:
+            plan.access = "scan"
+            result = self.source.fetch(plan)
+        plan.actual = len(result)
+        return result
+
+    def execute_and(self, plan):
+        if plan.children:
+            result = self.execute(plan.children[0])
+        else:
+            # Only NOTs, nothing to filter but the whole collection
+            result = self.source.all_doc_ids()
+        for child in plan.children[1:]:
+            result = common_sorted(self.matches(child, result), result)
+        for child in plan.excluded:
+            result = difference_sorted(result, self.matches(child, result))
+        return result
+
+    def matches(self, child, result):
+        # Leaves are probed for the current candidates only, anything else is run in full
+        if not len(result):
+            self.skip(child)
+            return result
+        if child.text is not None:
+            child.access = "probe"
+            matches = self.source.probe(child, result)
+            child.actual = len(matches)
+            return matches
+        return self.execute(child)
+
+    def skip(self, plan):
+        if plan.text is not None:
+            plan.access = "skipped"
+        for child in plan.children + plan.excluded:
+            self.skip(child)
+
+    def run(self, plan):
+        """Plans and executes plan. Returns its sorted doc ids."""
+        return self.execute(self.plan(plan))
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+
+class Overloaded(Exception):
+    """Raised when a query is turned away because every worker is busy and the queue is full."""
+
+
+class QueryPool:
+    """Runs query evaluation on a bounded pool of threads. At most workers queries run at
+    once and max_queue more wait for a worker, anything past that is rejected at once with
+    Overloaded rather than queueing behind slow queries, so latency stays bounded under load
+    and callers can answer 503. A query still waiting or running after timeout seconds
+    raises TimeoutError, its slot is only freed once it finishes. Threads rather than
+    processes, the memory-mapped index and its caches are shared by every worker."""
+    def __init__(self, workers: int = 4, max_queue: int = 16, timeout: float = 10.0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="query")
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedules fn(*args, **kwargs). Returns its Future, or raises Overloaded."""
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise Overloaded("%d queries in flight" % (self.workers + self.max_queue))
+        with self.lock:
+            self.in_flight += 1
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self.release(None)
+            raise
+        future.add_done_callback(self.release)
+        return future
+
+    def release(self, future):
+        with self.lock:
+            self.in_flight -= 1
+            self.completed += 1
+        self.slots.release()
+
+    def run(self, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) on the pool and waits for its result."""
+        future = self.submit(fn, *args, **kwargs)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # Dropped if no worker picked it up yet, a running query cannot be interrupted
+            future.cancel()
+            with self.lock:
+                self.timeouts += 1
+            raise
+
+    async def run_async(self, fn, *args, **kwargs):
+        """Like run, for asyncio callers: the event loop is not blocked while fn runs."""
+        future = self.submit(fn, *args, **kwargs)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            with self.lock:
+                self.timeouts += 1
+            raise TimeoutError()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "queued": max(0, self.in_flight - self.workers),
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
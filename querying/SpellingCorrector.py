@@ -0,0 +1,82 @@
+import re
+from TokenProcessor.TermCache import stem_cache
+from querying.QueryCache import QueryCache
+
+
+def edit_distance(a, b, bound):
+    """Levenshtein distance of a and b counting an adjacent transposition as one edit, or
+    bound + 1 as soon as it is known to exceed bound."""
+    if abs(len(a) - len(b)) > bound:
+        return bound + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > bound:
+            return bound + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class SpellingCorrector:
+    """Did you mean suggestions for words no document contains. Candidates are the vocabulary
+    terms whose k-grams overlap the word's by at least min_jaccard, see similar_terms of
+    DiskPositionalIndex, at most max_candidates of them. They are ranked by edit distance to
+    the word's stem, up to max_distance, then by document frequency. The vocabulary holds
+    stems, a correction is shown as the word its stem was most often stemmed from, see
+    display_form of DiskPositionalIndex. Corrections are cached per word and index generation."""
+    def __init__(self, max_distance: int = 2, min_jaccard: float = 0.2, max_candidates: int = 50, max_entries: int = 4096):
+        self.max_distance = max_distance
+        self.min_jaccard = min_jaccard
+        self.max_candidates = max_candidates
+        self.cache = QueryCache(max_entries)
+
+    def correct_word(self, index, word):
+        """Returns the display form of the best vocabulary term for word, or None if it needs no
+        correction or nothing is close enough."""
+        word = word.lower()
+        cached = self.cache.get(word, index.generation)
+        if cached is not None:
+            return cached[0]
+        term = stem_cache(word)
+        correction = None
+        if index.document_frequency(term) == 0:
+            best = None
+            for candidate in index.similar_terms(term, self.min_jaccard, self.max_candidates):
+                distance = edit_distance(term, candidate, self.max_distance)
+                if distance > self.max_distance:
+                    continue
+                key = (distance, -index.document_frequency(candidate), candidate)
+                if best is None or key < best:
+                    best = key
+            correction = index.display_form(best[2]) if best is not None else None
+        # Wrapped so a cached "no correction" is told apart from a miss
+        self.cache.put(word, index.generation, (correction,))
+        return correction
+
+    def suggest(self, index, text):
+        """Returns text with every misspelled word replaced by its correction, or None if no
+        word was corrected. Operators, phrases' quotes and wildcards are left alone."""
+        corrected = False
+
+        def replace(match):
+            nonlocal corrected
+            word = match.group(0)
+            if word in ("AND", "OR", "NOT") or word.isdigit():
+                return word
+            correction = self.correct_word(index, word)
+            if correction is None:
+                return word
+            corrected = True
+            return correction
+
+        suggestion = re.sub(r'(?<![\w*/])\w+(?![\w*/])', replace, text)
+        return suggestion if corrected else None
+
+    def stats(self):
+        return self.cache.stats()
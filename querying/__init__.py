@@ -1 +1,6 @@
-from querying.booleanqueryparser import BooleanQueryParser
\ No newline at end of file
+from querying.booleanqueryparser import BooleanQueryParser
+from querying.QueryCache import QueryCache
+from querying.QueryPlanner import Plan, QueryPlanner
+from querying.SpellingCorrector import SpellingCorrector
+from querying.QueryPool import QueryPool, Overloaded
+from querying.QueryMetrics import QueryMetrics, QueryTimer
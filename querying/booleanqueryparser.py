@@ -1,5 +1,9 @@
 import re
-from porter2stemmer import Porter2Stemmer
+from TokenProcessor.TermCache import stem_cache
+from indexing.proximity import parse_proximity, join_positions
+from indexing.intersect import common_sorted
+from querying.QueryPlanner import Plan, QueryPlanner
+from querying.QueryMetrics import stage
 from nltk.corpus import stopwords
 
 
@@ -9,8 +13,8 @@ class BooleanQueryParser:
 
     def parse_query(self, query):
         # Tokenize the query into components
-        result2 = re.findall(r'\w+|AND|OR|NOT|"[^"]+"|[+-]', query)
-        stemmer = Porter2Stemmer()
+        # "a NEAR/k b" is kept together as one proximity term, like a quoted phrase
+        result2 = re.findall(r'\w+(?:\s+NEAR/\d+\s+\w+)+|\w+|AND|OR|NOT|"[^"]+"|[+-]', query)
         result=[]
         for i in range(len(result2)):
             if result2[i] == "+":
@@ -18,8 +22,11 @@ class BooleanQueryParser:
             elif result2[i] == "-":
                 result.append("and")
                 result.append("not")
+            elif len(result2[i].split()) > 1:
+                # Phrases are stemmed word by word in phrase_query
+                result.append(result2[i])
             else:
-                result.append(stemmer.stem(result2[i]))
+                result.append(stem_cache(result2[i]))
       
         tokens = []
         i = 0
@@ -51,7 +58,6 @@ class BooleanQueryParser:
 
             i=i+1
         components = []
-        print(tokens)
         for i in range(len(tokens)):
             token = tokens[i]
 
@@ -63,6 +69,8 @@ class BooleanQueryParser:
                 components.append('NOT')
             elif token.startswith('"') and token.endswith('"'):
                 components.append(PhraseLiteral(token.strip('"')))
+            elif ' NEAR/' in token:
+                components.append(PhraseLiteral(token))
             else:
                 # Check for "AND NOT" query
                 if i + 2 < len(tokens) and (tokens[i + 1] == 'NOT' or tokens[i + 1] == 'not'):
@@ -137,78 +145,68 @@ class BooleanQueryParser:
         return query_stack[0]
 
     def get_postings(self, query_component):
+        # The query tree is rewritten and ordered by a QueryPlanner, this parser being its source
+        with stage("merge"):
+            return QueryPlanner(self).run(self.to_plan(query_component))
+
+    def explain(self, query):
+        """Runs query and returns its plan with estimated and actual cardinalities."""
+        plan = self.to_plan(self.parse_query(query))
+        QueryPlanner(self).run(plan)
+        return plan.explain()
+
+    def to_plan(self, query_component):
         if isinstance(query_component, TermLiteral):
-            return self.index.get_postings(query_component.term)
+            return Plan("term", text=query_component.term)
         elif isinstance(query_component, PhraseLiteral):
-            print("PhraseLiteral OPT")
-            return self.phrase_query(query_component)
+            return Plan("phrase", text=query_component.terms[0])
         elif isinstance(query_component, AndQuery):
-            print("AND OPT")
-            postings = self.get_postings(query_component.operands[0])
-            for operand in query_component.operands[1:]:
-              
-                postings = self.and_merge(postings, self.get_postings(operand))
-            return postings
+            return Plan("and", [self.to_plan(operand) for operand in query_component.operands])
         elif isinstance(query_component, OrQuery):
-            print("OR OPT")
-            postings = self.get_postings(query_component.operands[0])
-            for operand in query_component.operands[1:]:
-                print(query_component.operands[0],self.get_postings(operand))
-                
-                postings = self.or_merge(postings, self.get_postings(operand))
-            return postings
-        
+            return Plan("or", [self.to_plan(operand) for operand in query_component.operands])
         elif isinstance(query_component, NotQuery):
-            print("NOT OPT")
-            return self.not_query(query_component)
-        
+            return Plan("not", [self.to_plan(query_component.operand)])
         elif isinstance(query_component, AndNotQuery):
-            print("AND NOT OPT")
-            postings1 = self.get_postings(query_component.operands[0])
-            postings2 = self.get_postings(query_component.operands[1])
-            return self.and_not_merge(postings1, postings2)
-        # Add handling for wildcard queries if desired
+            return Plan("and", [self.to_plan(query_component.operands[0])], [self.to_plan(query_component.operands[1])])
 
-    def phrase_query(self, phrase_literal):
-        term=str(phrase_literal.terms[0]).split(" ")
-        stemmer = Porter2Stemmer()
-        postings = self.index.get_phrase_postings(stemmer.stem(term[0]))
-        
-        # Iterate through the rest of the terms in the phrase
-        for i in range(1, len(term)):
-            term_postings = self.index.get_phrase_postings(stemmer.stem(term[i]))
-            # Merge the current postings with the term's postings
-            postings = self.phrase_merge(postings, term_postings)
-            
-        unique_filenames = set()
+    def estimate(self, plan):
+        # QueryPlanner source: a phrase matches at most as many documents as its rarest term
+        if plan.kind == "term":
+            return len(self.index.get_postings(plan.text))
+        terms, _ = parse_proximity(str(plan.text).replace('"', '').split())
+        return min((len(self.index.get_postings(stem_cache(term))) for term in terms), default=0)
 
-        for item in postings:
-            filename = item.get('filename')
-            if filename is not None:  # Check if 'filename' key exists in the dictionary
-                unique_filenames.add(filename)
+    def fetch(self, plan):
+        if plan.kind == "phrase":
+            return self.phrase_query(PhraseLiteral(plan.text))
+        return sorted(self.index.get_postings(plan.text))
 
-        # Convert the set of unique filenames back to a list if needed
-        unique_filenames_list = list(unique_filenames)
+    def probe(self, plan, doc_ids):
+        return common_sorted(self.fetch(plan), doc_ids)
 
+    def all_doc_ids(self):
+        return self.index.get_all_doc_ids()
 
-        return unique_filenames_list
+    def phrase_query(self, phrase_literal):
+        # Exact phrase, or with NEAR/k between words, see parse_proximity
+        terms, gaps = parse_proximity(str(phrase_literal.terms[0]).replace('"', '').split())
+        if not terms:
+            return []
 
-    def not_query(self, not_query):
-        operand_postings = self.get_postings(not_query.operand)
-        all_doc_ids = set(self.index.get_all_doc_ids())
-        not_doc_ids = all_doc_ids - set(operand_postings)
-        return list(not_doc_ids)
+        # Positions of every term grouped by document
+        term_documents = []
+        for term in terms:
+            documents = {}
+            for posting in self.index.get_phrase_postings(stem_cache(term)):
+                documents.setdefault(posting['filename'], []).append(posting['index'])
+            term_documents.append(documents)
 
-    # Add methods for wildcard queries if desired
+        candidates = set(term_documents[0]).intersection(*term_documents[1:])
+        unique_filenames_list = [filename for filename in sorted(candidates)
+                                 if join_positions([sorted(documents[filename]) for documents in term_documents], gaps)]
 
-    # Add your existing methods for "AND" and "OR" merges
+        return unique_filenames_list
 
-    def and_merge(self, postings1, postings2):
-        result = []
-        i, j = 0, 0
-        duplicates = [value for value in postings1 if value in postings2]
-        return duplicates
-    
     def or_merge(self, postings1, postings2):
         # Implement "OR" merge logic
 
@@ -0,0 +1,238 @@
+"""Equivalence checks of the query engine against brute force evaluation over Python sets:
+intersections, DocBitmap, the postings format with skip tables, the Boolean query planner,
+positional joins and segmented indexes. Run with python -m pytest from the repository root."""
+import os
+import random
+import numpy as np
+import pytest
+from indexing import DiskIndexWriter, DiskPositionalIndex, DocBitmap, MergePolicy, PositionalInvertedIndexSqlite, SegmentedIndex, SegmentedIndexWriter
+from indexing.intersect import intersect_sorted, common_sorted, difference_sorted, union_sorted
+from indexing.proximity import parse_proximity, join_positions, join_documents
+from TokenProcessor.TermCache import stem_cache
+
+
+def vocabulary(size, rng):
+    """Words that are their own stem, so queries can name terms directly."""
+    words = []
+    while len(words) < size:
+        word = "".join(rng.choice("bdfgklmnprtvz") + rng.choice("aou") for _ in range(3))
+        if stem_cache(word) == word and word not in words:
+            words.append(word)
+    return words
+
+
+def make_documents(doc_ids, words, rng, length=(5, 40)):
+    """doc id -> list of words, the first words being far more frequent than the last."""
+    weights = [1.0 / (rank + 1) for rank in range(len(words))]
+    return {doc_id: rng.choices(words, weights, k=rng.randint(*length)) for doc_id in doc_ids}
+
+
+def to_index(documents):
+    index = PositionalInvertedIndexSqlite()
+    for doc_id, words in documents.items():
+        positions = {}
+        for position, word in enumerate(words):
+            positions.setdefault(word, []).append(position)
+        for term, term_positions in positions.items():
+            index.add_term(term, doc_id, term_positions)
+        index.add_document(doc_id, "Document %d" % doc_id, "", " ".join(words[:5]))
+    return index
+
+
+def write_index(directory, documents):
+    os.makedirs(directory, exist_ok=True)
+    db_path, postings_file = os.path.join(directory, "vocab_term_mapping.db"), os.path.join(directory, "postings.bin")
+    writer = DiskIndexWriter(to_index(documents), db_path, postings_file)
+    writer.write_index()
+    writer.close()
+    return db_path, postings_file
+
+
+def doc_sets(documents):
+    sets = {}
+    for doc_id, words in documents.items():
+        for word in words:
+            sets.setdefault(word, set()).add(doc_id)
+    return sets
+
+
+def brute_proximity(positions, gaps):
+    """Start positions of the first term of every match, trying every combination."""
+    def matches(i, position):
+        if i == len(gaps):
+            return True
+        low, high = gaps[i]
+        return any(low <= nxt - position <= high and nxt != position and matches(i + 1, nxt) for nxt in positions[i + 1])
+    return [position for position in positions[0] if matches(0, position)]
+
+
+def random_ids(rng, count, limit):
+    return sorted(rng.sample(range(limit), count))
+
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    rng = random.Random(7)
+    words = vocabulary(30, rng)
+    # Ids spread over several 65536 wide bitmap containers, common terms get multi-block skip tables
+    documents = make_documents(random_ids(rng, 700, 200000), words, rng)
+    directory = str(tmp_path_factory.mktemp("index"))
+    return words, documents, write_index(directory, documents)
+
+
+def test_intersections_match_sets():
+    rng = random.Random(1)
+    for _ in range(300):
+        a = random_ids(rng, rng.randint(0, 60), 300)
+        b = random_ids(rng, rng.randint(0, 200), 300)
+        expected = sorted(set(a) & set(b))
+        for x, y in ((a, b), (np.array(a, dtype=np.int64), b), (a, np.array(b, dtype=np.int64))):
+            assert [b[i] for i in list(intersect_sorted(x, y))] == expected
+            assert list(common_sorted(x, y)) == expected
+        assert list(common_sorted(DocBitmap.from_sorted(a), b)) == expected
+        assert (DocBitmap.from_sorted(a) & DocBitmap.from_sorted(b)).to_array().tolist() == expected
+        assert list(difference_sorted(a, b)) == sorted(set(a) - set(b))
+        assert list(difference_sorted(np.array(a, dtype=np.int64), DocBitmap.from_sorted(b))) == sorted(set(a) - set(b))
+        assert list(union_sorted([a, b, a[:3]])) == sorted(set(a) | set(b))
+
+
+def test_bitmap_matches_sets():
+    rng = random.Random(2)
+    for _ in range(20):
+        # Dense groups become bit containers, sparse ones sorted arrays
+        a = sorted(set(random_ids(rng, 6000, 70000) + random_ids(rng, 50, 300000)))
+        b = sorted(set(random_ids(rng, 3000, 140000)))
+        x, y = DocBitmap.from_sorted(a), DocBitmap.from_sorted(b)
+        assert x.to_array().tolist() == a and len(x) == len(a)
+        assert (x & y).to_array().tolist() == sorted(set(a) & set(b))
+        assert (x | y).to_array().tolist() == sorted(set(a) | set(b))
+        assert (x - y).to_array().tolist() == sorted(set(a) - set(b))
+        assert (y - x).to_array().tolist() == sorted(set(b) - set(a))
+        probe = random_ids(rng, 500, 300000)
+        assert x.member(probe).tolist() == [doc_id in set(a) for doc_id in probe]
+        assert all((doc_id in x) == (doc_id in set(a)) for doc_id in probe[:50])
+    assert DocBitmap.full(70000).to_array().tolist() == list(range(70000))
+
+
+def test_postings_round_trip_with_skips(corpus):
+    words, documents, paths = corpus
+    index = DiskPositionalIndex(*paths, cache_bytes=0)
+    sets = doc_sets(documents)
+    rng = random.Random(3)
+    for word in words:
+        expected = [(doc_id, [position for position, w in enumerate(documents[doc_id]) if w == word]) for doc_id in sorted(sets.get(word, ()))]
+        assert index.get_postings(word) == expected
+        assert index.document_frequency(word) == len(expected)
+        # Few ids read only the skip blocks that may hold them, many decode the whole run
+        for count in (3, 40, 400):
+            doc_ids = random_ids(rng, count, 200000) + sorted(rng.sample(sorted(sets[word]), min(count, len(sets[word]))))
+            doc_ids = sorted(set(doc_ids))
+            assert index.intersect_doc_ids(word, doc_ids).tolist() == sorted(set(doc_ids) & sets[word])
+    index.close()
+
+
+@pytest.mark.parametrize("bitmap_min_df", [4096, 20])
+def test_boolean_queries_match_brute_force(corpus, bitmap_min_df):
+    words, documents, paths = corpus
+    index = DiskPositionalIndex(*paths, bitmap_min_df=bitmap_min_df)
+    sets = doc_sets(documents)
+    rng = random.Random(4)
+    for _ in range(300):
+        terms = rng.sample(words, rng.randint(1, 4))
+        operations = [rng.choice(("AND", "OR", "AND NOT")) for _ in terms[1:]]
+        # Operations apply left to right
+        expected = set(sets.get(terms[0], ()))
+        for term, operation in zip(terms[1:], operations):
+            other = sets.get(term, set())
+            expected = expected & other if operation == "AND" else expected | other if operation == "OR" else expected - other
+        assert [doc_id for doc_id, _ in index.query(terms, operations)] == sorted(expected)
+    index.close()
+
+
+def test_phrase_and_near_queries_match_brute_force(corpus):
+    words, documents, paths = corpus
+    index = DiskPositionalIndex(*paths)
+    rng = random.Random(5)
+    for _ in range(150):
+        query = [rng.choice(words[:8])]
+        for _ in range(rng.randint(1, 2)):
+            if rng.random() < 0.5:
+                query.append("NEAR/%d" % rng.randint(1, 4))
+            query.append(rng.choice(words[:8]))
+        terms, gaps = parse_proximity(query)
+        expected = []
+        for doc_id in sorted(documents):
+            positions = [[i for i, w in enumerate(documents[doc_id]) if w == term] for term in terms]
+            if all(positions) and brute_proximity(positions, gaps):
+                expected.append(doc_id)
+        text = " ".join(query) if len(query) > len(terms) else '"%s"' % " ".join(query)
+        assert [doc_id for doc_id, _ in index.query([text], [])] == expected
+        # As the second operand of an AND the phrase is only probed for the candidates
+        other = rng.choice(words)
+        with_other = {doc_id for doc_id, ws in documents.items() if other in ws}
+        assert [doc_id for doc_id, _ in index.query([other, text], ["AND"])] == sorted(set(expected) & with_other)
+    index.close()
+
+
+def test_positional_joins_match_brute_force():
+    rng = random.Random(6)
+    for _ in range(500):
+        query = ["a"]
+        for _ in range(rng.randint(1, 3)):
+            if rng.random() < 0.5:
+                query.append("NEAR/%d" % rng.randint(1, 4))
+            query.append(rng.choice("abc"))
+        terms, gaps = parse_proximity(query)
+        texts = [[rng.choice("abc") for _ in range(rng.randint(1, 25))] for _ in range(6)]
+        expected = []
+        for doc_id, text in enumerate(texts):
+            positions = [[i for i, w in enumerate(text) if w == term] for term in terms]
+            starts = brute_proximity(positions, gaps)
+            assert join_positions(positions, gaps) == starts
+            if starts:
+                expected.append((doc_id, starts))
+        candidates = [doc_id for doc_id, text in enumerate(texts) if all(term in text for term in terms)]
+        term_positions = []
+        for term in terms:
+            tfs = np.array([texts[doc_id].count(term) for doc_id in candidates], dtype=np.int64)
+            positions = np.array([i for doc_id in candidates for i, w in enumerate(texts[doc_id]) if w == term], dtype=np.int64)
+            term_positions.append((tfs, positions))
+        assert join_documents(np.array(candidates, dtype=np.int64), term_positions, gaps) == expected
+    # NEAR is unordered
+    assert join_positions([[5], [3]], parse_proximity(["a", "NEAR/2", "b"])[1]) == [5]
+
+
+def ranked(index, terms, type):
+    key = "Okapi" if type == "okapi" else "score"
+    return [(item["doc_id"], round(item[key], 9)) for item in index.queryRank(terms, type, 20)]
+
+
+def test_segments_match_a_single_index(tmp_path):
+    rng = random.Random(8)
+    words = vocabulary(25, rng)
+    documents = make_documents(range(300), words, rng)
+    writer = SegmentedIndexWriter(str(tmp_path / "segments"), MergePolicy(max_segments=100))
+    for start in range(0, 300, 100):
+        writer.add_segment(to_index({doc_id: documents[doc_id] for doc_id in range(start, start + 100)}))
+    # New versions of some documents, and deletions
+    replaced = make_documents(range(50, 70), words, rng)
+    writer.add_segment(to_index(replaced))
+    documents.update(replaced)
+    deleted = set(range(120, 160))
+    writer.delete_documents(deleted)
+    live = {doc_id: words_ for doc_id, words_ in documents.items() if doc_id not in deleted}
+    reference = DiskPositionalIndex(*write_index(str(tmp_path / "reference"), live))
+
+    segmented = SegmentedIndex(str(tmp_path / "segments"))
+    for merged in (False, True):
+        if merged:
+            writer.merge([segment["name"] for segment in writer.manifest["segments"]])
+            segmented = segmented.refreshed()
+            assert len(segmented.segments) == 1
+        for _ in range(60):
+            terms = rng.sample(words, rng.randint(1, 3))
+            operations = [rng.choice(("AND", "OR", "AND NOT")) for _ in terms[1:]]
+            assert segmented.query(terms, operations) == reference.query(terms, operations)
+            for type in ("okapi", "cosine"):
+                assert ranked(segmented, terms, type) == ranked(reference, terms, type)
+    reference.close()